@@ -0,0 +1,187 @@
+from collections import OrderedDict
+from threading import Lock, Condition
+import re
+import threading
+import time
+import tracing
+
+# Admission control settings of a Raft node, can be overridden through the config passed
+# to Raft or on the command line as --max-client-requests=32 (see utils.parse_config_args)
+DEFAULT_ADMISSION = {
+    # Client commands handled at the same time, peer RPCs do not count
+    'max_client_requests': 32,
+    # Client commands waiting for one of those slots, more are rejected right away
+    'client_queue_size': 128,
+    # A client command that waited this long in the queue is rejected
+    'client_queue_timeout_ms': 1000,
+    # Commands per second every client may send and the burst above that rate, 0 turns
+    # the limit off
+    'client_rate': 0,
+    'client_burst': 50,
+    # Retry after hint of a BUSY reply when the queue is full
+    'busy_retry_ms': 50,
+}
+
+# Raft RPCs between nodes, requests a node sends on behalf of a command it already
+# admitted and operator commands. They never wait behind client commands, so heartbeats
+# and votes still get through when a node is overloaded.
+PEER_COMMANDS = ('VOTE-REQ', 'HEARTBEAT', 'APPEND-REQ', 'TIMEOUT-NOW', 'CODEC-REQ', 'GET-AT',
+                 'SCAN-PART', 'STATUS', 'TRANSFER', 'DRAIN', 'RESUME')
+
+# Prefixes of a message between Multi-Raft hosts (GROUP <partition>) and of a traced
+# command (TRACE <trace id> <span id>), the command after them decides how it is admitted
+ENVELOPE = '^((?:GROUP [0-9]+ )?(?:TRACE [0-9a-f]+ [0-9a-f]+ )?)'
+
+# Commands that hold their request open for a while, they are rate limited but do not
+# take one of the client slots
+LONG_POLL_COMMANDS = ('WATCH',)
+
+
+# Client of the command the current thread is handling, None while it handles a peer RPC
+context = threading.local()
+
+
+def forward(msg):
+    # Prefix a client command that a node passes on to another node (e.g. to the leader)
+    # with the client it came from, that node limits it as that client instead of as the
+    # forwarding node (see AdmissionControl.handle)
+    client = getattr(context, 'client', None)
+    if client is None or msg.split(' ', 1)[0] in PEER_COMMANDS:
+        return msg
+    return f"FORWARD {client} {msg}"
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+
+    def take(self, now):
+        # Returns 0 if a token was taken, otherwise the seconds until the next token
+        self.tokens = min(self.burst, self.tokens + (now - self.last)*self.rate)
+        self.last = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens)/self.rate
+
+
+class AdmissionControl:
+    # Bounded queue in front of the client commands of a node and a token bucket per
+    # client. Rejected commands get BUSY <retry after ms> right away instead of piling up
+    # threads that delay everything else on the node. A command forwarded by another node
+    # is limited as the client named in its FORWARD prefix, addresses are never trusted.
+    def __init__(self, config, max_buckets=10000):
+        self.max_running = config['max_client_requests']
+        self.queue_size = config['client_queue_size']
+        self.queue_timeout_ms = config['client_queue_timeout_ms']
+        self.rate = config['client_rate']
+        self.burst = config['client_burst']
+        self.busy_retry_ms = config['busy_retry_ms']
+        self.max_buckets = max_buckets
+
+        self.cond = Condition(Lock())
+        self.running = 0
+        self.waiting = 0
+        # client -> TokenBucket, least recently used first
+        self.buckets = OrderedDict()
+        self.rejected = 0
+
+    def get_command(self, msg):
+        # Name of the command inside the envelope of msg
+        return re.sub(ENVELOPE, '', msg.strip(), count=1).split(' ', 1)[0]
+
+    def is_peer_message(self, msg):
+        return self.get_command(msg) in PEER_COMMANDS
+
+    def get_client(self, msg, addr):
+        # Clients with a session are told apart by their client id, others by their address
+        session = re.search(' SESSION ([^\s]+) [0-9]+$', msg.strip())
+        if session:
+            return session.group(1)
+        return addr
+
+    def check_rate(self, client):
+        # Returns None if the client is within its rate, otherwise the ms until it is
+        if self.rate <= 0 or client is None:
+            return None
+
+        with self.cond:
+            if client not in self.buckets:
+                self.buckets[client] = TokenBucket(self.rate, self.burst)
+                while len(self.buckets) > self.max_buckets:
+                    self.buckets.popitem(last=False)
+            self.buckets.move_to_end(client)
+            wait = self.buckets[client].take(time.time())
+
+        return int(wait*1000) + 1 if wait > 0 else None
+
+    def acquire(self):
+        with self.cond:
+            if self.running < self.max_running:
+                self.running += 1
+                return True
+
+            if self.waiting >= self.queue_size:
+                return False
+
+            self.waiting += 1
+            admitted = self.cond.wait_for(lambda: self.running < self.max_running,
+                                          timeout=self.queue_timeout_ms/1000.0)
+            self.waiting -= 1
+
+            if admitted:
+                self.running += 1
+            return admitted
+
+    def release(self):
+        with self.cond:
+            self.running -= 1
+            self.cond.notify()
+
+    def handle(self, msg, addr, handler):
+        # Run handler(msg) unless the command is rejected, then BUSY <retry after ms>. The
+        # FORWARD prefix of a forwarded command is removed before handler sees it, the
+        # GROUP and TRACE prefixes are kept.
+        msg = msg.strip()
+        if self.is_peer_message(msg):
+            return handler(msg)
+
+        forwarded = re.match(ENVELOPE + 'FORWARD ([^\s]+) (.*)$', msg, re.S)
+        if forwarded:
+            envelope, client, command = forwarded.groups()
+            msg = envelope + command
+        else:
+            client = self.get_client(msg, addr)
+
+        retry_ms = self.check_rate(client)
+        if retry_ms is not None:
+            self.rejected += 1
+            return f"BUSY {retry_ms}"
+
+        if self.get_command(msg) in LONG_POLL_COMMANDS:
+            return self.handle_as(client, msg, handler)
+
+        with tracing.span('admission'):
+            admitted = self.acquire()
+
+        if not admitted:
+            self.rejected += 1
+            return f"BUSY {self.busy_retry_ms}"
+
+        try:
+            return self.handle_as(client, msg, handler)
+        finally:
+            self.release()
+
+    def handle_as(self, client, msg, handler):
+        # Commands the handler forwards to other nodes carry the client (see forward)
+        previous = getattr(context, 'client', None)
+        context.client = client
+        try:
+            return handler(msg)
+        finally:
+            context.client = previous
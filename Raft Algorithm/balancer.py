@@ -0,0 +1,128 @@
+import argparse
+import re
+import sys
+import time
+import utils
+
+
+def get_host(addr, group_by):
+    return addr.split(':')[0] if group_by == 'ip' else addr
+
+
+def find_leaders(partitions, timeout):
+    # Leader address of every partition, None if no replica claims to be leader. An old
+    # leader that did not notice a new election yet has a lower term.
+    leaders = []
+    for i, cluster in enumerate(partitions):
+        leader, leader_term = None, -1
+        for addr in cluster:
+            resp = utils.request(addr, f"STATUS {i}", timeout)
+            status = re.match('^STATUS ([0-9]+) ([0-9]+) ([A-Z]+) ([0-9]+) ', resp) if resp else None
+            if status and status.group(3) == 'LEADER' and int(status.group(4)) > leader_term:
+                leader, leader_term = addr, int(status.group(4))
+        leaders += [leader]
+    return leaders
+
+
+def plan_move(partitions, leaders, group_by, excluded):
+    # Pick one (partition, target index) that moves a leader from the host with the most
+    # leaders to a replica on a host with at least two leaders less, None once balanced
+    counts = {}
+    for cluster in partitions:
+        for addr in cluster:
+            if get_host(addr, group_by) not in excluded:
+                counts.setdefault(get_host(addr, group_by), 0)
+    for leader in leaders:
+        if leader and get_host(leader, group_by) in counts:
+            counts[get_host(leader, group_by)] += 1
+
+    moves = []
+    for i, cluster in enumerate(partitions):
+        if leaders[i] is None:
+            continue
+        source = get_host(leaders[i], group_by)
+
+        for j, addr in enumerate(cluster):
+            target = get_host(addr, group_by)
+            if target not in counts or target == source:
+                continue
+
+            if source in excluded:
+                # Leaders on drained hosts move wherever there is room
+                moves += [(-len(leaders)-1, counts[target], i, j)]
+            elif counts[source] - counts[target] > 1:
+                moves += [(-(counts[source] - counts[target]), counts[target], i, j)]
+
+    if len(moves) == 0:
+        return None
+    _, _, i, j = min(moves)
+    return i, j
+
+
+def get_host_addrs(partitions, host, group_by):
+    return sorted(set([addr for cluster in partitions for addr in cluster if get_host(addr, group_by) == host]))
+
+
+def balance(partitions, args):
+    excluded = set(args.exclude)
+    moved = 0
+
+    # Drained nodes hand over their leaders and do not start elections anymore, so
+    # leadership does not come back to them while they are down for maintenance
+    for host in excluded:
+        for addr in get_host_addrs(partitions, host, args.group_by):
+            if utils.request(addr, 'DRAIN', args.transfer_timeout) != 'ok':
+                print(f"Draining {addr} failed")
+
+    for host in args.resume:
+        for addr in get_host_addrs(partitions, host, args.group_by):
+            if utils.request(addr, 'RESUME', args.timeout) != 'ok':
+                print(f"Resuming {addr} failed")
+
+    for _ in range(args.max_moves):
+        leaders = find_leaders(partitions, args.timeout)
+        move = plan_move(partitions, leaders, args.group_by, excluded)
+        if move is None:
+            break
+
+        i, j = move
+        print(f"Moving leader of partition {i} from {leaders[i]} to {partitions[i][j]}")
+        resp = utils.request(leaders[i], f"TRANSFER {i} {j}", args.transfer_timeout)
+        if resp != 'ok':
+            print(f"Transfer of partition {i} failed: {resp}")
+            break
+        moved += 1
+
+    leaders = find_leaders(partitions, args.timeout)
+    counts = {}
+    for leader in leaders:
+        if leader:
+            counts[get_host(leader, args.group_by)] = counts.get(get_host(leader, args.group_by), 0) + 1
+    print(f"Moved {moved} leaders, leaders per host: {counts}")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Spread partition leaders evenly across hosts')
+    parser.add_argument('partitions', help="partitions config, same format as raft.py and multiraft.py")
+    parser.add_argument('--group-by', choices=['addr', 'ip'], default='addr',
+                        help='count leaders per ip:port (multiraft.py hosts) or per ip (raft.py nodes on one machine)')
+    parser.add_argument('--exclude', action='append', default=[],
+                        help='host to move all leaders off, e.g. before maintenance, can be repeated')
+    parser.add_argument('--resume', action='append', default=[],
+                        help='host that is back from maintenance and may lead partitions again, can be repeated')
+    parser.add_argument('--max-moves', type=int, default=100, help='leadership transfers per round')
+    parser.add_argument('--interval', type=float, default=0.0, help='keep balancing every interval seconds')
+    parser.add_argument('--timeout', type=float, default=2.0, help='STATUS request timeout in seconds')
+    parser.add_argument('--transfer-timeout', type=float, default=30.0)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    partitions = eval(args.partitions)
+
+    while True:
+        balance(partitions, args)
+        if args.interval <= 0:
+            break
+        time.sleep(args.interval)
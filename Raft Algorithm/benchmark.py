@@ -0,0 +1,301 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+from threading import Lock
+from simulator import SimCluster, SimNetwork
+import utils
+
+SCENARIOS = ['write', 'read', 'mixed', 'failover', 'catchup']
+
+
+def percentile(values, p):
+    # values must be sorted
+    if len(values) == 0:
+        return 0.0
+    k = min(len(values)-1, max(0, int(round(p/100.0*len(values)+0.5))-1))
+    return values[k]
+
+
+def summarize(scenario, latencies, errors, elapsed, extra=None):
+    latencies = sorted(latencies)
+    result = {
+        'scenario': scenario,
+        'ops': len(latencies),
+        'errors': errors,
+        'elapsed_s': round(elapsed, 3),
+        'ops_per_sec': round(len(latencies)/elapsed, 2) if elapsed > 0 else 0.0,
+        'p50_ms': round(percentile(latencies, 50)*1000, 3),
+        'p99_ms': round(percentile(latencies, 99)*1000, 3),
+        'p999_ms': round(percentile(latencies, 99.9)*1000, 3),
+        'max_ms': round(latencies[-1]*1000, 3) if len(latencies) > 0 else 0.0,
+    }
+    if extra:
+        result.update(extra)
+    return result
+
+
+class Workload:
+    # Closed loop clients issuing SET/GET commands against random nodes of the cluster,
+    # the same way client.py picks a random server for every command. Crashed nodes and
+    # nodes cut off from their majority are left out, a real client would fail over from
+    # them instead of waiting out the timeout on every command.
+    def __init__(self, cluster, keys=100, read_ratio=0.0, value_size=8, timeout=2.0, seed=0,
+                 max_stale_ms=None):
+        self.cluster = cluster
+        self.keys = keys
+        self.read_ratio = read_ratio
+        self.value = 'v'*value_size
+        self.timeout = timeout
+        # GETs accept values read from the leader up to max_stale_ms ago, None reads
+        # through the leader every time
+        self.max_stale_ms = max_stale_ms
+        self.rand = random.Random(seed)
+        self.req_ids = itertools.count()
+        self.lock = Lock()
+        self.latencies = []
+        self.errors = 0
+        self.completions = []
+
+    def next_command(self):
+        with self.lock:
+            key = f"key{self.rand.randint(0, self.keys-1)}"
+            is_read = self.rand.random() < self.read_ratio
+            node = self.rand.choice(self.cluster.live_nodes())
+
+        if is_read:
+            stale = f" STALE {self.max_stale_ms}" if self.max_stale_ms is not None else ''
+            return f"GET {key} {next(self.req_ids)}{stale}", node, False
+        return f"SET {key} {self.value} {next(self.req_ids)}", node, True
+
+    def execute(self, client, command, node, is_write):
+        start = time.time()
+        resp = client.send_and_recv_no_retry(command, node.ip, node.port, timeout=self.timeout)
+        end = time.time()
+
+        # Values never contain whitespace, replies such as BUSY <ms> and Error: ... do
+        ok = resp == 'ok' if is_write else resp is not None and resp != 'ko' and ' ' not in resp
+        with self.lock:
+            if ok:
+                self.latencies += [end-start]
+                self.completions += [(start, end)]
+            else:
+                self.errors += 1
+        return ok
+
+    def client_loop(self, deadline):
+        client = self.cluster.client()
+        while time.time() < deadline:
+            command, node, is_write = self.next_command()
+            self.execute(client, command, node, is_write)
+
+    def run(self, clients, duration):
+        deadline = time.time() + duration
+        threads = [utils.run_thread(fn=self.client_loop, args=(deadline,)) for _ in range(clients)]
+        for t in threads:
+            t.join()
+
+    def preload(self, clients):
+        # Write every key once so that reads do not miss. Returns False if the cluster had
+        # no leader to write to.
+        # list.pop and list.append are atomic, which is all the loader threads need
+        keys = list(range(self.keys))
+        no_leader = []
+        client_threads = []
+
+        def loader():
+            client = self.cluster.client()
+            while len(no_leader) == 0:
+                try:
+                    i = keys.pop()
+                except IndexError:
+                    return
+                while True:
+                    leader = self.cluster.wait_for_leader()
+                    if leader is None:
+                        no_leader.append(i)
+                        return
+                    if self.execute(client, f"SET key{i} {self.value} {next(self.req_ids)}", leader, True):
+                        break
+
+        for _ in range(clients):
+            client_threads += [utils.run_thread(fn=loader, args=())]
+        for t in client_threads:
+            t.join()
+
+        self.latencies = []
+        self.completions = []
+        self.errors = 0
+        return len(no_leader) == 0
+
+
+def run_scenario(scenario, args):
+    # Nodes print every message they handle, keep the benchmark output readable
+    sys.stdout = open(os.devnull, 'w')
+
+    # All nodes share one GIL in the simulator, switch threads more often to get
+    # closer to the behaviour of one process per node.
+    sys.setswitchinterval(args.switch_interval)
+
+    network = SimNetwork(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                         loss=args.loss, seed=args.seed)
+    cluster = SimCluster(num_partitions=args.partitions, replicas=args.replicas,
+                         network=network, seed=args.seed, adaptive_timeouts=args.adaptive_timeouts,
+                         config={'compression': args.compression})
+    cluster.start()
+
+    try:
+        for partition in range(args.partitions):
+            if cluster.wait_for_leader(partition) is None:
+                return {'scenario': scenario, 'error': 'no leader elected'}
+
+        read_ratio = {'write': 0.0, 'read': 1.0, 'mixed': args.read_ratio,
+                      'failover': 0.0, 'catchup': 0.0}[scenario]
+        workload = Workload(cluster, keys=args.keys, read_ratio=read_ratio,
+                            value_size=args.value_size, timeout=args.timeout, seed=args.seed,
+                            max_stale_ms=args.max_stale_ms)
+
+        if scenario in ('read', 'mixed') and not workload.preload(args.clients):
+            return {'scenario': scenario, 'error': 'no leader'}
+
+        if scenario == 'failover':
+            return run_failover(cluster, workload, args)
+        if scenario == 'catchup':
+            return run_catchup(cluster, workload, args)
+
+        start = time.time()
+        workload.run(args.clients, args.duration)
+        return summarize(scenario, workload.latencies, workload.errors, time.time()-start,
+                         dict(get_replication_stats(cluster), **get_read_cache_stats(cluster)))
+
+    finally:
+        # Node threads keep running after the log directory is removed, hide their errors
+        sys.stderr = open(os.devnull, 'w')
+        cluster.stop()
+
+
+def get_replication_stats(cluster):
+    # Bytes of AppendEntries batches sent by all nodes before and after compression
+    raw = sum([node.replication_bytes[0] for node in cluster.nodes])
+    sent = sum([node.replication_bytes[1] for node in cluster.nodes])
+    return {'replication_kb': round(sent/1024.0, 1),
+            'compression_ratio': round(raw/float(sent), 2) if sent > 0 else None}
+
+
+def get_read_cache_stats(cluster):
+    # Share of GETs with a STALE bound that followers answered from their cache
+    hits = sum([node.read_cache.hits for node in cluster.nodes])
+    misses = sum([node.read_cache.misses for node in cluster.nodes])
+    return {'read_cache_hit_ratio': round(hits/float(hits+misses), 3) if hits+misses > 0 else None}
+
+
+def run_failover(cluster, workload, args):
+    # Crash the leader a third of the way into the run and measure how long it takes
+    # until a new leader is elected and until writes succeed again.
+    start = time.time()
+    runner = utils.run_thread(fn=workload.run, args=(args.clients, args.duration))
+
+    time.sleep(args.duration/3.0)
+    old_leader = cluster.leader()
+    if old_leader is None:
+        runner.join()
+        return {'scenario': 'failover', 'error': 'no leader'}
+    crash_time = time.time()
+    cluster.network.isolate(cluster.addr(old_leader))
+
+    new_leader = cluster.wait_for_leader(timeout=args.duration)
+    election_time = time.time()
+    runner.join()
+
+    with workload.lock:
+        resumed = [end for op_start, end in workload.completions if op_start >= crash_time]
+
+    extra = {
+        'election_ms': round((election_time-crash_time)*1000, 3) if new_leader else None,
+        'write_unavailable_ms': round((min(resumed)-crash_time)*1000, 3) if len(resumed) > 0 else None,
+    }
+    return summarize('failover', workload.latencies, workload.errors, time.time()-start, extra)
+
+
+def run_catchup(cluster, workload, args):
+    # Take a follower offline while writes go on, then measure how long it takes
+    # to replicate the missing entries after it comes back.
+    leader = cluster.leader()
+    if leader is None:
+        return {'scenario': 'catchup', 'error': 'no leader'}
+    follower = [node for node in cluster.partition_nodes(0) if node is not leader][0]
+    cluster.network.isolate(cluster.addr(follower))
+
+    start = time.time()
+    workload.run(args.clients, args.duration)
+    elapsed = time.time()-start
+
+    follower_last_index, _ = follower.commit_log.get_last_index_term()
+    leader = cluster.wait_for_leader()
+    if leader is None:
+        return {'scenario': 'catchup', 'error': 'no leader'}
+    leader_last_index, _ = leader.commit_log.get_last_index_term()
+
+    heal_time = time.time()
+    cluster.network.heal(cluster.addr(follower))
+    caught_up = cluster.wait_for_catch_up(follower, timeout=args.duration*10)
+
+    extra = {
+        'entries_behind': leader_last_index-follower_last_index,
+        'catchup_ms': round((time.time()-heal_time)*1000, 3) if caught_up else None,
+    }
+    return summarize('catchup', workload.latencies, workload.errors, elapsed, extra)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Throughput and latency benchmarks on a simulated Raft cluster')
+    parser.add_argument('scenarios', nargs='*', default=SCENARIOS, help=f"any of {', '.join(SCENARIOS)}")
+    parser.add_argument('--replicas', type=int, default=3)
+    parser.add_argument('--partitions', type=int, default=1)
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per scenario')
+    parser.add_argument('--keys', type=int, default=100)
+    parser.add_argument('--value-size', type=int, default=8)
+    parser.add_argument('--read-ratio', type=float, default=0.9, help='fraction of GETs in the mixed scenario')
+    parser.add_argument('--timeout', type=float, default=2.0, help='client timeout in seconds')
+    parser.add_argument('--latency-ms', type=float, default=1.0, help='round trip time between nodes')
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--loss', type=float, default=0.0, help='probability of dropping a message')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compression', choices=['none', 'zlib'], default='none',
+                        help='codec for AppendEntries batches')
+    parser.add_argument('--max-stale-ms', type=int, default=None,
+                        help='let followers answer GETs from their cache with values up to this old')
+    parser.add_argument('--adaptive-timeouts', action='store_true', help='derive timeouts from measured round trips')
+    parser.add_argument('--switch-interval', type=float, default=0.0005)
+    parser.add_argument('--output', default=None, help='write results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f"unknown scenario {scenario}")
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    results = []
+
+    # Every scenario runs in a fresh process, Raft threads can not be stopped and
+    # would otherwise keep running into the next scenario.
+    ctx = multiprocessing.get_context('spawn')
+
+    for scenario in args.scenarios:
+        with ctx.Pool(1) as pool:
+            result = pool.apply(run_scenario, (scenario, args))
+
+        results += [result]
+        print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2)
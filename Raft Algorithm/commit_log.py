@@ -1,126 +1,407 @@
-from datetime import datetime
-from threading import Lock
-import os, tqdm
-
-
-class CommitLog:
-    def __init__(self, file='commit-log.txt'):
-        self.file = file
-        self.lock = Lock()
-        self.last_term = 0
-        self.last_index = -1
-
-    def truncate(self):
-        # Truncate file
-        with self.lock:
-            with open(self.file, 'w') as f:
-                f.truncate()
-
-        self.last_term = 0
-        self.last_index = -1
-
-    def get_last_index_term(self):
-        with self.lock:
-            return self.last_index, self.last_term
-
-    def log(self, term, command):
-        # Append the term and command to file along with timestamp
-        with self.lock:
-            with open(self.file, 'a') as f:
-                now = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-                message = f"{now},{term},{command}"
-                f.write(f"{message}\n")
-                self.last_term = term
-                self.last_index += 1
-
-            return self.last_index, self.last_term
-
-    def log_replace(self, term, commands, start):
-        # Replace or Append multiple commands starting at 'start' index line number in file
-        index = 0
-        i = 0
-        with self.lock:
-            with open(self.file, 'r+') as f:
-                if len(commands) > 0:
-                    while i < len(commands):
-                        if index >= start:
-                            command = commands[i]
-                            i += 1
-                            now = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-                            message = f"{now},{term},{command}"
-                            f.write(f"{message}\n")
-
-                            if index > self.last_index:
-                                self.last_term = term
-                                self.last_index = index
-
-                        index += 1
-
-                    # Truncate all lines coming after last command.
-                    f.truncate()
-
-            return self.last_index, self.last_term
-
-    def read_log(self):
-        # Return in memory array of term and command
-        with self.lock:
-            output = []
-            with open(self.file, 'r') as f:
-                for line in f:
-                    _, term, command = line.strip().split(",")
-                    output += [(term, command)]
-
-            return output
-
-    def read_logs_start_end(self, start, end=None):
-        # Return in memory array of term and command between start and end indices
-        with self.lock:
-            output = []
-            index = 0
-            with open(self.file, 'r') as f:
-                for line in f:
-                    if index >= start:
-                        _, term, command = line.strip().split(",")
-                        output += [(term, command)]
-
-                    index += 1
-                    if end and index > end:
-                        break
-
-            return output
-
-    def write_log_from_sock(self, sock):
-        # Read from socket and write to log
-        with self.lock:
-            file_name = self.file
-            file_size = os.path.getsize(file_name)
-            BUFFER_SIZE = 4096
-
-            sock.send("commitlog".encode())
-
-            progress = tqdm.tqdm(range(file_size), f"Receiving {file_name}", unit="B", unit_scale=True,
-                                 unit_divisor=1024)
-
-            with open(self.file, 'ab') as f:
-                while True:
-                    bytes_read = sock.recv(BUFFER_SIZE)
-                    if not bytes_read:
-                        break
-                    f.write(bytes_read)
-                    progress.update(len(bytes_read))
-
-    def send_log_to_sock(self, sock):
-        # Send log through socket
-        with self.lock:
-            file_name = self.file
-            file_size = os.path.getsize(file_name)
-            BUFFER_SIZE = 4096
-
-            progress = tqdm.tqdm(range(file_size), f"Sending {file_name}", unit="B", unit_scale=True, unit_divisor=1024)
-            with open(file_name, "rb") as f:
-                while True:
-                    bytes_read = f.read(BUFFER_SIZE)
-                    if not bytes_read:
-                        break
-                    sock.sendall(bytes_read)
+from datetime import datetime
+from threading import Lock, Event, Thread
+from array import array
+from queue import Queue, Empty
+from collections import OrderedDict
+import os, re, struct, tqdm
+import compression
+
+
+class BatchedLogWriter:
+    # Shared by the commit logs of all Raft groups hosted in one process. Appends from
+    # all logs are written by a single thread: every file in a batch is opened once and
+    # flushed (and fsynced if sync is set) once, however many entries it received.
+    def __init__(self, sync=False):
+        self.sync = sync
+        self.queue = Queue()
+
+        writer_thread = Thread(target=self.run)
+        writer_thread.daemon = True
+        writer_thread.start()
+
+    def write(self, file, message):
+        # Blocks until the message is on disk
+        done = Event()
+        self.queue.put((file, message, done))
+        done.wait()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get(block=True)]
+            while True:
+                try:
+                    batch += [self.queue.get_nowait()]
+                except Empty:
+                    break
+
+            # Keep the order of messages within each file
+            files = {}
+            for file, message, _ in batch:
+                files.setdefault(file, []).append(message)
+
+            for file, messages in files.items():
+                with open(file, 'a') as f:
+                    f.write(''.join(messages))
+                    f.flush()
+                    if self.sync:
+                        os.fsync(f.fileno())
+
+            for _, _, done in batch:
+                done.set()
+
+
+class CommitLog:
+    # Entries are lines of timestamp,term,command in a text file. With segment_entries set,
+    # committed entries are sealed into compressed segment files of that many entries,
+    # named <file>.<first index>-<last index>.seg, and the text file only holds the entries
+    # from base_index on. Segments are split into blocks of block_entries entries that
+    # are compressed one by one with a dictionary trained from the segment's entries.
+    def __init__(self, file='commit-log.txt', writer=None, codec='none', segment_entries=0,
+                 block_entries=32, dictionary_bytes=4096, level=6):
+        self.file = file
+        self.writer = writer
+        self.lock = Lock()
+        self.last_term = 0
+        self.last_index = -1
+
+        self.codec = codec
+        self.segment_entries = segment_entries
+        self.block_entries = block_entries
+        self.dictionary_bytes = dictionary_bytes
+        self.level = level
+        self.base_index = 0
+        # (first index, last index, path) of every segment in log order
+        self.segments = []
+        # Headers and decompressed blocks of segments that were read recently
+        self.segment_headers = {}
+        self.blocks = OrderedDict()
+
+        # Byte offset of every line in the file, so that reading from an index seeks to
+        # it instead of scanning the file from the beginning
+        self.offsets = array('q')
+        self.size = 0
+        self.load()
+
+    def load(self):
+        # Pick up entries of an existing log file, e.g. after a restart
+        self.offsets = array('q')
+        self.size = 0
+        self.last_term = 0
+        self.last_index = -1
+        self.load_segments()
+
+        if os.path.exists(self.file):
+            with open(self.file, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # Torn write at the end of the file
+                        break
+                    self.offsets.append(self.size)
+                    self.size += len(line)
+                    self.last_term = int(line.decode().split(",", 2)[1])
+
+            if self.size < os.path.getsize(self.file):
+                # Drop the torn entry, the next entry is appended where it started
+                with open(self.file, 'rb+') as f:
+                    f.truncate(self.size)
+
+        if len(self.offsets) == 0 and len(self.segments) > 0:
+            self.last_term = int(self.read_segment_entry(self.base_index-1)[0])
+
+        self.last_index = self.base_index + len(self.offsets)-1
+
+    def load_segments(self):
+        # A seal writes the segment, then the remaining entries to <file>.rest, then the new
+        # base index to <file>.base and finally moves <file>.rest over the file. Whatever a
+        # crash left behind is completed or rolled back here.
+        directory = os.path.dirname(os.path.abspath(self.file))
+        name = os.path.basename(self.file)
+
+        self.base_index = 0
+        if os.path.exists(self.file + '.base'):
+            with open(self.file + '.base') as f:
+                self.base_index = int(f.read())
+
+        self.segments = []
+        unfinished = False
+        for entry in sorted(os.listdir(directory)):
+            if entry.startswith(name + '.') and entry.endswith('.tmp'):
+                os.remove(os.path.join(directory, entry))
+                continue
+
+            segment = re.match('^' + re.escape(name) + '\\.([0-9]+)-([0-9]+)\\.seg$', entry)
+            if segment:
+                start, end = int(segment.group(1)), int(segment.group(2))
+                if start >= self.base_index:
+                    # Sealed but the base index was never moved past it
+                    os.remove(os.path.join(directory, entry))
+                    unfinished = True
+                else:
+                    self.segments += [(start, end, os.path.join(directory, entry))]
+
+        self.segments = sorted(self.segments)
+
+        if os.path.exists(self.file + '.rest'):
+            if unfinished:
+                os.remove(self.file + '.rest')
+            else:
+                os.replace(self.file + '.rest', self.file)
+
+    def truncate(self):
+        # Truncate file
+        with self.lock:
+            with open(self.file, 'w') as f:
+                f.truncate()
+
+            for _, _, path in self.segments:
+                os.remove(path)
+            if os.path.exists(self.file + '.base'):
+                os.remove(self.file + '.base')
+
+            self.segments = []
+            self.segment_headers = {}
+            self.blocks = OrderedDict()
+            self.base_index = 0
+            self.offsets = array('q')
+            self.size = 0
+
+        self.last_term = 0
+        self.last_index = -1
+
+    def write_file(self, path, data):
+        # Write data to path through a temporary file so that path is either complete or missing
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def seal(self, upto):
+        # Move the committed entries up to index upto into compressed segments, a segment is
+        # only written once segment_entries entries can go into it
+        if self.segment_entries <= 0:
+            return
+
+        with self.lock:
+            while upto - self.base_index + 1 >= self.segment_entries:
+                start, end = self.base_index, self.base_index + self.segment_entries - 1
+                split = self.offsets[self.segment_entries] if self.segment_entries < len(self.offsets) else self.size
+
+                with open(self.file, 'rb') as f:
+                    data = f.read(self.size)
+
+                lines = data[:split].split(b'\n')[:-1]
+                path = f"{self.file}.{start}-{end}.seg"
+                self.write_file(path, self.get_segment_data(lines))
+
+                with open(self.file + '.rest', 'wb') as f:
+                    f.write(data[split:])
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                self.write_file(self.file + '.base', str(end+1).encode())
+                os.replace(self.file + '.rest', self.file)
+
+                self.offsets = array('q', [offset - split for offset in self.offsets[self.segment_entries:]])
+                self.size -= split
+                self.base_index = end+1
+                self.segments += [(start, end, path)]
+
+    def get_segment_data(self, lines):
+        # Header line with codec, block size and dictionary length, the dictionary, then
+        # every block as its compressed length and data
+        dictionary = b''
+        if self.codec != 'none' and self.dictionary_bytes > 0:
+            dictionary = compression.train_dictionary(lines, self.dictionary_bytes)
+
+        data = [f"{self.codec} {self.block_entries} {len(dictionary)}\n".encode(), dictionary]
+        for i in range(0, len(lines), self.block_entries):
+            block = compression.compress(self.codec, b'\n'.join(lines[i:i+self.block_entries]),
+                                         dictionary, self.level)
+            data += [struct.pack('<I', len(block)), block]
+
+        return b''.join(data)
+
+    def get_segment_header(self, path):
+        # (codec, block entries, dictionary, offset of every block)
+        if path not in self.segment_headers:
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            header, data = data.split(b'\n', 1)
+            codec, block_entries, dictionary_length = header.decode().split(' ')
+            dictionary = data[:int(dictionary_length)]
+
+            blocks = []
+            position = int(dictionary_length)
+            while position < len(data):
+                length = struct.unpack_from('<I', data, position)[0]
+                blocks += [(position + len(header) + 1 + 4, length)]
+                position += 4 + length
+
+            self.segment_headers[path] = (codec, int(block_entries), dictionary, blocks)
+
+        return self.segment_headers[path]
+
+    def read_segment_entry(self, index):
+        # (term, command) of an entry that was sealed into a segment
+        for start, end, path in self.segments:
+            if start <= index <= end:
+                codec, block_entries, dictionary, blocks = self.get_segment_header(path)
+                block = (index - start) // block_entries
+
+                if (path, block) not in self.blocks:
+                    with open(path, 'rb') as f:
+                        f.seek(blocks[block][0])
+                        data = compression.decompress(codec, f.read(blocks[block][1]), dictionary)
+                    self.blocks[(path, block)] = data.split(b'\n')
+
+                    while len(self.blocks) > 16:
+                        self.blocks.popitem(last=False)
+
+                self.blocks.move_to_end((path, block))
+                _, term, command = self.blocks[(path, block)][(index - start) % block_entries].decode().split(",", 2)
+                return term, command
+
+        return None
+
+    def get_first_index(self):
+        # Entries before this index were compacted away
+        with self.lock:
+            return self.segments[0][0] if len(self.segments) > 0 else self.base_index
+
+    def compact(self, upto):
+        # Delete the segments that only hold entries before index upto, oldest first so
+        # that the remaining segments always follow each other without a gap. The newest
+        # segment is kept for the term of the last entry when the text file is empty.
+        with self.lock:
+            while len(self.segments) > 1 and self.segments[0][1] < upto:
+                _, _, path = self.segments.pop(0)
+                os.remove(path)
+                self.segment_headers.pop(path, None)
+                for block in [block for block in self.blocks if block[0] == path]:
+                    self.blocks.pop(block)
+
+    def get_last_index_term(self):
+        with self.lock:
+            return self.last_index, self.last_term
+
+    def log(self, term, command):
+        # Append the term and command to file along with timestamp
+        with self.lock:
+            now = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+            message = f"{now},{term},{command}"
+
+            if self.writer:
+                self.writer.write(self.file, f"{message}\n")
+            else:
+                with open(self.file, 'a') as f:
+                    f.write(f"{message}\n")
+
+            self.offsets.append(self.size)
+            self.size += len(f"{message}\n".encode())
+            self.last_term = term
+            self.last_index += 1
+
+            return self.last_index, self.last_term
+
+    def log_replace(self, terms, commands, start):
+        # Replace or Append multiple commands starting at 'start' index line number in file,
+        # every command is stored with its term from terms
+        with self.lock:
+            with open(self.file, 'rb+') as f:
+                if start < self.base_index:
+                    # Entries before the base index are committed and already the same
+                    commands = commands[self.base_index-start:]
+                    terms = terms[self.base_index-start:]
+                    start = self.base_index
+
+                if len(commands) > 0:
+                    # Writing begins right after the lines before start
+                    start = min(start - self.base_index, len(self.offsets))
+                    position = self.offsets[start] if start < len(self.offsets) else self.size
+                    del self.offsets[start:]
+                    f.seek(position)
+
+                    for term, command in zip(terms, commands):
+                        now = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+                        message = f"{now},{term},{command}\n".encode()
+                        f.write(message)
+                        self.offsets.append(position)
+                        position += len(message)
+
+                    # Truncate all lines coming after last command.
+                    f.truncate()
+
+                    self.size = position
+                    self.last_term = int(terms[-1])
+                    self.last_index = self.base_index + len(self.offsets)-1
+
+            return self.last_index, self.last_term
+
+    def read_log(self):
+        # Return in memory array of term and command
+        return self.read_logs_start_end(0)
+
+    def read_logs_start_end(self, start, end=None):
+        # Return in memory array of term and command between start and end indices
+        with self.lock:
+            output = []
+            start = max(start, 0)
+            end = self.last_index if end is None else min(end, self.last_index)
+
+            if start > end:
+                return output
+
+            while start <= end and start < self.base_index:
+                output += [self.read_segment_entry(start)]
+                start += 1
+
+            if start > end:
+                return output
+
+            with open(self.file, 'rb') as f:
+                f.seek(self.offsets[start - self.base_index])
+                for _ in range(end-start+1):
+                    _, term, command = f.readline().decode().strip().split(",", 2)
+                    output += [(term, command)]
+
+            return output
+
+    def write_log_from_sock(self, sock):
+        # Read from socket and write to log
+        with self.lock:
+            file_name = self.file
+            file_size = os.path.getsize(file_name)
+            BUFFER_SIZE = 4096
+
+            sock.send("commitlog".encode())
+
+            progress = tqdm.tqdm(range(file_size), f"Receiving {file_name}", unit="B", unit_scale=True,
+                                 unit_divisor=1024)
+
+            with open(self.file, 'ab') as f:
+                while True:
+                    bytes_read = sock.recv(BUFFER_SIZE)
+                    if not bytes_read:
+                        break
+                    f.write(bytes_read)
+                    progress.update(len(bytes_read))
+
+            self.load()
+
+    def send_log_to_sock(self, sock):
+        # Send log through socket
+        with self.lock:
+            file_name = self.file
+            file_size = os.path.getsize(file_name)
+            BUFFER_SIZE = 4096
+
+            progress = tqdm.tqdm(range(file_size), f"Sending {file_name}", unit="B", unit_scale=True, unit_divisor=1024)
+            with open(file_name, "rb") as f:
+                while True:
+                    bytes_read = f.read(BUFFER_SIZE)
+                    if not bytes_read:
+                        break
+                    sock.sendall(bytes_read)
                     progress.update(len(bytes_read))
\ No newline at end of file
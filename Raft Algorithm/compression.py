@@ -0,0 +1,122 @@
+from collections import OrderedDict
+from threading import Lock
+import base64
+import zlib
+
+# Compression settings of a Raft node, can be overridden through the config passed to
+# Raft or on the command line as --compression=zlib (see utils.parse_config_args)
+DEFAULT_COMPRESSION = {
+    # Codec for AppendEntries batches and sealed commit log segments, none or zlib
+    'compression': 'none',
+    'compression_level': 6,
+    # AppendEntries batches smaller than this are sent as they are
+    'compress_min_bytes': 256,
+    # Size of the dictionary trained from recent log entries, 0 compresses without one
+    'dictionary_bytes': 4096,
+    # The leader trains a new dictionary from the last dictionary_entries committed
+    # entries once that many entries were committed since the previous one
+    'dictionary_entries': 1000,
+    # Committed entries are moved from the text log into compressed segment files of
+    # this many entries, 0 keeps the whole log as text
+    'wal_segment_entries': 0,
+    # Entries per compressed block of a segment, reading an entry decompresses its block
+    'wal_block_entries': 32,
+    # Segments that end more than this many entries before the last applied entry are
+    # deleted once every replica has them, 0 keeps all segments. Only replicas with a
+    # durable state machine (disk_hashtable.DiskHashTable) delete their segments.
+    'wal_retain_entries': 0,
+}
+
+# Codecs this node can decode, in order of preference
+CODECS = ['zlib', 'none']
+
+
+def get_dictionary_id(dictionary):
+    return zlib.crc32(dictionary) if dictionary else -1
+
+
+def train_dictionary(samples, size):
+    # A zlib preset dictionary is a string of bytes that is likely to appear in the input,
+    # matches close to its end are the cheapest. Keep the most recent distinct samples,
+    # newest last, until the dictionary is full. The result only depends on the samples,
+    # so replicas holding the same log entries train the same dictionary.
+    chosen = []
+    seen = set()
+    total = 0
+    for sample in reversed(samples):
+        sample = sample.encode() if isinstance(sample, str) else sample
+        if sample in seen:
+            continue
+        if total + len(sample) + 1 > size:
+            break
+        seen.add(sample)
+        chosen += [sample]
+        total += len(sample) + 1
+
+    return b'\n'.join(reversed(chosen))
+
+
+def compress(codec, data, dictionary=None, level=6):
+    if codec == 'none':
+        return data
+
+    # Raw deflate, the zlib header and checksum are left out
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(codec, data, dictionary=None):
+    if codec == 'none':
+        return data
+
+    if dictionary:
+        decompressor = zlib.decompressobj(-15, zdict=dictionary)
+    else:
+        decompressor = zlib.decompressobj(-15)
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+def encode_payload(codec, dictionary_id, dictionary, text, level=6):
+    # Z<codec>:<dictionary id>:<base64 data>, has no whitespace so that it fits wherever
+    # the protocol expects a single token
+    data = base64.b64encode(compress(codec, text.encode(), dictionary, level)).decode()
+    return f"Z{codec}:{dictionary_id}:{data}"
+
+
+def decode_payload(payload, dictionaries):
+    # Returns the text or None if the dictionary is not in the DictionaryStore
+    codec, dictionary_id, data = payload[1:].split(':', 2)
+    dictionary_id = int(dictionary_id)
+
+    dictionary = None
+    if dictionary_id != -1:
+        dictionary = dictionaries.get(dictionary_id)
+        if dictionary is None:
+            return None
+
+    return decompress(codec, base64.b64decode(data), dictionary).decode()
+
+
+class DictionaryStore:
+    # Dictionaries by id, only the most recent ones are kept
+    def __init__(self, max_dictionaries=4):
+        self.max_dictionaries = max_dictionaries
+        self.dictionaries = OrderedDict()
+        self.lock = Lock()
+
+    def add(self, dictionary):
+        dictionary_id = get_dictionary_id(dictionary)
+        with self.lock:
+            self.dictionaries[dictionary_id] = dictionary
+            self.dictionaries.move_to_end(dictionary_id)
+
+            while len(self.dictionaries) > self.max_dictionaries:
+                self.dictionaries.popitem(last=False)
+        return dictionary_id
+
+    def get(self, dictionary_id):
+        with self.lock:
+            return self.dictionaries.get(dictionary_id)
@@ -0,0 +1,436 @@
+from collections import OrderedDict
+from threading import Lock
+import heapq
+import mmap
+import os
+import re
+import struct
+import zlib
+from sortedcontainers import SortedList
+from hashtable import scan_keys
+
+# Every record is a header followed by the key and the value:
+# crc32 of the rest of the record, record type, req_id, expire_at, key length, value length
+HEADER = struct.Struct('<IBqqII')
+
+PUT = 1
+DELETE = 2
+# req_id holds the index of the last applied log entry
+APPLIED = 3
+# First record of a merged file, req_id holds the highest file id the merge replaced
+MERGED = 4
+# Client session, the key is the client id, req_id the last sequence number, expire_at the
+# time of the last command and the value the response
+SESSION = 5
+
+
+class ValueCache:
+    # LRU cache of values bounded by the total size of the cached values, size is the
+    # length of the encoded value as stored in the data file
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        # key -> (value, size)
+        self.values = OrderedDict()
+
+    def get(self, key):
+        if key in self.values:
+            self.values.move_to_end(key)
+            return self.values[key][0]
+        return None
+
+    def put(self, key, value, size):
+        self.discard(key)
+        if size > self.max_bytes:
+            return
+
+        self.values[key] = (value, size)
+        self.bytes += size
+
+        while self.bytes > self.max_bytes:
+            _, (_, old_size) = self.values.popitem(last=False)
+            self.bytes -= old_size
+
+    def discard(self, key):
+        if key in self.values:
+            self.bytes -= self.values.pop(key)[1]
+
+
+class DiskHashTable:
+    # Log structured hash table for data sets larger than memory, a drop-in replacement for
+    # HashTable. Values live in append-only data files, only the keys are kept in memory
+    # together with the location of their latest value. Sealed data files are read through
+    # mmap, hot values are kept in a size bounded LRU cache. The index of the last applied
+    # log entry is written to the same data files, so after a restart Raft only replays
+    # the log entries after it. Once enough of the data is overwritten or deleted, the
+    # sealed files are merged into one file holding only live values.
+    def __init__(self, directory, max_file_size=64*1024*1024, cache_bytes=64*1024*1024, sync=False,
+                 merge_ratio=0.5):
+        self.directory = directory
+        self.max_file_size = max_file_size
+        self.sync = sync
+        self.merge_ratio = merge_ratio
+        self.lock = Lock()
+        self.cache = ValueCache(cache_bytes)
+
+        # key -> (file_id, value offset, value length, req_id)
+        self.index = {}
+        # Keys of the index in sorted order for range scans
+        self.keys = SortedList()
+        # Same as HashTable.expiry, expiry_heap and track_expiry
+        self.expiry = {}
+        self.expiry_heap = []
+        self.track_expiry = False
+        self.applied_index = -1
+        # Data and applied index survive a restart, so the log before the applied index
+        # may be compacted away
+        self.durable = True
+        # Same as HashTable.sessions
+        self.sessions = OrderedDict()
+
+        self.maps = {}
+        self.active_id = 0
+        self.active = None
+        self.active_size = 0
+        self.total_bytes = 0
+        self.dead_bytes = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def get_file(self, file_id):
+        return os.path.join(self.directory, f"data-{file_id:08d}.log")
+
+    def list_files(self):
+        file_ids = []
+        for name in os.listdir(self.directory):
+            data_file = re.match('^data-([0-9]+)\\.log$', name)
+            if data_file:
+                file_ids += [int(data_file.group(1))]
+        return sorted(file_ids)
+
+    def read_records(self, file_id):
+        # Yields (offset, type, req_id, expire_at, key, value offset, value length, record size)
+        # and stops at the first incomplete or corrupt record
+        if os.path.getsize(self.get_file(file_id)) == 0:
+            return
+
+        with open(self.get_file(file_id), 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            offset = 0
+            while offset + HEADER.size <= len(data):
+                crc, kind, req_id, expire_at, key_len, value_len = HEADER.unpack_from(data, offset)
+                end = offset + HEADER.size + key_len + value_len
+
+                if end > len(data) or zlib.crc32(data[offset+4:end]) != crc:
+                    break
+
+                key = data[offset+HEADER.size:offset+HEADER.size+key_len].decode()
+                yield offset, kind, req_id, expire_at, key, offset+HEADER.size+key_len, value_len, end-offset
+                offset = end
+        finally:
+            data.close()
+
+    def load(self):
+        file_ids = self.list_files()
+
+        # Files replaced by a merge that could not be deleted before a crash are dropped
+        merged_upto = -1
+        for file_id in file_ids:
+            for _, kind, req_id, _, _, _, _, _ in self.read_records(file_id):
+                if kind == MERGED:
+                    merged_upto = max(merged_upto, req_id)
+                break
+
+        for file_id in [file_id for file_id in file_ids if file_id < merged_upto]:
+            os.remove(self.get_file(file_id))
+        file_ids = [file_id for file_id in file_ids if file_id >= merged_upto]
+
+        for file_id in file_ids:
+            valid_size = 0
+            f = open(self.get_file(file_id), 'rb')
+            for offset, kind, req_id, expire_at, key, value_offset, value_len, size in self.read_records(file_id):
+                valid_size = offset + size
+                self.total_bytes += size
+
+                if kind == PUT:
+                    if key in self.index:
+                        self.dead_bytes += self.get_record_size(key, self.index[key][2])
+                    self.index[key] = (file_id, value_offset, value_len, req_id)
+                    if expire_at > 0:
+                        self.expiry[key] = expire_at
+                    else:
+                        self.expiry.pop(key, None)
+
+                elif kind == DELETE:
+                    if key in self.index:
+                        self.dead_bytes += self.get_record_size(key, self.index[key][2])
+                        self.index.pop(key)
+                    self.expiry.pop(key, None)
+                    self.dead_bytes += size
+
+                elif kind == APPLIED:
+                    self.applied_index = req_id
+                    self.dead_bytes += size
+
+                elif kind == SESSION:
+                    # Only the latest record of a session is live, sessions that expired
+                    # before the restart are expired again by the next session command
+                    if key in self.sessions:
+                        self.dead_bytes += self.get_record_size(key, len(self.sessions[key][1].encode()))
+                    self.sessions[key] = (req_id, os.pread(f.fileno(), value_len, value_offset).decode(), expire_at)
+                    self.sessions.move_to_end(key)
+            f.close()
+
+            if file_id == file_ids[-1] and valid_size < os.path.getsize(self.get_file(file_id)):
+                # Torn write at the end of the last file
+                with open(self.get_file(file_id), 'rb+') as f:
+                    f.truncate(valid_size)
+
+        self.keys = SortedList(self.index.keys())
+
+        self.active_id = file_ids[-1] if len(file_ids) > 0 else 0
+        self.open_active()
+
+    def open_active(self):
+        self.active = open(self.get_file(self.active_id), 'ab+')
+        self.active_size = self.active.seek(0, os.SEEK_END)
+
+    def get_record_size(self, key, value_len):
+        return HEADER.size + len(key.encode()) + value_len
+
+    def write_record(self, kind, key='', value='', req_id=0, expire_at=0):
+        # Append a record to the active file and return (file_id, value offset, value length).
+        # A full file is rolled over before the write so that a merge never sees a record
+        # whose location is not in the index yet.
+        if self.active_size >= self.max_file_size:
+            self.roll_over()
+
+        key = key.encode()
+        value = value.encode()
+        body = HEADER.pack(0, kind, req_id, expire_at, len(key), len(value))[4:] + key + value
+        record = struct.pack('<I', zlib.crc32(body)) + body
+
+        self.active.write(record)
+        self.active.flush()
+        if self.sync:
+            os.fsync(self.active.fileno())
+
+        location = (self.active_id, self.active_size + HEADER.size + len(key), len(value))
+        self.active_size += len(record)
+        self.total_bytes += len(record)
+        return location
+
+    def roll_over(self):
+        self.active.close()
+        self.active_id += 1
+        self.open_active()
+
+        if self.dead_bytes > self.merge_ratio*self.total_bytes:
+            self.merge()
+
+    def read_value(self, file_id, offset, length):
+        if file_id == self.active_id:
+            return os.pread(self.active.fileno(), length, offset).decode()
+
+        if file_id not in self.maps:
+            with open(self.get_file(file_id), 'rb') as f:
+                self.maps[file_id] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.maps[file_id][offset:offset+length].decode()
+
+    def merge(self):
+        # Write the live values of all sealed files into a single file that takes the id of
+        # the newest sealed file. Deleted keys have no record left in the merged file, the
+        # MERGED record makes sure the older files are never read again after a crash.
+        sealed = [file_id for file_id in self.list_files() if file_id < self.active_id]
+        if len(sealed) == 0:
+            return
+
+        merged_id = sealed[-1]
+        tmp_file = self.get_file(merged_id) + '.merge'
+        moved = {}
+
+        with open(tmp_file, 'wb') as f:
+            position = 0
+            for kind, key, value, req_id, expire_at in \
+                    [(MERGED, '', '', merged_id, 0), (APPLIED, '', '', self.applied_index, 0)] + \
+                    [(SESSION, client_id, response, seq, now) for client_id, (seq, response, now) in self.sessions.items()] + \
+                    [(PUT, key, self.read_value(*location[:3]), location[3], self.expiry.get(key, 0))
+                     for key, location in self.index.items() if location[0] < self.active_id]:
+                key_bytes = key.encode()
+                value_bytes = value.encode()
+                body = HEADER.pack(0, kind, req_id, expire_at, len(key_bytes), len(value_bytes))[4:] + key_bytes + value_bytes
+                f.write(struct.pack('<I', zlib.crc32(body)) + body)
+
+                if kind == PUT:
+                    moved[key] = (merged_id, position + HEADER.size + len(key_bytes), len(value_bytes), req_id)
+                position += 4 + len(body)
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        for m in self.maps.values():
+            m.close()
+        self.maps = {}
+
+        os.replace(tmp_file, self.get_file(merged_id))
+        for file_id in sealed[:-1]:
+            os.remove(self.get_file(file_id))
+
+        self.index.update(moved)
+        self.total_bytes = position + self.active_size
+        self.dead_bytes = 0
+
+    def get_applied_index(self):
+        with self.lock:
+            return self.applied_index
+
+    def set_applied_index(self, index):
+        with self.lock:
+            if index != self.applied_index:
+                self.write_record(APPLIED, req_id=index)
+                self.dead_bytes += HEADER.size
+                self.applied_index = index
+
+    def get_copy(self):
+        with self.lock:
+            return dict([(key, (self.read_value(*location[:3]), location[3]))
+                         for key, location in self.index.items()])
+
+    def set_copy(self, cpy):
+        with self.lock:
+            for key in list(self.index.keys()):
+                if key not in cpy:
+                    self.write_record(DELETE, key=key, req_id=self.index.pop(key)[3])
+                    self.keys.remove(key)
+                    self.expiry.pop(key, None)
+
+            for key, (value, req_id) in cpy.items():
+                file_id, offset, length = self.write_record(PUT, key=key, value=value, req_id=req_id)
+                if key not in self.index:
+                    self.keys.add(key)
+                self.index[key] = (file_id, offset, length, req_id)
+                self.expiry.pop(key, None)
+
+            self.cache = ValueCache(self.cache.max_bytes)
+
+    def set(self, key, value, req_id, expire_at=None):
+        with self.lock:
+            if key not in self.index or self.index[key][3] < req_id:
+                if key in self.index:
+                    self.dead_bytes += self.get_record_size(key, self.index[key][2])
+                else:
+                    self.keys.add(key)
+
+                file_id, offset, length = self.write_record(PUT, key=key, value=value, req_id=req_id,
+                                                            expire_at=expire_at if expire_at else 0)
+                self.index[key] = (file_id, offset, length, req_id)
+                self.cache.put(key, value, length)
+
+                if expire_at:
+                    self.expiry[key] = expire_at
+                    if self.track_expiry:
+                        heapq.heappush(self.expiry_heap, (expire_at, key))
+                        # Keys set again with another TTL leave stale entries behind
+                        if len(self.expiry_heap) > 2*len(self.expiry) + 1024:
+                            self.rebuild_expiry_heap()
+                else:
+                    self.expiry.pop(key, None)
+                return 1
+            return -1
+
+    def get_value(self, key, now=None):
+        # Keys past their expiry time are not returned even if their delete is not applied yet
+        with self.lock:
+            if key in self.index:
+                if now is not None and key in self.expiry and self.expiry[key] <= now:
+                    return None
+
+                value = self.cache.get(key)
+                if value is None:
+                    value = self.read_value(*self.index[key][:3])
+                    self.cache.put(key, value, self.index[key][2])
+                return value
+            return None
+
+    def scan(self, start=None, end=None, prefix=None, after=None, limit=100, now=None):
+        # Return up to limit (key, value) pairs in key order (see hashtable.scan_keys) and
+        # whether there are more keys left, expired keys are skipped
+        items = []
+        with self.lock:
+            for key in scan_keys(self.keys, start, end, prefix, after):
+                if now is not None and key in self.expiry and self.expiry[key] <= now:
+                    continue
+                if len(items) == limit:
+                    return items, True
+
+                value = self.cache.get(key)
+                if value is None:
+                    value = self.read_value(*self.index[key][:3])
+                items += [(key, value)]
+        return items, False
+
+    def get_req_id(self, key):
+        with self.lock:
+            if key in self.index:
+                return self.index[key][3]
+            return -1
+
+    def delete(self, key, req_id):
+        with self.lock:
+            if key in self.index and self.index[key][3] <= req_id:
+                self.dead_bytes += self.get_record_size(key, self.index[key][2])
+                self.write_record(DELETE, key=key, req_id=req_id)
+                self.dead_bytes += self.get_record_size(key, 0)
+                self.index.pop(key)
+                self.keys.remove(key)
+                self.cache.discard(key)
+                self.expiry.pop(key, None)
+                return 1
+            return -1
+
+    def pop_expired(self, now, limit=1000):
+        # Return up to limit (key, req_id, expire_at) of keys that expired at or before now
+        # and remove them from the heap
+        expired = []
+        with self.lock:
+            while len(self.expiry_heap) > 0 and self.expiry_heap[0][0] <= now and len(expired) < limit:
+                expire_at, key = heapq.heappop(self.expiry_heap)
+                if self.expiry.get(key) == expire_at and key in self.index:
+                    expired += [(key, self.index[key][3], expire_at)]
+        return expired
+
+    def get_session(self, client_id):
+        with self.lock:
+            return self.sessions.get(client_id)
+
+    def set_session(self, client_id, seq, response, now):
+        with self.lock:
+            if client_id in self.sessions:
+                self.dead_bytes += self.get_record_size(client_id, len(self.sessions[client_id][1].encode()))
+            self.write_record(SESSION, key=client_id, value=response, req_id=seq, expire_at=now)
+            self.sessions[client_id] = (seq, response, now)
+            self.sessions.move_to_end(client_id)
+
+    def expire_sessions(self, before):
+        with self.lock:
+            while len(self.sessions) > 0 and next(iter(self.sessions.values()))[2] < before:
+                client_id, (_, response, _) = self.sessions.popitem(last=False)
+                self.dead_bytes += self.get_record_size(client_id, len(response.encode()))
+
+    def set_expiry_tracking(self, enabled):
+        # Only the leader pops expired keys, other nodes keep no heap so that it does not grow
+        # with every TTL write they apply. The heap is rebuilt from expiry once this node
+        # becomes leader.
+        with self.lock:
+            if enabled and not self.track_expiry:
+                self.rebuild_expiry_heap()
+            elif not enabled:
+                self.expiry_heap = []
+            self.track_expiry = enabled
+
+    def rebuild_expiry_heap(self):
+        self.expiry_heap = [(expire_at, key) for key, expire_at in self.expiry.items()]
+        heapq.heapify(self.expiry_heap)
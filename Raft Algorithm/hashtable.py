@@ -1,42 +1,159 @@
-from threading import Lock
-from copy import deepcopy
-
-
-class HashTable:
-    def __init__(self):
-        self.map = {}
-        self.lock = Lock()
-
-    def get_copy(self):
-        with self.lock:
-            return deepcopy(self.map)
-
-    def set_copy(self, cpy):
-        with self.lock:
-            self.map = cpy
-
-    def set(self, key, value, req_id):
-        with self.lock:
-            if key not in self.map or self.map[key][1] < req_id:
-                self.map[key] = (value, req_id)
-                return 1
-            return -1
-
-    def get_value(self, key):
-        with self.lock:
-            if key in self.map:
-                return self.map[key][0]
-            return None
-
-    def get_req_id(self, key):
-        with self.lock:
-            if key in self.map:
-                return self.map[key][1]
-            return -1
-
-    def delete(self, key, req_id):
-        with self.lock:
-            if key in self.map and self.map[key][1] <= req_id:
-                self.map.pop(key)
-                return 1
-            return -1
\ No newline at end of file
+from collections import OrderedDict
+from threading import Lock
+from copy import deepcopy
+import heapq
+from sortedcontainers import SortedList
+
+
+def scan_keys(keys, start=None, end=None, prefix=None, after=None):
+    # Iterate over the keys of a SortedList in order with start <= key < end, starting
+    # with prefix and greater than after (the last key of the previous page)
+    lower = max([k for k in (start, prefix) if k is not None], default=None)
+    inclusive = True
+    if after is not None and (lower is None or after >= lower):
+        lower = after
+        inclusive = False
+
+    for key in keys.irange(minimum=lower, maximum=end, inclusive=(inclusive, False)):
+        if prefix is not None and not key.startswith(prefix):
+            break
+        yield key
+
+
+class HashTable:
+    def __init__(self):
+        self.map = {}
+        self.lock = Lock()
+
+        # Keys of the map in sorted order for range scans, kept up to date on every change
+        self.keys = SortedList()
+
+        # Expiry time in ms for keys set with a TTL, and a heap of (expire_at, key) ordered
+        # by expiry time so that finding expired keys never scans the whole map. Heap entries
+        # whose expire_at no longer matches self.expiry are stale and skipped. The heap is only
+        # kept while track_expiry is set (see set_expiry_tracking).
+        self.expiry = {}
+        self.expiry_heap = []
+        self.track_expiry = False
+
+        # Index of the last log entry applied, nothing survives a restart so the whole
+        # log is applied again
+        self.applied_index = -1
+        # Log entries before the applied index must not be compacted away
+        self.durable = False
+
+        # client_id -> (last sequence number, response, time of the last command in ms) of
+        # every client session, in order of last activity
+        self.sessions = OrderedDict()
+
+    def get_applied_index(self):
+        return self.applied_index
+
+    def set_applied_index(self, index):
+        self.applied_index = index
+
+    def get_copy(self):
+        with self.lock:
+            return deepcopy(self.map)
+
+    def set_copy(self, cpy):
+        with self.lock:
+            self.map = cpy
+            self.keys = SortedList(cpy.keys())
+
+    def set(self, key, value, req_id, expire_at=None):
+        with self.lock:
+            if key not in self.map or self.map[key][1] < req_id:
+                if key not in self.map:
+                    self.keys.add(key)
+                self.map[key] = (value, req_id)
+
+                if expire_at:
+                    self.expiry[key] = expire_at
+                    if self.track_expiry:
+                        heapq.heappush(self.expiry_heap, (expire_at, key))
+                        # Keys set again with another TTL leave stale entries behind
+                        if len(self.expiry_heap) > 2*len(self.expiry) + 1024:
+                            self.rebuild_expiry_heap()
+                else:
+                    self.expiry.pop(key, None)
+                return 1
+            return -1
+
+    def get_value(self, key, now=None):
+        # Keys past their expiry time are not returned even if their delete is not applied yet
+        with self.lock:
+            if key in self.map:
+                if now is not None and key in self.expiry and self.expiry[key] <= now:
+                    return None
+                return self.map[key][0]
+            return None
+
+    def scan(self, start=None, end=None, prefix=None, after=None, limit=100, now=None):
+        # Return up to limit (key, value) pairs in key order (see scan_keys) and whether
+        # there are more keys left, expired keys are skipped
+        items = []
+        with self.lock:
+            for key in scan_keys(self.keys, start, end, prefix, after):
+                if now is not None and key in self.expiry and self.expiry[key] <= now:
+                    continue
+                if len(items) == limit:
+                    return items, True
+                items += [(key, self.map[key][0])]
+        return items, False
+
+    def get_req_id(self, key):
+        with self.lock:
+            if key in self.map:
+                return self.map[key][1]
+            return -1
+
+    def delete(self, key, req_id):
+        with self.lock:
+            if key in self.map and self.map[key][1] <= req_id:
+                self.map.pop(key)
+                self.keys.remove(key)
+                self.expiry.pop(key, None)
+                return 1
+            return -1
+
+    def pop_expired(self, now, limit=1000):
+        # Return up to limit (key, req_id, expire_at) of keys that expired at or before now
+        # and remove them from the heap
+        expired = []
+        with self.lock:
+            while len(self.expiry_heap) > 0 and self.expiry_heap[0][0] <= now and len(expired) < limit:
+                expire_at, key = heapq.heappop(self.expiry_heap)
+                if self.expiry.get(key) == expire_at and key in self.map:
+                    expired += [(key, self.map[key][1], expire_at)]
+        return expired
+
+    def get_session(self, client_id):
+        with self.lock:
+            return self.sessions.get(client_id)
+
+    def set_session(self, client_id, seq, response, now):
+        with self.lock:
+            self.sessions[client_id] = (seq, response, now)
+            self.sessions.move_to_end(client_id)
+
+    def expire_sessions(self, before):
+        # Drop sessions whose last command is older than before
+        with self.lock:
+            while len(self.sessions) > 0 and next(iter(self.sessions.values()))[2] < before:
+                self.sessions.popitem(last=False)
+
+    def set_expiry_tracking(self, enabled):
+        # Only the leader pops expired keys, other nodes keep no heap so that it does not grow
+        # with every TTL write they apply. The heap is rebuilt from expiry once this node
+        # becomes leader.
+        with self.lock:
+            if enabled and not self.track_expiry:
+                self.rebuild_expiry_heap()
+            elif not enabled:
+                self.expiry_heap = []
+            self.track_expiry = enabled
+
+    def rebuild_expiry_heap(self):
+        self.expiry_heap = [(expire_at, key) for key, expire_at in self.expiry.items()]
+        heapq.heapify(self.expiry_heap)
@@ -0,0 +1,328 @@
+import argparse
+import bisect
+import json
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from queue import Queue
+from threading import Lock
+import utils
+
+
+class LatencyHistogram:
+    # HDR style histogram, values are recorded in microseconds into buckets whose
+    # width grows with the magnitude of the value so that the relative error stays
+    # below 1/sub_buckets over the whole range.
+    def __init__(self, sub_buckets=128):
+        self.sub_buckets = sub_buckets
+        self.counts = {}
+        self.total = 0
+        self.max = 0
+
+    def get_bucket(self, value):
+        if value < self.sub_buckets:
+            return (0, value)
+        exponent = value.bit_length() - self.sub_buckets.bit_length() + 1
+        return (exponent, value >> exponent)
+
+    def get_bucket_value(self, bucket):
+        # Highest value that falls in the bucket
+        exponent, sub_bucket = bucket
+        return ((sub_bucket+1) << exponent) - 1
+
+    def record(self, seconds):
+        value = max(0, int(seconds*1000000))
+        bucket = self.get_bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        # Value in milliseconds below which p percent of the recorded values fall
+        if self.total == 0:
+            return 0.0
+        rank = max(1, int(math.ceil(p/100.0*self.total)))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self.get_bucket_value(bucket), self.max)/1000.0
+        return self.max/1000.0
+
+    def to_dict(self):
+        return {'counts': [[e, s, c] for (e, s), c in self.counts.items()],
+                'total': self.total, 'max': self.max}
+
+    @staticmethod
+    def from_dict(d):
+        h = LatencyHistogram()
+        h.counts = dict([((e, s), c) for e, s, c in d['counts']])
+        h.total = d['total']
+        h.max = d['max']
+        return h
+
+
+class KeyChooser:
+    def __init__(self, keys, distribution='uniform', zipf_s=0.99, seed=0):
+        self.keys = keys
+        self.rand = random.Random(seed)
+        self.cdf = None
+
+        if distribution == 'zipf':
+            # Rank k is chosen with probability proportional to 1/k^s
+            weights = [1.0/math.pow(k, zipf_s) for k in range(1, keys+1)]
+            total = sum(weights)
+            self.cdf = []
+            acc = 0.0
+            for w in weights:
+                acc += w/total
+                self.cdf += [acc]
+
+    def next_key(self):
+        if self.cdf is None:
+            return f"key{self.rand.randint(0, self.keys-1)}"
+        i = bisect.bisect_left(self.cdf, self.rand.random())
+        return f"key{min(i, self.keys-1)}"
+
+
+class Worker:
+    # Open loop load: requests are scheduled on a Poisson process and handed to a pool
+    # of sender threads. Latency is measured from the scheduled time, not from the time
+    # a sender picked the request up, so queueing delay is not hidden when the nodes
+    # fall behind (coordinated omission).
+    def __init__(self, worker_id, args):
+        self.worker_id = worker_id
+        self.args = args
+        self.partitions = eval(args.partitions)
+        self.rand = random.Random(args.seed + worker_id)
+        self.keys = KeyChooser(args.keys, args.distribution, args.zipf_s, seed=args.seed + worker_id)
+        self.value = 'v'*args.value_size
+        self.requests = Queue()
+        self.lock = Lock()
+        self.histograms = {'SET': LatencyHistogram(), 'GET': LatencyHistogram()}
+        self.errors = 0
+        # Commands the nodes rejected with BUSY, not retried so that the offered load stays
+        # at the target rate
+        self.busy = 0
+        self.req_id = 0
+
+    def next_command(self):
+        key = self.keys.next_key()
+        # Request ids only have to increase per key, interleave them across workers
+        self.req_id += 1
+        req_id = self.req_id*self.args.workers + self.worker_id
+
+        if self.rand.random() < self.args.read_ratio:
+            return 'GET', f"GET {key} {req_id}"
+        return 'SET', f"SET {key} {self.value} {req_id}"
+
+    def pick_server(self):
+        # Same as client.py, any node of any partition accepts any key
+        i = self.rand.randint(0, len(self.partitions)-1)
+        j = self.rand.randint(0, len(self.partitions[i])-1)
+        ip, port = self.partitions[i][j].split(':')
+        return ip, int(port)
+
+    def sender(self):
+        conns = {}
+        while True:
+            item = self.requests.get(block=True)
+            if item is None:
+                break
+
+            scheduled, kind, command, server = item
+            resp = None
+
+            try:
+                if server not in conns:
+                    conns[server] = socket.create_connection(server, timeout=self.args.timeout)
+                conn = conns[server]
+                # The trailing newline frames the command for multiraft.py hosts, raft.py
+                # nodes ignore it
+                conn.sendall((command + '\n').encode())
+                resp = conn.recv(2048).decode().strip()
+            except Exception as e:
+                conn = conns.pop(server, None)
+                if conn:
+                    conn.close()
+
+            latency = time.time() - scheduled
+            busy = resp is not None and resp.startswith('BUSY')
+            ok = resp == 'ok' if kind == 'SET' else resp is not None and len(resp) > 0 and resp != 'ko' and not busy
+
+            with self.lock:
+                if busy:
+                    self.busy += 1
+                elif ok:
+                    self.histograms[kind].record(latency)
+                else:
+                    self.errors += 1
+
+        for conn in conns.values():
+            conn.close()
+
+    def run(self, start, results):
+        senders = [utils.run_thread(fn=self.sender, args=()) for _ in range(self.args.connections)]
+        rate = self.args.rate/float(self.args.workers)
+        end = start + self.args.duration
+
+        while time.time() < start:
+            time.sleep(0.001)
+
+        scheduled = start
+        sent = 0
+        while True:
+            scheduled += self.rand.expovariate(rate)
+            if scheduled >= end:
+                break
+
+            delay = scheduled - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            kind, command = self.next_command()
+            self.requests.put((scheduled, kind, command, self.pick_server()))
+            sent += 1
+
+        for _ in senders:
+            self.requests.put(None)
+        for t in senders:
+            t.join()
+
+        results.put({'worker': self.worker_id, 'sent': sent, 'errors': self.errors, 'busy': self.busy,
+                     'SET': self.histograms['SET'].to_dict(), 'GET': self.histograms['GET'].to_dict()})
+
+
+def run_worker(worker_id, args, start, results):
+    Worker(worker_id, args).run(start, results)
+
+
+def start_nodes(partitions, log_dir):
+    # Start one raft.py process per node in the partitions config, commit logs go to log_dir
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'raft.py')
+    procs = []
+    for cluster in eval(partitions):
+        for addr in cluster:
+            ip, port = addr.split(':')
+            procs += [subprocess.Popen([sys.executable, script, ip, port, partitions], cwd=log_dir,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)]
+    return procs
+
+
+def wait_for_cluster(partitions, timeout):
+    # Every partition is ready once its first node can answer a GET, which needs a leader
+    end = time.time() + timeout
+    for i, cluster in enumerate(eval(partitions)):
+        ip, port = cluster[0].split(':')
+        while time.time() < end:
+            try:
+                conn = socket.create_connection((ip, int(port)), timeout=1.0)
+                conn.settimeout(timeout)
+                conn.sendall(f"GET loadgen-ready-{i} 0\n".encode())
+                resp = conn.recv(2048).decode().strip()
+                conn.close()
+                if resp != 'ko':
+                    break
+            except Exception as e:
+                pass
+            time.sleep(0.5)
+        else:
+            return False
+    return True
+
+
+def report(kind, histogram, duration):
+    print(f"{kind}: {histogram.total} ops, {histogram.total/duration:.2f} ops/sec")
+    print(f"  {'percentile':>10} {'latency_ms':>12}")
+    for p in (50, 75, 90, 99, 99.9, 99.99, 100):
+        print(f"  {p:>10} {histogram.percentile(p):>12.3f}")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Open loop load generator for Raft nodes over real sockets')
+    parser.add_argument('partitions', help="partitions config, same format as raft.py and client.py")
+    parser.add_argument('--rate', type=float, default=100.0, help='target requests per second over all workers')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds')
+    parser.add_argument('--workers', type=int, default=4, help='number of load generating processes')
+    parser.add_argument('--connections', type=int, default=16, help='sender threads per worker')
+    parser.add_argument('--keys', type=int, default=10000)
+    parser.add_argument('--distribution', choices=['uniform', 'zipf'], default='uniform')
+    parser.add_argument('--zipf-s', type=float, default=0.99)
+    parser.add_argument('--value-size', type=int, default=8)
+    parser.add_argument('--read-ratio', type=float, default=0.5)
+    parser.add_argument('--timeout', type=float, default=10.0, help='socket timeout in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--start-nodes', action='store_true', help='start local raft.py processes for the config')
+    parser.add_argument('--startup-timeout', type=float, default=120.0)
+    parser.add_argument('--output', default=None, help='write results as JSON to this file')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    procs = []
+    log_dir = None
+
+    if args.start_nodes:
+        log_dir = tempfile.mkdtemp(prefix='raft-loadgen-')
+        procs = start_nodes(args.partitions, log_dir)
+        print(f"Started {len(procs)} nodes, commit logs in {log_dir} until the run ends")
+
+    try:
+        if not wait_for_cluster(args.partitions, args.startup_timeout):
+            print("Cluster did not become ready")
+            sys.exit(1)
+
+        results = multiprocessing.Queue()
+        start = time.time() + 1.0
+        workers = [multiprocessing.Process(target=run_worker, args=(i, args, start, results))
+                   for i in range(args.workers)]
+        for w in workers:
+            w.start()
+
+        outputs = [results.get(block=True) for _ in workers]
+        for w in workers:
+            w.join()
+
+        histograms = {'SET': LatencyHistogram(), 'GET': LatencyHistogram()}
+        for output in outputs:
+            for kind in histograms:
+                histograms[kind].merge(LatencyHistogram.from_dict(output[kind]))
+
+        sent = sum([output['sent'] for output in outputs])
+        errors = sum([output['errors'] for output in outputs])
+        busy = sum([output['busy'] for output in outputs])
+        print(f"Target rate {args.rate:.2f}/sec, sent {sent}, errors {errors}, busy {busy}")
+        for kind in histograms:
+            report(kind, histograms[kind], args.duration)
+
+        if args.output:
+            summary = {'config': vars(args), 'sent': sent, 'errors': errors, 'busy': busy}
+            for kind, h in histograms.items():
+                summary[kind] = {'ops': h.total, 'ops_per_sec': round(h.total/args.duration, 2),
+                                 'percentiles_ms': dict([(str(p), h.percentile(p))
+                                                         for p in (50, 75, 90, 99, 99.9, 99.99, 100)]),
+                                 'histogram': h.to_dict()}
+            with open(args.output, 'w') as f:
+                json.dump(summary, f, indent=2)
+
+    finally:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            p.wait()
+        if log_dir:
+            shutil.rmtree(log_dir, ignore_errors=True)
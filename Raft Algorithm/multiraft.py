@@ -0,0 +1,294 @@
+import math
+import os
+import re
+import socket
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+import mmh3
+from commit_log import BatchedLogWriter
+from disk_hashtable import DiskHashTable
+from raft import Raft
+from timeouts import DEFAULT_TIMEOUTS
+from compression import DEFAULT_COMPRESSION
+from read_cache import DEFAULT_READ_CACHE
+from admission import DEFAULT_ADMISSION, AdmissionControl
+from tracing import DEFAULT_TRACING, Tracer, SamplingProfiler
+from transport import Connection, HostTransport
+import utils
+
+
+class TimerWheel:
+    # Hashed timing wheel shared by all groups of a host. One thread advances the wheel
+    # every tick_ms and runs the callbacks that are due, callbacks must not block.
+    def __init__(self, tick_ms=10, slots=512):
+        self.tick_ms = tick_ms
+        self.slots = [[] for _ in range(slots)]
+        self.cursor = 0
+        self.lock = Lock()
+        utils.run_thread(fn=self.run, args=())
+
+    def schedule(self, delay_ms, fn, args=()):
+        ticks = max(1, int(math.ceil(delay_ms/float(self.tick_ms))))
+        with self.lock:
+            slot = (self.cursor + ticks) % len(self.slots)
+            rounds = (ticks-1) // len(self.slots)
+            self.slots[slot].append([rounds, fn, args])
+
+    def run(self):
+        next_tick = time.time()
+        while True:
+            next_tick += self.tick_ms/1000.0
+            delay = next_tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            with self.lock:
+                self.cursor = (self.cursor + 1) % len(self.slots)
+                timers = self.slots[self.cursor]
+                due = [timer for timer in timers if timer[0] == 0]
+                self.slots[self.cursor] = [[timer[0]-1, timer[1], timer[2]] for timer in timers if timer[0] > 0]
+
+            for _, fn, args in due:
+                try:
+                    fn(*args)
+                except Exception as e:
+                    traceback.print_exc(limit=1000)
+
+
+class MultiRaftHost:
+    # Hosts the replicas of every partition that lists this host's address. All groups
+    # share one listener, one connection pool, one timer wheel, one batched log writer and
+    # one worker pool; election checks and leader replication of each group run as
+    # ticks on the worker pool instead of in two dedicated threads per group, and so do
+    # the applies of committed entries and the messages of a BATCH. With
+    # disk_data=True every group keeps its key value data in a DiskHashTable under its
+    # own directory instead of in memory. config holds the timing, compression, read cache,
+    # admission control and tracing settings of all groups (see timeouts.py, compression.py,
+    # read_cache.py, admission.py and tracing.py), admission control, the tracer and the
+    # profiler are shared by all groups.
+    def __init__(self, ip, port, partitions, log_dir='.', workers=32, tick_ms=10, sync=False,
+                 disk_data=False, config=None):
+        self.ip = ip
+        self.port = port
+        self.partitions = eval(partitions)
+        self.tick_ms = tick_ms
+        self.transport = HostTransport()
+        self.log_writer = BatchedLogWriter(sync=sync)
+        self.timers = TimerWheel(tick_ms=tick_ms)
+        # A client command in a BATCH keeps its worker until its entry is applied, at most
+        # max_client_requests of them are admitted at a time. The pool has room for those
+        # on top of workers, so ticks and applies always find a free worker.
+        admission = dict(DEFAULT_ADMISSION, **(config if config else {}))
+        self.workers = ThreadPoolExecutor(max_workers=workers + admission['max_client_requests'])
+        self.groups = {}
+        self.running = set()
+        # Groups with an apply on the worker pool, and those of them that have to apply
+        # again because more entries were committed while it ran
+        self.applying = set()
+        self.apply_pending = set()
+        self.lock = Lock()
+        self.admission = AdmissionControl(admission)
+        self.tracer = Tracer(dict(DEFAULT_TRACING, **(config if config else {})), f"{ip}:{port}",
+                             os.path.join(log_dir, f"trace-{ip}-{port}.jsonl"))
+        self.profiler = SamplingProfiler(os.path.join(log_dir, f"profile-{ip}-{port}.txt"))
+
+        for i in range(len(self.partitions)):
+            if f"{ip}:{port}" in self.partitions[i]:
+                group_dir = os.path.join(log_dir, f"partition-{i}")
+                os.makedirs(group_dir, exist_ok=True)
+                state_machine = DiskHashTable(os.path.join(group_dir, 'data'), sync=sync) if disk_data else None
+                self.groups[i] = Raft(ip=ip, port=port, partitions=partitions,
+                                      transport=self.transport.for_group(i), log_dir=group_dir,
+                                      cluster_index=i, log_writer=self.log_writer,
+                                      state_machine=state_machine, config=config, tracer=self.tracer,
+                                      profiler=self.profiler, applier=lambda i=i: self.schedule_apply(i))
+
+        print(f"Hosting partitions {sorted(self.groups.keys())}")
+
+    def init(self):
+        for i in self.groups:
+            self.groups[i].set_election_timeout()
+            self.schedule_tick(i)
+
+    def schedule_tick(self, i):
+        self.timers.schedule(self.tick_ms, self.on_tick, (i,))
+
+    def on_tick(self, i):
+        # Runs on the timer wheel thread, hand the work over to the worker pool. A group
+        # whose previous tick is still running (e.g. waiting for a majority) is skipped.
+        with self.lock:
+            if i in self.running:
+                self.schedule_tick(i)
+                return
+            self.running.add(i)
+
+        self.workers.submit(self.tick, i)
+
+    def schedule_apply(self, i):
+        # Applies of a group run on the worker pool one at a time, which keeps them in log
+        # order without holding a worker that waits for the previous apply
+        with self.lock:
+            if i in self.applying:
+                self.apply_pending.add(i)
+                return
+            self.applying.add(i)
+
+        self.workers.submit(self.apply, i)
+
+    def apply(self, i):
+        while True:
+            try:
+                self.groups[i].apply_committed()
+            except Exception as e:
+                traceback.print_exc(limit=1000)
+
+            with self.lock:
+                if i not in self.apply_pending:
+                    self.applying.discard(i)
+                    return
+                self.apply_pending.discard(i)
+
+    def tick(self, i):
+        try:
+            self.groups[i].election_tick()
+            self.groups[i].leader_tick()
+            self.groups[i].expiry_tick()
+        except Exception as e:
+            traceback.print_exc(limit=1000)
+        finally:
+            with self.lock:
+                self.running.discard(i)
+            self.schedule_tick(i)
+
+    def route(self, msg):
+        # Peer RPCs are prefixed with the group they belong to. Client commands are routed
+        # by the partition of their key, same as handle_commands, any local group can
+        # forward keys of partitions not hosted here.
+        group = None
+        group_msg = re.match('^GROUP ([0-9]+) (.*)$', msg, re.S)
+        if group_msg:
+            group, msg = group_msg.groups()
+            group = int(group)
+
+            # Commands forwarded by another host as part of a traced command
+            if msg.startswith('TRACE '):
+                return self.tracer.handle(msg, lambda msg: self.route(f"GROUP {group} {msg}"))
+
+        client_cmd = re.match('^(SET|GET|DEL) ([^\s]+)', msg)
+        if client_cmd:
+            node = mmh3.hash(client_cmd.group(2), signed=False) % len(self.partitions)
+            group = node if node in self.groups else sorted(self.groups.keys())[0]
+
+        # SCAN fans out from any local group
+        if msg.startswith('SCAN '):
+            group = sorted(self.groups.keys())[0]
+
+        # Per partition scans and WATCH streams name their partition
+        scan_part = re.match('^(?:SCAN-PART|WATCH) ([0-9]+)( |$)', msg)
+        if scan_part:
+            node = int(scan_part.group(1))
+            group = node if node in self.groups else sorted(self.groups.keys())[0]
+
+        # Admin commands name their partition and are served by the local replica only
+        admin_cmd = re.match('^(TRANSFER|STATUS) ([0-9]+)', msg)
+        if admin_cmd:
+            group = int(admin_cmd.group(2))
+
+        # Moves leadership of every group off this host, e.g. before maintenance
+        if msg in ('DRAIN', 'RESUME'):
+            return self.handle_all_groups(msg)
+
+        # Tracing and profiling are per process, any local group handles them
+        if re.match('^(TRACING|PROFILE) ', msg):
+            group = sorted(self.groups.keys())[0]
+
+        if group not in self.groups:
+            return "Error: Unknown partition"
+
+        return self.groups[group].handle_commands(msg, None)
+
+    def handle_all_groups(self, msg):
+        # Leadership transfers of the groups run in parallel on the worker pool
+        results = [self.workers.submit(self.handle_group, i, msg) for i in self.groups]
+        return 'ok' if all([res.result() == 'ok' for res in results]) else 'ko'
+
+    def handle_group(self, i, msg):
+        output = None
+        try:
+            output = self.groups[i].handle_commands(msg, None)
+        except Exception as e:
+            traceback.print_exc(limit=1000)
+        return output
+
+    def handle_batch(self, msgs, addr):
+        # Handle the messages of a batch in parallel on the worker pool so that one slow
+        # message does not delay the replies of the other groups. Every message is admitted
+        # on its own, a client command forwarded by another host is limited like one sent
+        # directly.
+        results = [self.workers.submit(self.handle_one, msg, addr) for msg in msgs]
+        return [res.result() for res in results]
+
+    def handle_one(self, msg, addr):
+        output = None
+        try:
+            output = self.admission.handle(msg, addr, self.route)
+        except Exception as e:
+            traceback.print_exc(limit=1000)
+        return output if output else ''
+
+    def process_request(self, conn, addr):
+        while True:
+            try:
+                msg = conn.recv()
+                if msg is None:
+                    conn.close()
+                    break
+
+                if msg.startswith('BATCH\t'):
+                    output = 'BATCH\t' + '\t'.join(self.handle_batch(msg.split('\t')[1:], addr))
+                else:
+                    output = self.tracer.handle(msg, lambda msg: self.admission.handle(msg, addr, self.route))
+
+                conn.send(output if output else 'ko')
+
+            except Exception as e:
+                traceback.print_exc(limit=1000)
+                conn.close()
+                break
+
+    def listen_to_clients(self):
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind(('0.0.0.0', int(self.port)))
+        server_socket.listen(50)
+
+        print(f"Multi-Raft host listening on {self.ip}:{self.port}")
+
+        while True:
+            try:
+                client_socket, client_address = server_socket.accept()
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                client_thread = Thread(target=self.process_request, args=(Connection(client_socket), client_address[0]))
+                client_thread.daemon = True
+                client_thread.start()
+
+            except Exception as e:
+                print(f"Error accepting connection: {e}")
+                continue
+
+
+if __name__ == '__main__':
+    ip_address = str(sys.argv[1])
+    port = int(sys.argv[2])
+    partitions = str(sys.argv[3])
+
+    config = utils.parse_config_args(sys.argv[4:], dict(DEFAULT_TIMEOUTS, **DEFAULT_COMPRESSION,
+                                                        **DEFAULT_READ_CACHE, **DEFAULT_ADMISSION,
+                                                        **DEFAULT_TRACING))
+    host = MultiRaftHost(ip=ip_address, port=port, partitions=partitions,
+                         disk_data='--disk-data' in sys.argv[4:], config=config)
+    host.init()
+    host.listen_to_clients()
@@ -1,662 +1,1676 @@
-from random import randint, random
-import sys
-import os
-import re
-import socket
-import select
-from hashtable import HashTable
-from threading import Thread, Lock
-import mmh3
-import time
-from queue import Queue
-from random import shuffle
-from commit_log import CommitLog
-import tqdm
-from pathlib import Path
-from consistent_hashing import ConsistentHashing
-import shutil
-import utils
-import traceback
-from queue import Queue
-
-class Raft:
-    def __init__(self, ip, port, partitions):
-        self.ip = ip
-        self.port = port
-        self.ht = HashTable()
-        self.commit_log = CommitLog(file=f"commit-log-{self.ip}-{self.port}.txt")
-        self.partitions = eval(partitions)
-        self.conns = [[None]*len(self.partitions[i]) for i in range(len(self.partitions))]
-        self.cluster_index = -1
-        self.server_index = -1
-
-        # Initialize commit log file
-        commit_logfile = Path(self.commit_log.file)
-        commit_logfile.touch(exist_ok=True)
-
-        for i in range(len(self.partitions)):
-            cluster = self.partitions[i]
-
-            for j in range(len(cluster)):
-                ip, port = cluster[j].split(':')
-                port = int(port)
-
-                if (ip, port) == (self.ip, self.port):
-                    self.cluster_index = i
-                    self.server_index = j
-
-                else:
-                    self.conns[i][j] = (ip, port)
-
-        self.current_term = 1
-        self.voted_for = -1
-        self.votes = set()
-
-        u = len(self.partitions[self.cluster_index])
-
-        self.state = 'FOLLOWER' if len(self.partitions[self.cluster_index]) > 1 else 'LEADER'
-        self.leader_id = -1
-        self.commit_index = 0
-        self.next_indices = [0]*u
-        self.match_indices = [-1]*u
-        self.election_period_ms = randint(5000, 10000)  # Randomized election timeout between 5-10 seconds
-        self.rpc_period_ms = 3000
-        self.election_timeout = -1
-        self.rpc_timeout = [-1]*u
-        self.lease_duration = 5000  # Fixed lease duration of 5 seconds
-        self.old_leader_lease_timeout = -1  # To track the maximum old leader lease timeout
-
-        print("Ready...")
-
-    def init(self):
-        # set initial election timeout
-        self.set_election_timeout()
-
-        # Check for election timeout in the background
-        utils.run_thread(fn=self.on_election_timeout, args=())
-
-        # Sync logs or send heartbeats from leader to all servers in the background
-        utils.run_thread(fn=self.leader_send_append_entries, args=())
-
-    def set_election_timeout(self, timeout=None):
-        # Reset this whenever previous timeout expires and starts a new election
-        if timeout:
-            self.election_timeout = timeout
-        else:
-            self.election_timeout = time.time() + randint(self.election_period_ms,
-                                                          2*self.election_period_ms)/1000.0
-
-    def on_election_timeout(self):
-        while True:
-            # Check everytime that state is either FOLLOWER or CANDIDATE before sending
-            # vote requests.
-
-            # The possibilities in this path are:
-            # 1. Requestor sends requests, receives replies and becomes leader
-            # 2. Requestor sends requests, receives replies and becomes follower again, repeat on election timeout
-            if time.time() > self.election_timeout and \
-                    (self.state == 'FOLLOWER' or self.state == 'CANDIDATE'):
-
-                print(f"Node {self.server_index} election timer timed out, Starting election.")
-                self.set_election_timeout()
-                self.start_election()
-
-    def start_election(self):
-        print("Starting election...")
-
-        # At the start of election, set state to CANDIDATE and increment term
-        # also vote for self.
-        self.state = 'CANDIDATE'
-        self.voted_for = self.server_index
-        self.current_term += 1
-        self.votes.add(self.server_index)
-        self.old_leader_lease_timeout = -1  # Reset the old leader lease timeout
-
-        # Send vote requests in parallel
-        threads = []
-        for j in range(len(self.partitions[self.cluster_index])):
-            if j != self.server_index:
-                t = utils.run_thread(fn=self.request_vote, args=(j,))
-                threads += [t]
-
-        # Wait for completion of request flow
-        for t in threads:
-            t.join()
-
-        return True
-
-    def request_vote(self, server):
-        # Get last index and term from commit log
-        last_index, last_term = self.commit_log.get_last_index_term()
-
-        while True:
-            # Retry on timeout
-            print(f"Requesting vote from {server}...")
-
-            # Check if state if still CANDIDATE
-            if self.state == 'CANDIDATE' and time.time() < self.election_timeout:
-                ip, port = self.conns[self.cluster_index][server]
-                msg = f"VOTE-REQ {self.server_index} {self.current_term} {last_term} {last_index}"
-
-                resp = \
-                    utils.send_and_recv_no_retry(msg, ip, port,
-                                                 timeout=self.rpc_period_ms/1000.0)
-
-                # If timeout happens resp returns None, so it won't go inside this condition
-                if resp:
-                    vote_rep = re.match(
-                        '^VOTE-REP ([0-9]+) ([0-9\-]+) ([0-9\-]+) ([0-9\-]+)$', resp)
-
-                    if vote_rep:
-                        server, curr_term, voted_for, old_leader_lease_timeout = vote_rep.groups()
-
-                        server = int(server)
-                        curr_term = int(curr_term)
-                        voted_for = int(voted_for)
-                        old_leader_lease_timeout = int(old_leader_lease_timeout)
-
-                        self.process_vote_reply(
-                            server, curr_term, voted_for, old_leader_lease_timeout)
-                        break
-            else:
-                break
-
-    def process_vote_request(self, server, term, last_term, last_index):
-        print(f"Processing vote request from {server} {term}...")
-
-        if term > self.current_term:
-            # Requestor term is higher hence update
-            self.step_down(term)
-
-        # Get last index and term from log
-        self_last_index, self_last_term = self.commit_log.get_last_index_term()
-
-        # Vote for requestor only if requestor term is equal to self term
-        # and self has either voted for no one yet or has voted for same requestor (can happen during failure/timeout and retry)
-        # and either both requestor and self have empty logs (starting up)
-        # or the last term of requestor is greater
-        # or if they are equal then the last index of requestor should be greater.
-        # This is to ensure that only vote for all requestors who have updated logs.
-        if term == self.current_term \
-            and (self.voted_for == server or self.voted_for == -1) \
-            and (last_term > self_last_term or
-                 (last_term == self_last_term and last_index >= self_last_index)):
-
-            self.voted_for = server
-            self.state = 'FOLLOWER'
-            self.set_election_timeout()
-
-            if self.state == 'FOLLOWER':
-                print(
-                    f"Vote granted for Node {server} in term {self.current_term}.")
-
-        else:
-            print(f"Vote denied for Node {server} in term {self.current_term}.")
-
-        return f"VOTE-REP {self.server_index} {self.current_term} {self.voted_for} {self.old_leader_lease_timeout}"
-
-    def process_vote_reply(self, server, term, voted_for, old_leader_lease_timeout):
-        print(f"Processing vote reply from {server} {term}...")
-
-        # It is not possible to have term < self.current_term because during vote request
-        # the server will update its term to match requestor term if requestor term is higher
-        if term > self.current_term:
-            # Requestor term is lower hence update
-            self.step_down(term)
-
-        if term == self.current_term and self.state == 'CANDIDATE':
-            if voted_for == self.server_index:
-                self.votes.add(server)
-
-                # Keep track of the maximum old leader lease timeout received from voters
-                self.old_leader_lease_timeout = max(
-                    self.old_leader_lease_timeout, old_leader_lease_timeout)
-
-            # Convert to leader if received votes from majority
-            if len(self.votes) > len(self.partitions[self.cluster_index])/2.0:
-                self.state = 'LEADER'
-                self.leader_id = self.server_index
-
-                print(
-                    f"Node {self.server_index} became the leader for term {self.current_term}.")
-                print(f"{self.votes}-{self.current_term}")
-
-                # Wait for the maximum of the old leader's lease timer and its own lease timer to run out before acquiring its own lease
-                self.wait_for_old_leader_lease_timeout()
-
-                # Start the lease timer and send heartbeats with lease duration
-                self.start_lease_timer()
-                self.send_heartbeats_with_lease_duration()
-
-    def step_down(self, term):
-        print(f"{self.server_index} Stepping down...")
-
-        # Revert to follower state
-        self.current_term = term
-        self.state = 'FOLLOWER'
-        self.voted_for = -1
-        self.set_election_timeout()
-
-    def wait_for_old_leader_lease_timeout(self):
-        if self.old_leader_lease_timeout > 0:
-            print("New Leader waiting for Old Leader Lease to timeout.")
-            time.sleep(self.old_leader_lease_timeout / 1000.0)
-
-    def start_lease_timer(self):
-        self.lease_start_time = time.time()
-
-    def send_heartbeats_with_lease_duration(self):
-        print(
-            f"Leader {self.server_index} sending heartbeat & Renewing Lease")
-        self.append_noop_entry()
-
-        for j in range(len(self.partitions[self.cluster_index])):
-            if j != self.server_index:
-                utils.run_thread(fn=self.send_append_entries_request,
-                                 args=(j, None))
-
-    def leader_send_append_entries(self):
-        print(f"Sending append entries from leader...")
-
-        while True:
-            # Check everytime if it is leader before sending append queries
-            if self.state == 'LEADER':
-                if time.time() - self.lease_start_time > self.lease_duration / 1000.0:
-                    # Lease has expired, renew the lease
-                    if self.send_heartbeats_with_lease_duration():
-                        self.start_lease_timer()
-                    else:
-                        # Failed to renew the lease, step down as leader
-                        print(
-                            f"Leader {self.server_index} lease renewal failed. Stepping Down.")
-                        self.step_down(self.current_term)
-                        break
-
-                self.append_entries()
-
-                # Commit entry after it has been replicated
-                last_index, _ = self.commit_log.get_last_index_term()
-                self.commit_index = last_index
-
-    def append_noop_entry(self):
-        self.commit_log.log(self.current_term, f"NO-OP {self.current_term}")
-
-    def append_entries(self):
-        res = Queue()
-
-        for j in range(len(self.partitions[self.cluster_index])):
-            if j != self.server_index:
-                # Send append entries requests in parallel
-                utils.run_thread(
-                    fn=self.send_append_entries_request, args=(j, res,))
-
-        if len(self.partitions[self.cluster_index]) > 1:
-            cnts = 0
-
-            while True:
-                # Wait for servers to respond
-                res.get(block=True)
-                cnts += 1
-                # Once we get reply from majority of servers, then return
-                # and don't wait for remaining servers
-                # Exclude self
-                if cnts > (len(self.partitions[self.cluster_index])/2.0)-1:
-                    return
-        else:
-            return
-
-    def send_append_entries_request(self, server, res=None):
-        print(f"Sending append entries to {server}...")
-
-        # Fetch previous index and previous term for log matching
-        prev_idx = self.next_indices[server]-1
-
-        # Get all logs from prev_idx onwards, because all logs after prev_idx will be
-        # used to replicate to server
-        log_slice = self.commit_log.read_logs_start_end(prev_idx)
-
-        if prev_idx == -1:
-            prev_term = 0
-        else:
-            if len(log_slice) > 0:
-                prev_term = log_slice[0][0]
-                log_slice = log_slice[1:] if len(log_slice) > 1 else []
-            else:
-                prev_term = 0
-                log_slice = []
-
-        # Include lease duration in the AppendEntries RPC
-        msg = f"APPEND-REQ {self.server_index} {self.current_term} {prev_idx} {prev_term} {str(log_slice)} {self.commit_index} {self.lease_duration}"
-
-        while True:
-            if self.state == 'LEADER':
-                ip, port = self.conns[self.cluster_index][server]
-
-                resp = \
-                    utils.send_and_recv_no_retry(msg, ip, port,
-                                                 timeout=self.rpc_period_ms/1000.0)
-
-                # If timeout happens resp returns None, so it won't go inside this condition
-                if resp:
-                    append_rep = re.match(
-                        '^APPEND-REP ([0-9]+) ([0-9\-]+) ([0-9]+) ([0-9\-]+)$', resp)
-
-                    if append_rep:
-                        server, curr_term, flag, index = append_rep.groups()
-                        server = int(server)
-                        curr_term = int(curr_term)
-                        flag = int(flag)
-                        success = True if flag == 1 else False
-                        index = int(index)
-
-                        self.process_append_reply(
-                            server, curr_term, success, index)
-                        break
-            else:
-                break
-
-        if res:
-            res.put('ok')
-
-    def process_append_requests(self, server, term, prev_idx, prev_term, logs, commit_index):
-        print(f"Processing append request from {server} {term}...")
-
-        # Follower/Candidate received vote reply, reset election timeout
-        self.set_election_timeout()
-
-        flag, index = 0, 0
-
-        # If term < self.current_term then the append request came from an old leader
-        # and we should not take action in that case.
-        if term > self.current_term:
-            # Most likely term == self.current_term, if this server participated
-            # in voting rounds. If server was down during voting rounds and previous append requests, then term > self.current_term
-            # and we should update its term
-            self.step_down(term)
-
-        if term == self.current_term:
-            # Request came from current leader
-            self.leader_id = server
-
-            # Check if the term corresponding to the prev_idx matches with that of the leader
-            self_logs = self.commit_log.read_logs_start_end(
-                prev_idx, prev_idx) if prev_idx != -1 else []
-
-            # Even with retries, this is idempotent
-            success = prev_idx == - \
-                1 or (len(self_logs) > 0 and self_logs[0][0] == prev_term)
-
-            if success:
-                # On retry, we will overwrite the same logs
-                last_index, last_term = self.commit_log.get_last_index_term()
-
-                if len(logs) > 0 and last_term == logs[-1][0] and last_index == self.commit_index:
-                    # Check if last term in self log matches leader log and last index in self log matches commit index
-                    # Then this is a retry and will avoid overwriting the logs
-                    index = self.commit_index
-                else:
-                    index = self.store_entries(prev_idx, logs)
-
-            flag = 1 if success else 0
-
-        return f"APPEND-REP {self.server_index} {self.current_term} {flag} {index}"
-
-    def process_append_reply(self, server, term, success, index):
-        print(f"Processing append reply from {server} {term}...")
-
-        # It cannot be possible that term < self.current_term because at the time of append request,
-        # all servers will be updated to current term
-
-        if term > self.current_term:
-            # This could be an old leader which become active and sent
-            # append requests but on receiving higher term, it will revert
-            # back to follower state.
-            self.step_down(term)
-
-        if self.state == 'LEADER' and term == self.current_term:
-            if success:
-                # If server log repaired successfully from leader then increment next index
-                self.next_indices[server] = index+1
-            else:
-                # If server log could not be repaired successfully, then retry with 1 index less lower than current next index
-                # Process repeats until we find a matching index and term on server
-                self.next_indices[server] = max(0, self.next_indices[server]-1)
-                self.send_append_entries_request(server)
-
-    def store_entries(self, prev_idx, leader_logs):
-        # Update/Repair server logs from leader logs, replacing non-matching entries and adding non-existent entries
-        # Repair starts from prev_idx+1 where prev_idx is the index till where
-        # both leader and server logs match.
-        commands = [f"{leader_logs[i][1]}" for i in range(len(leader_logs))]
-        last_index, _ = self.commit_log.log_replace(
-            self.current_term, commands, prev_idx+1)
-        self.commit_index = last_index
-
-        # Update state machine
-        for command in commands:
-            self.update_state_machine(command)
-
-        return last_index
-
-    def update_state_machine(self, command):
-        # Update state machine i.e. in memory hash map in this case
-        set_ht = re.match('^SET ([^\s]+) ([^\s]+) ([0-9]+)$', command)
-
-        if set_ht:
-            key, value, req_id = set_ht.groups()
-            req_id = int(req_id)
-            self.ht.set(key=key, value=value, req_id=req_id)
-
-    def handle_commands(self, msg, conn):
-        set_ht = re.match('^SET ([^\s]+) ([^\s]+) ([0-9]+)$', msg)
-        get_ht = re.match('^GET ([^\s]+) ([0-9]+)$', msg)
-        vote_req = re.match('^VOTE-REQ ([0-9]+) ([0-9\-]+) ([0-9\-]+) ([0-9\-]+)$', msg)
-        append_req = re.match('^APPEND-REQ ([0-9]+) ([0-9\-]+) ([0-9\-]+) ([0-9\-]+) (\[.*?\]) ([0-9\-]+)$', msg)
-
-        if set_ht:
-            output = "ko"
-
-            try:
-                key, value, req_id = set_ht.groups()
-                req_id = int(req_id)
-
-                # Hash based partitioning
-                node = mmh3.hash(key, signed=False) % len(self.partitions)
-
-                if self.cluster_index == node:
-                    # The key is intended for current cluster
-
-                    while True:
-                        if self.state == 'LEADER':
-                            # Replicate if this is leader server
-                            last_index, _ = self.commit_log.log(self.current_term, msg)
-                            # Get response from at-least N/2 number of servers
-
-                            while True:
-                                if last_index == self.commit_index:
-                                    break
-
-                            # Set state machine
-                            self.ht.set(key=key, value=value, req_id=req_id)
-                            output = "ok"
-                            break
-                        else:
-                            # If sent to non-leader, then forward to leader
-                            # Do not retry here because it might happen that current server becomes leader after sometime
-                            # Retry at client/upstream service end
-                            if self.leader_id != -1 and self.leader_id != self.server_index:
-                                # If request lands up on the server which was not present in the majority
-                                # when the leader sent and received append queries successfully. The leader_id
-                                # for these servers will still be -1
-                                output = utils.send_and_recv_no_retry(msg,
-                                                                    self.conns[node][self.leader_id][0],
-                                                                    self.conns[node][self.leader_id][1],
-                                                                    timeout=self.rpc_period_ms)
-                                if output is not None:
-                                    break
-                            else:
-                                output = 'ko'
-                                break
-                else:
-                    # Forward to relevant cluster (1st in partitions config) if key is not intended for this cluster
-                    # Retry here because this is different partition
-                    output = utils.send_and_recv(msg,
-                                                self.conns[node][0][0],
-                                                self.conns[node][0][1])
-                    if output is None:
-                        output = "ko"
-
-                # Introduce a delay after processing SET requests
-                time.sleep(0.01)  # Adjust the delay as needed
-
-            except Exception as e:
-                traceback.print_exc(limit=1000)
-
-        elif get_ht:
-            output = "ko"
-
-            try:
-                key, _ = get_ht.groups()
-                node = mmh3.hash(key, signed=False) % len(self.partitions)
-
-                if self.cluster_index == node:
-                    # The key is intended for current cluster
-
-                    while True:
-                        if self.state == 'LEADER':
-                            output = self.ht.get_value(key=key)
-                            if output:
-                                output = str(output)
-                            else:
-                                output = 'Error: Non existent key'
-                            break
-
-                        else:
-                            # If sent to non-leader, then forward to leader
-                            # Do not retry here because it might happen that current server becomes leader after sometime
-                            # Retry at client/upstream service end
-                            if self.leader_id != -1 and self.leader_id != self.server_index:
-                                output = utils.send_and_recv_no_retry(msg,
-                                                                      self.conns[node][self.leader_id][0],
-                                                                      self.conns[node][self.leader_id][1],
-                                                                      timeout=self.rpc_period_ms)
-                                if output is not None:
-                                    break
-                            else:
-                                output = 'ko'
-                                break
-
-                else:
-                    # Forward to relevant cluster (1st in partitions config) if key is not intended for this cluster
-                    # Retry here because this is different partition
-                    output = utils.send_and_recv(msg,
-                                                 self.conns[node][0][0],
-                                                 self.conns[node][0][1])
-                    if output is None:
-                        output = "ko"
-
-            except Exception as e:
-                traceback.print_exc(limit=1000)
-
-        elif vote_req:
-            try:
-                server, curr_term, last_term, last_indx = vote_req.groups()
-                server = int(server)
-                curr_term = int(curr_term)
-                last_term = int(last_term)
-                last_indx = int(last_indx)
-
-                output = self.process_vote_request(
-                    server, curr_term, last_term, last_indx)
-
-            except Exception as e:
-                traceback.print_exc(limit=1000)
-
-        elif append_req:
-            try:
-                server, curr_term, prev_idx, prev_term, logs, commit_index = append_req.groups()
-                server = int(server)
-                curr_term = int(curr_term)
-                prev_idx = int(prev_idx)
-                prev_term = int(prev_term)
-                logs = eval(logs)
-                commit_index = int(commit_index)
-
-                output = self.process_append_requests(
-                    server, curr_term, prev_idx, prev_term, logs, commit_index)
-
-            except Exception as e:
-                traceback.print_exc(limit=1000)
-
-        else:
-            print("Hello1 - " + msg + " - Hello2")
-            output = "Error: Invalid command"
-
-        return output
-
-    def process_request(self, conn):
-        while True:
-            try:
-                msg = conn.recv(2048)
-                if not msg:
-                    # Client disconnected, clean up the connection
-                    print("Client disconnected")
-                    conn.close()
-                    break
-
-                msg = msg.decode()
-                print(f"{msg} received")
-                output = self.handle_commands(msg, conn)
-                conn.sendall(output.encode())
-
-            except ConnectionResetError:
-                # Connection was reset by the client
-                print("Connection reset by client")
-                conn.close()
-                break
-
-            except Exception as e:
-                traceback.print_exc(limit=1000)
-                print("Error processing message from client")
-                conn.close()
-                break
-
-            except Exception as e:
-                traceback.print_exc(limit=1000)
-                print("Error processing message from client")
-                conn.close()
-                break
-
-    def listen_to_clients(self):
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_socket.bind(('0.0.0.0', int(self.port)))
-        server_socket.listen(50)
-
-        print(f"Server listening on {self.ip}:{self.port}")
-
-        while True:
-            try:
-                client_socket, client_address = server_socket.accept()
-                print(f"Connected to new client at address {client_address}")
-                client_thread = Thread(target=self.process_request, args=(client_socket,))
-                client_thread.daemon = True
-                client_thread.start()
-
-            except Exception as e:
-                print(f"Error accepting connection: {e}")
-                continue
-
-
-if __name__ == '__main__':
-    ip_address = str(sys.argv[1])
-    port = int(sys.argv[2])
-    partitions = str(sys.argv[3])
-
-    dht = Raft(ip=ip_address, port=port, partitions=partitions)
-    utils.run_thread(fn=dht.init, args=())
-    dht.listen_to_clients()
-
-
-
+from random import randint, random
+import sys
+import os
+import re
+import socket
+import select
+from hashtable import HashTable
+from disk_hashtable import DiskHashTable
+from threading import Thread, Lock, Event, Condition
+import mmh3
+import time
+from queue import Queue
+from random import shuffle
+from commit_log import CommitLog
+import tqdm
+from pathlib import Path
+from consistent_hashing import ConsistentHashing
+import shutil
+import utils
+import traceback
+import heapq
+from queue import Queue, Empty
+from transport import SocketTransport
+from timeouts import DEFAULT_TIMEOUTS, ADAPTIVE_TIMEOUTS, RttEstimator, clamp
+from compression import DEFAULT_COMPRESSION, CODECS, DictionaryStore
+from read_cache import DEFAULT_READ_CACHE, ReadCache
+from admission import DEFAULT_ADMISSION, AdmissionControl
+from tracing import DEFAULT_TRACING, Tracer, SamplingProfiler
+import tracing
+import compression
+
+class Raft:
+    def __init__(self, ip, port, partitions, transport=None, log_dir=None, cluster_index=None,
+                 log_writer=None, state_machine=None, config=None, tracer=None, profiler=None, applier=None):
+        self.ip = ip
+        self.port = port
+
+        # Timing, compression, read cache, admission control and tracing settings, see
+        # timeouts.py, compression.py, read_cache.py, admission.py and tracing.py
+        self.config = dict(DEFAULT_TIMEOUTS, **DEFAULT_COMPRESSION, **DEFAULT_READ_CACHE, **DEFAULT_ADMISSION,
+                           **DEFAULT_TRACING)
+        if config:
+            if config.get('adaptive_timeouts') == 1:
+                self.config.update(ADAPTIVE_TIMEOUTS)
+            self.config.update(config)
+        config = self.config
+
+        # State machine the committed commands are applied to, an in memory hash table
+        # unless another engine is injected (e.g. disk_hashtable.DiskHashTable)
+        self.ht = state_machine if state_machine else HashTable()
+
+        # Transport used for all node to node RPCs, real sockets unless a simulated
+        # transport is injected (see simulator.py)
+        self.transport = transport if transport else SocketTransport()
+
+        commit_log_file = f"commit-log-{self.ip}-{self.port}.txt"
+        if log_dir:
+            commit_log_file = os.path.join(log_dir, commit_log_file)
+        self.commit_log = CommitLog(file=commit_log_file, writer=log_writer, codec=config['compression'],
+                                    segment_entries=config['wal_segment_entries'],
+                                    block_entries=config['wal_block_entries'],
+                                    dictionary_bytes=config['dictionary_bytes'],
+                                    level=config['compression_level'])
+        self.partitions = eval(partitions)
+        self.conns = [[None]*len(self.partitions[i]) for i in range(len(self.partitions))]
+        self.cluster_index = -1
+        self.server_index = -1
+
+        # Initialize commit log file
+        commit_logfile = Path(self.commit_log.file)
+        commit_logfile.touch(exist_ok=True)
+
+        for i in range(len(self.partitions)):
+            cluster = self.partitions[i]
+
+            for j in range(len(cluster)):
+                ip, port = cluster[j].split(':')
+                port = int(port)
+
+                # A Multi-Raft host serves several partitions from the same address and
+                # creates one Raft object per partition with an explicit cluster_index
+                if (ip, port) == (self.ip, self.port) and (cluster_index is None or cluster_index == i):
+                    self.cluster_index = i
+                    self.server_index = j
+
+                else:
+                    self.conns[i][j] = (ip, port)
+
+        self.current_term = 1
+        self.voted_for = -1
+        self.votes = set()
+
+        u = len(self.partitions[self.cluster_index])
+
+        self.state = 'FOLLOWER' if len(self.partitions[self.cluster_index]) > 1 else 'LEADER'
+        self.leader_id = -1
+        self.commit_index = -1
+        self.next_indices = [0]*u
+        self.match_indices = [-1]*u
+
+        self.election_period_ms = config['election_period_ms']
+        self.rpc_period_ms = config['rpc_period_ms']
+        self.election_timeout = -1
+        self.rpc_timeout = [-1]*u
+        self.lease_duration = config['lease_duration']
+        self.old_leader_lease_timeout = -1  # To track the maximum old leader lease timeout
+        self.lease_start_time = time.time()
+
+        # Leader only sends a heartbeat to a follower that got no other message within this period
+        self.heartbeat_period_ms = config['heartbeat_period_ms']
+        self.last_contact = [0]*u
+
+        # In adaptive mode the leader estimates the round trip time to every follower and
+        # the followers estimate the time between messages from the leader
+        self.adaptive_timeouts = config['adaptive_timeouts'] == 1
+        self.rtt = [RttEstimator() for _ in range(u)]
+        self.leader_gaps = RttEstimator()
+        self.last_leader_message = -1
+        # Followers with an append entries request in flight
+        self.inflight = set()
+        # Every node reads a message with a single 2048 byte recv, an append entries request
+        # carries at most append_max_entries entries whose text fits in append_max_bytes. A
+        # follower that is further behind catches up over several requests.
+        self.append_max_entries = 100
+        self.append_max_bytes = 1800
+        # A follower that did not answer an append entries request gets the next one after
+        # append_backoff_ms[j], doubled on every failure up to the election period and reset
+        # by any reply
+        self.append_backoff_ms = [0]*u
+        self.append_retry_at = [0]*u
+        # Set whenever a new entry is appended on the leader to wake up replication
+        self.append_event = Event()
+
+        # Expired keys are deleted by the leader through DEL log entries
+        self.expiry_period_ms = 1000
+
+        # SCAN pages hold at most scan_max_limit keys and must fit in a single 2048 byte
+        # recv of the client or of the node that forwarded the request
+        self.scan_max_limit = 1000
+        self.scan_page_bytes = 1900
+
+        # Follower that leadership is being handed over to, new writes are rejected until
+        # the transfer finished so that the follower can catch up. A draining node never
+        # starts an election, so leadership stays away from it during maintenance.
+        self.transfer_target = -1
+        self.draining = False
+
+        # AppendEntries batches are compressed with the codec and dictionary agreed on with
+        # each follower, None until negotiated. The leader trains a dictionary from recent
+        # committed entries, followers train the same one from their own copy of the entries.
+        self.peer_codecs = [None]*u
+        self.dictionaries = DictionaryStore()
+        self.dictionary_id = -1
+        self.dictionary_range = (-1, -1)
+        # Bytes of AppendEntries batches before and after compression
+        self.replication_bytes = [0, 0]
+
+        # WATCH consumers read the changes of committed entries from a log index on. The
+        # leader logs COMPACT entries so that all replicas delete the same old segments, a
+        # consumer whose index was compacted away gets snapshot pages instead.
+        self.wal_retain_entries = config['wal_retain_entries']
+        self.compact_index = -1
+        self.compact_logged = -1
+        self.watch_max_entries = 1000
+        self.watch_max_wait_ms = 10000
+
+        # Commands of a client session carry a client id and a sequence number, the state
+        # machine keeps the response of the last command of every session so that a retry
+        # is answered without being applied again. pending_sessions holds
+        # client_id -> (seq, index, term) of commands logged but not applied yet.
+        self.session_ttl_ms = config['session_ttl_ms']
+        self.pending_sessions = {}
+        self.session_lock = Lock()
+
+        # Followers cache values read from the leader for GETs that accept stale values
+        self.read_cache = ReadCache(config['read_cache_entries'], config['read_cache_bytes'])
+
+        # Client commands that arrive over a connection wait in a bounded queue and are rate
+        # limited per client, peer RPCs skip both (see admission.py)
+        self.admission = AdmissionControl(config)
+
+        # A sampled fraction of the client commands is traced through every stage, spans go to
+        # trace-<ip>-<port>.jsonl next to the commit log unless a tracer is injected (e.g. the
+        # one of a Multi-Raft host). traced_entries holds index -> (trace, time logged) of
+        # traced commands that are not applied yet. PROFILE START samples the stacks of all
+        # threads until PROFILE STOP, which writes them to profile-<ip>-<port>.txt.
+        log_dir_prefix = os.path.join(log_dir, '') if log_dir else ''
+        self.tracer = tracer if tracer else Tracer(config, f"{self.ip}:{self.port}",
+                                                   f"{log_dir_prefix}trace-{self.ip}-{self.port}.jsonl")
+        self.traced_entries = {}
+        self.profiler = profiler if profiler else SamplingProfiler(f"{log_dir_prefix}profile-{self.ip}-{self.port}.txt")
+        self.profile_interval_ms = config['profile_interval_ms']
+
+        # Entries up to last_applied have been applied to the state machine, which keeps
+        # track of it so that a restart only replays the entries after it
+        self.apply_lock = Lock()
+        self.applied = Condition(self.apply_lock)
+        self.last_applied = self.ht.get_applied_index()
+        self.recover()
+
+        # Committed entries are applied by the thread that finds them committed, unless an
+        # applier is injected that runs apply_committed elsewhere (e.g. on the worker pool
+        # of a Multi-Raft host)
+        self.applier = applier
+
+        print("Ready...")
+
+    def recover(self):
+        # Entries up to the persisted apply index were committed and are already in the state
+        # machine. Entries after it may not be committed, a new leader can still replace them,
+        # so they are only applied once the commit index of the leader reaches them.
+        last_index, _ = self.commit_log.get_last_index_term()
+        self.commit_index = max(self.commit_index, self.last_applied)
+        if last_index > self.last_applied:
+            print(f"Log entries {self.last_applied+1} to {last_index} wait for the leader's commit index")
+
+    def init(self):
+        # set initial election timeout
+        self.set_election_timeout()
+
+        # Check for election timeout in the background
+        utils.run_thread(fn=self.on_election_timeout, args=())
+
+        # Sync logs or send heartbeats from leader to all servers in the background
+        utils.run_thread(fn=self.leader_send_append_entries, args=())
+
+        # Delete expired keys in the background
+        utils.run_thread(fn=self.on_expiry_timeout, args=())
+
+    def set_election_timeout(self, timeout=None):
+        # Reset this whenever previous timeout expires and starts a new election
+        if timeout:
+            self.election_timeout = timeout
+        else:
+            self.election_timeout = time.time() + randint(self.election_period_ms,
+                                                          2*self.election_period_ms)/1000.0
+
+    def get_rpc_timeout(self, server):
+        # Timeout in seconds for an RPC to server in this partition
+        if self.adaptive_timeouts and self.rtt[server].has_samples():
+            return clamp(self.rtt[server].get_timeout(), self.config['min_rpc_period_ms'],
+                         self.config['max_rpc_period_ms'])/1000.0
+        return self.rpc_period_ms/1000.0
+
+    def send_rpc(self, msg, server):
+        # Send msg to server in this partition and keep track of the round trip time
+        ip, port = self.conns[self.cluster_index][server]
+        start = time.time()
+        resp = self.transport.send_and_recv_no_retry(msg, ip, port, timeout=self.get_rpc_timeout(server))
+
+        if resp is not None:
+            self.rtt[server].add_sample((time.time() - start)*1000)
+        return resp
+
+    def on_leader_message(self, server):
+        # Followers derive their election period from the time between messages of the
+        # leader: twice the time after which the next message is overdue, never below two
+        # heartbeat periods since heartbeats are not sent while entries are flowing
+        now = time.time()
+        if self.leader_id != server:
+            self.leader_gaps.reset()
+        elif self.last_leader_message > 0:
+            self.leader_gaps.add_sample((now - self.last_leader_message)*1000)
+        self.last_leader_message = now
+
+        if self.adaptive_timeouts and self.leader_gaps.has_samples():
+            overdue = max(self.leader_gaps.get_timeout(), self.heartbeat_period_ms)
+            self.election_period_ms = int(clamp(2*overdue, self.config['min_election_period_ms'],
+                                                self.config['max_election_period_ms']))
+
+    def update_lease_duration(self):
+        # The lease must run out before a follower can time out and elect a new leader, even
+        # if the heartbeat that renews it takes as long as the slowest follower's RPC timeout
+        if self.adaptive_timeouts:
+            slowest = max([self.get_rpc_timeout(j)*1000 for j in range(len(self.partitions[self.cluster_index]))
+                           if j != self.server_index], default=0)
+            self.lease_duration = int(clamp(self.config['min_election_period_ms'] - slowest,
+                                            self.heartbeat_period_ms, self.config['lease_duration']))
+
+    def on_election_timeout(self):
+        while True:
+            self.election_tick()
+
+    def election_tick(self):
+        # Check everytime that state is either FOLLOWER or CANDIDATE before sending
+        # vote requests.
+
+        # The possibilities in this path are:
+        # 1. Requestor sends requests, receives replies and becomes leader
+        # 2. Requestor sends requests, receives replies and becomes follower again, repeat on election timeout
+        if time.time() > self.election_timeout and not self.draining and \
+                (self.state == 'FOLLOWER' or self.state == 'CANDIDATE'):
+
+            print(f"Node {self.server_index} election timer timed out, Starting election.")
+            self.set_election_timeout()
+            self.start_election()
+
+    def start_election(self):
+        print("Starting election...")
+
+        # At the start of election, set state to CANDIDATE and increment term
+        # also vote for self.
+        self.state = 'CANDIDATE'
+        self.voted_for = self.server_index
+        self.current_term += 1
+        # Votes of earlier terms do not count
+        self.votes = set([self.server_index])
+        self.old_leader_lease_timeout = -1  # Reset the old leader lease timeout
+
+        # Send vote requests in parallel
+        threads = []
+        for j in range(len(self.partitions[self.cluster_index])):
+            if j != self.server_index:
+                t = utils.run_thread(fn=self.request_vote, args=(j,))
+                threads += [t]
+
+        # Wait for completion of request flow
+        for t in threads:
+            t.join()
+
+        return True
+
+    def request_vote(self, server):
+        # Get last index and term from commit log
+        last_index, last_term = self.commit_log.get_last_index_term()
+
+        while True:
+            # Retry on timeout
+            print(f"Requesting vote from {server}...")
+
+            # Check if state if still CANDIDATE
+            if self.state == 'CANDIDATE' and time.time() < self.election_timeout:
+                msg = f"VOTE-REQ {self.server_index} {self.current_term} {last_term} {last_index}"
+                resp = self.send_rpc(msg, server)
+
+                # If timeout happens resp returns None, so it won't go inside this condition
+                if resp:
+                    vote_rep = re.match(
+                        '^VOTE-REP ([0-9]+) ([0-9\-]+) ([0-9\-]+) ([0-9\-]+)$', resp)
+
+                    if vote_rep:
+                        server, curr_term, voted_for, old_leader_lease_timeout = vote_rep.groups()
+
+                        server = int(server)
+                        curr_term = int(curr_term)
+                        voted_for = int(voted_for)
+                        old_leader_lease_timeout = int(old_leader_lease_timeout)
+
+                        self.process_vote_reply(
+                            server, curr_term, voted_for, old_leader_lease_timeout)
+                        break
+            else:
+                break
+
+    def process_vote_request(self, server, term, last_term, last_index):
+        print(f"Processing vote request from {server} {term}...")
+
+        if term > self.current_term:
+            # Requestor term is higher hence update
+            self.step_down(term)
+
+        # Get last index and term from log
+        self_last_index, self_last_term = self.commit_log.get_last_index_term()
+
+        # Vote for requestor only if requestor term is equal to self term
+        # and self has either voted for no one yet or has voted for same requestor (can happen during failure/timeout and retry)
+        # and either both requestor and self have empty logs (starting up)
+        # or the last term of requestor is greater
+        # or if they are equal then the last index of requestor should be greater.
+        # This is to ensure that only vote for all requestors who have updated logs.
+        if term == self.current_term \
+            and (self.voted_for == server or self.voted_for == -1) \
+            and (last_term > self_last_term or
+                 (last_term == self_last_term and last_index >= self_last_index)):
+
+            self.voted_for = server
+            self.state = 'FOLLOWER'
+            self.set_election_timeout()
+
+            if self.state == 'FOLLOWER':
+                print(
+                    f"Vote granted for Node {server} in term {self.current_term}.")
+
+        else:
+            print(f"Vote denied for Node {server} in term {self.current_term}.")
+
+        return f"VOTE-REP {self.server_index} {self.current_term} {self.voted_for} {self.old_leader_lease_timeout}"
+
+    def process_vote_reply(self, server, term, voted_for, old_leader_lease_timeout):
+        print(f"Processing vote reply from {server} {term}...")
+
+        # It is not possible to have term < self.current_term because during vote request
+        # the server will update its term to match requestor term if requestor term is higher
+        if term > self.current_term:
+            # Requestor term is lower hence update
+            self.step_down(term)
+
+        if term == self.current_term and self.state == 'CANDIDATE':
+            if voted_for == self.server_index:
+                self.votes.add(server)
+
+                # Keep track of the maximum old leader lease timeout received from voters
+                self.old_leader_lease_timeout = max(
+                    self.old_leader_lease_timeout, old_leader_lease_timeout)
+
+            # Convert to leader if received votes from majority
+            if len(self.votes) > len(self.partitions[self.cluster_index])/2.0:
+                self.state = 'LEADER'
+                self.leader_id = self.server_index
+
+                print(
+                    f"Node {self.server_index} became the leader for term {self.current_term}.")
+                print(f"{self.votes}-{self.current_term}")
+
+                # Wait for the maximum of the old leader's lease timer and its own lease timer to run out before acquiring its own lease
+                self.wait_for_old_leader_lease_timeout()
+
+                # Start replicating to every follower right after the last entry of the new leader,
+                # a NO-OP entry is only written on leadership change to commit entries of older terms
+                last_index, _ = self.commit_log.get_last_index_term()
+                self.next_indices = [last_index+1]*len(self.partitions[self.cluster_index])
+                self.match_indices = [-1]*len(self.partitions[self.cluster_index])
+                self.peer_codecs = [None]*len(self.partitions[self.cluster_index])
+                self.append_noop_entry()
+
+                # Start the lease timer and send heartbeats with lease duration
+                self.start_lease_timer()
+                self.send_heartbeats_with_lease_duration()
+                self.append_event.set()
+
+    def step_down(self, term):
+        print(f"{self.server_index} Stepping down...")
+
+        # Revert to follower state
+        self.current_term = term
+        self.state = 'FOLLOWER'
+        self.voted_for = -1
+        self.set_election_timeout()
+
+    def transfer_leadership(self, target=-1):
+        # Hand leadership over to the follower target, or to the most up to date follower
+        # if target is -1: replicate until the target has every entry of the leader, then
+        # tell it to start an election right away with TIMEOUT-NOW. The target wins since
+        # its log is as up to date as any other, and its vote request makes this leader
+        # step down. Gives up after an election period, returns True once not leader anymore.
+        if self.state != 'LEADER' or len(self.partitions[self.cluster_index]) == 1:
+            return False
+
+        if target == -1:
+            followers = self.get_transfer_candidates()
+            if len(followers) == 0:
+                return False
+            target = max(followers, key=lambda j: self.match_indices[j])
+
+        if target == self.server_index:
+            return True
+
+        print(f"Leader {self.server_index} transferring leadership to {target}...")
+        self.transfer_target = target
+        term = self.current_term
+        deadline = time.time() + self.election_period_ms/1000.0
+
+        try:
+            while time.time() < deadline and self.state == 'LEADER':
+                last_index, _ = self.commit_log.get_last_index_term()
+                if self.match_indices[target] >= last_index:
+                    break
+                self.append_event.set()
+                time.sleep(0.005)
+            else:
+                return False
+
+            self.send_rpc(f"TIMEOUT-NOW {self.server_index} {term}", target)
+
+            while time.time() < deadline and self.state == 'LEADER' and self.current_term == term:
+                time.sleep(0.005)
+
+            return self.state != 'LEADER'
+
+        finally:
+            self.transfer_target = -1
+
+    def get_transfer_candidates(self):
+        # Followers that answer STATUS and are not draining, so that draining one node does
+        # not move leadership onto another node that is being drained
+        candidates = []
+        for j in range(len(self.partitions[self.cluster_index])):
+            if j == self.server_index:
+                continue
+            resp = self.send_rpc(f"STATUS {self.cluster_index}", j)
+            status = re.match('^STATUS (?:[^\s]+ ){6}[^\s]+ ([01])$', resp) if resp else None
+            if status and status.group(1) == '0':
+                candidates += [j]
+        return candidates
+
+    def process_timeout_now(self, server, term):
+        # Leader handed over leadership, start an election without waiting for the timeout
+        if term == self.current_term and self.state == 'FOLLOWER' and not self.draining:
+            print(f"Node {self.server_index} got TIMEOUT-NOW from {server}, Starting election.")
+            self.set_election_timeout()
+            utils.run_thread(fn=self.start_election, args=())
+
+        return f"TIMEOUT-NOW-REP {self.server_index} {self.current_term}"
+
+    def drain(self):
+        # Move leadership off this node and keep it from becoming leader until resume
+        self.draining = True
+        if self.state == 'LEADER':
+            return self.transfer_leadership()
+        return True
+
+    def resume(self):
+        self.draining = False
+
+    def get_status(self):
+        last_index, _ = self.commit_log.get_last_index_term()
+        return f"STATUS {self.cluster_index} {self.server_index} {self.state} {self.current_term} " \
+               f"{self.leader_id} {last_index} {self.commit_index} {1 if self.draining else 0}"
+
+    def wait_for_old_leader_lease_timeout(self):
+        if self.old_leader_lease_timeout > 0:
+            print("New Leader waiting for Old Leader Lease to timeout.")
+            time.sleep(self.old_leader_lease_timeout / 1000.0)
+
+    def start_lease_timer(self):
+        self.lease_start_time = time.time()
+
+    def send_heartbeats_with_lease_duration(self):
+        print(
+            f"Leader {self.server_index} sending heartbeat & Renewing Lease")
+
+        # Followers that got an append entries request or heartbeat within the heartbeat
+        # period already know about the leader
+        now = time.time()
+        for j in range(len(self.partitions[self.cluster_index])):
+            if j != self.server_index and now - self.last_contact[j] >= self.heartbeat_period_ms/1000.0:
+                self.last_contact[j] = now
+                utils.run_thread(fn=self.send_heartbeat, args=(j,))
+
+        return True
+
+    def leader_send_append_entries(self):
+        print(f"Sending append entries from leader...")
+
+        while True:
+            self.append_event.clear()
+
+            if not self.leader_tick():
+                break
+
+            # Sleep until a new entry is appended or the next heartbeat is due
+            self.append_event.wait(self.heartbeat_period_ms/1000.0)
+
+    def leader_tick(self):
+        # Returns False if the leader had to step down because its lease could not be renewed
+
+        # Check everytime if it is leader before sending append queries
+        if self.state == 'LEADER':
+            self.update_lease_duration()
+            if time.time() - self.lease_start_time > self.lease_duration / 1000.0:
+                # Lease has expired, renew the lease
+                if self.send_heartbeats_with_lease_duration():
+                    self.start_lease_timer()
+                else:
+                    # Failed to renew the lease, step down as leader
+                    print(
+                        f"Leader {self.server_index} lease renewal failed. Stepping Down.")
+                    self.step_down(self.current_term)
+                    return False
+
+            # Only followers that are missing entries get append entries requests,
+            # the others only get a heartbeat once they have been idle for a while
+            now = time.time()
+            last_index, _ = self.commit_log.get_last_index_term()
+            pending = [j for j in range(len(self.partitions[self.cluster_index]))
+                       if j != self.server_index and self.next_indices[j] <= last_index and
+                       self.append_retry_at[j] <= now]
+
+            if len(pending) > 0:
+                self.append_entries(pending)
+
+            self.send_idle_heartbeats()
+
+            # Commit entries after they have been replicated
+            self.update_commit_index()
+            self.schedule_apply()
+            self.update_dictionary()
+            self.update_compaction()
+
+        return True
+
+    def update_commit_index(self):
+        # Highest index stored on a majority of servers, counting the leader itself
+        last_index, _ = self.commit_log.get_last_index_term()
+        indices = [last_index] + [self.match_indices[j] for j in range(len(self.partitions[self.cluster_index]))
+                                  if j != self.server_index]
+        indices = sorted(indices, reverse=True)
+        majority_index = indices[len(self.partitions[self.cluster_index])//2]
+
+        # Only an entry of the current term is committed by counting replicas, entries of older
+        # terms are committed along with it (Raft section 5.4.2). The NO-OP a new leader logs
+        # makes sure there is one.
+        if majority_index > self.commit_index:
+            entries = self.commit_log.read_logs_start_end(majority_index, majority_index)
+            if len(entries) > 0 and int(entries[0][0]) == self.current_term:
+                self.commit_index = majority_index
+
+    def schedule_apply(self):
+        if self.applier:
+            self.applier()
+        else:
+            self.apply_committed()
+
+    def apply_committed(self):
+        # Apply committed entries to the state machine in log order
+        with self.apply_lock:
+            if self.commit_index <= self.last_applied:
+                return
+
+            entries = self.commit_log.read_logs_start_end(self.last_applied+1, self.commit_index)
+            for _, command in entries:
+                traced = self.traced_entries.pop(self.last_applied+1, None)
+                start = time.time()
+                self.update_state_machine(command, self.last_applied+1)
+                self.last_applied += 1
+
+                if traced:
+                    (tracer, trace_id, span_id), logged = traced
+                    tracer.record(trace_id, span_id, 'replicate', logged, start, index=self.last_applied)
+                    tracer.record(trace_id, span_id, 'apply', start, time.time(), index=self.last_applied)
+
+            self.ht.set_applied_index(self.last_applied)
+            self.commit_log.seal(self.last_applied)
+
+            # Segments are only deleted after the entries in them are durably applied
+            if self.ht.durable and self.compact_index > 0:
+                self.commit_log.compact(self.compact_index)
+
+            # Wake up WATCH consumers waiting for new entries
+            self.applied.notify_all()
+
+    def update_compaction(self):
+        # Log a COMPACT entry once at least a whole segment can be deleted. Entries from the
+        # new first index on are kept by every follower, since there is no snapshot transfer
+        # between replicas to catch up a follower that is missing compacted entries.
+        if self.wal_retain_entries <= 0 or self.commit_log.segment_entries <= 0:
+            return
+
+        replicated = [self.match_indices[j] for j in range(len(self.partitions[self.cluster_index]))
+                      if j != self.server_index]
+        upto = min([self.last_applied] + replicated) - self.wal_retain_entries + 1
+
+        if upto - max(self.commit_log.get_first_index(), self.compact_logged) >= self.commit_log.segment_entries:
+            self.commit_log.log(self.current_term, f"COMPACT {upto}")
+            self.compact_logged = upto
+            self.append_event.set()
+
+    def append_noop_entry(self):
+        self.commit_log.log(self.current_term, f"NO-OP {self.current_term}")
+
+    def append_entries(self, servers=None):
+        res = Queue()
+
+        if servers is None:
+            servers = [j for j in range(len(self.partitions[self.cluster_index])) if j != self.server_index]
+
+        # Do not start another request to a follower that has not replied to the previous one yet
+        servers = [j for j in servers if j not in self.inflight]
+
+        for j in servers:
+            # Send append entries requests in parallel
+            self.inflight.add(j)
+            utils.run_thread(
+                fn=self.send_append_entries_request, args=(j, res,))
+
+        # Once we get reply from majority of servers (excluding self), or from all servers
+        # the requests were sent to, then return and don't wait for remaining servers. A
+        # follower that is down or slow does not hold up the heartbeats of the others for
+        # longer than the RPC timeout, its request keeps running on its own thread.
+        cnts = 0
+        needed = min(len(servers), len(self.partitions[self.cluster_index])//2)
+        deadline = time.time() + max([self.get_rpc_timeout(j) for j in servers] + [0])
+
+        while cnts < needed:
+            # Wait for servers to respond
+            try:
+                res.get(block=True, timeout=max(0, deadline - time.time()))
+            except Empty:
+                break
+            cnts += 1
+
+    def send_idle_heartbeats(self):
+        now = time.time()
+
+        for j in range(len(self.partitions[self.cluster_index])):
+            if j != self.server_index and now - self.last_contact[j] >= self.heartbeat_period_ms/1000.0:
+                self.last_contact[j] = now
+                utils.run_thread(fn=self.send_heartbeat, args=(j,))
+
+    def send_heartbeat(self, server):
+        # Heartbeats only carry term, commit index and lease, they are never retried
+        # since the next one goes out after another heartbeat period
+        msg = f"HEARTBEAT {self.server_index} {self.current_term} {self.commit_index} {self.lease_duration}"
+        resp = self.send_rpc(msg, server)
+
+        if resp:
+            heartbeat_rep = re.match('^HEARTBEAT-REP ([0-9]+) ([0-9\-]+) ([0-9\-]+)$', resp)
+
+            if heartbeat_rep:
+                server, curr_term, last_index = heartbeat_rep.groups()
+                self.process_heartbeat_reply(int(server), int(curr_term), int(last_index))
+
+    def process_heartbeat_request(self, server, term, commit_index):
+        print(f"Processing heartbeat from {server} {term}...")
+
+        self.set_election_timeout()
+
+        if term > self.current_term:
+            self.step_down(term)
+
+        last_index, _ = self.commit_log.get_last_index_term()
+
+        if term == self.current_term:
+            self.on_leader_message(server)
+            self.leader_id = server
+            self.state = 'FOLLOWER'
+            self.commit_index = max(self.commit_index, min(commit_index, last_index))
+            self.schedule_apply()
+
+        return f"HEARTBEAT-REP {self.server_index} {self.current_term} {last_index}"
+
+    def process_heartbeat_reply(self, server, term, last_index):
+        if term > self.current_term:
+            self.step_down(term)
+
+        # The follower is reachable again, append entries requests to it resume right away
+        self.append_backoff_ms[server] = 0
+        self.append_retry_at[server] = 0
+
+        if self.state == 'LEADER' and term == self.current_term and last_index < self.next_indices[server]-1:
+            # Follower is missing entries, the next leader tick sends them
+            self.next_indices[server] = max(0, last_index+1)
+            self.append_event.set()
+
+    def update_dictionary(self):
+        # Train a new dictionary once dictionary_entries entries were committed since the
+        # last one, followers switch to it when the codec is negotiated again
+        if self.config['compression'] == 'none' or self.config['dictionary_bytes'] <= 0 or \
+                self.commit_index - self.dictionary_range[1] < self.config['dictionary_entries']:
+            return
+
+        start = max(0, self.commit_index - self.config['dictionary_entries'] + 1)
+        entries = self.commit_log.read_logs_start_end(start, self.commit_index)
+        dictionary = compression.train_dictionary([command for _, command in entries],
+                                                  self.config['dictionary_bytes'])
+
+        self.dictionary_id = self.dictionaries.add(dictionary)
+        self.dictionary_range = (start, self.commit_index)
+        self.peer_codecs = [None]*len(self.partitions[self.cluster_index])
+
+    def get_peer_codec(self, server):
+        # (codec, dictionary id) for batches sent to server, negotiated on first use
+        if self.config['compression'] == 'none':
+            return None
+
+        if self.peer_codecs[server] is None:
+            start, end = self.dictionary_range
+            msg = f"CODEC-REQ {self.server_index} {self.config['compression']},none {start} {end} " \
+                  f"{self.config['dictionary_bytes']} {self.dictionary_id}"
+            resp = self.send_rpc(msg, server)
+
+            codec_rep = re.match('^CODEC-REP ([0-9]+) ([a-z]+) ([0-9\-]+)$', resp) if resp else None
+            if codec_rep:
+                self.peer_codecs[server] = (codec_rep.group(2), int(codec_rep.group(3)))
+
+        return self.peer_codecs[server]
+
+    def process_codec_request(self, server, codecs, start, end, size, dictionary_id):
+        # Pick the first codec offered by the leader that this node can decode, and train
+        # the leader's dictionary from the same log entries if it is not known yet. The
+        # dictionary is only used if it came out the same as the leader's.
+        codec = ([c for c in codecs.split(',') if c in CODECS] + ['none'])[0]
+
+        if dictionary_id != -1 and self.dictionaries.get(dictionary_id) is None:
+            last_index, _ = self.commit_log.get_last_index_term()
+            if start >= 0 and last_index >= end:
+                entries = self.commit_log.read_logs_start_end(start, end)
+                dictionary = compression.train_dictionary([command for _, command in entries], size)
+                if compression.get_dictionary_id(dictionary) == dictionary_id:
+                    self.dictionaries.add(dictionary)
+
+        accepted = dictionary_id if self.dictionaries.get(dictionary_id) is not None else -1
+        return f"CODEC-REP {self.server_index} {codec} {accepted}"
+
+    def send_append_entries_request(self, server, res=None):
+        print(f"Sending append entries to {server}...")
+        self.last_contact[server] = time.time()
+
+        # Fetch previous index and previous term for log matching
+        prev_idx = self.next_indices[server]-1
+
+        # Get the logs from prev_idx onwards that fit in one request, the entry at prev_idx
+        # itself only provides the previous term
+        log_slice = self.commit_log.read_logs_start_end(prev_idx, prev_idx + self.append_max_entries)
+        size = 0
+        for k in range(1 if prev_idx != -1 else 0, len(log_slice)):
+            size += len(str(log_slice[k])) + 2
+            if size > self.append_max_bytes and k > (1 if prev_idx != -1 else 0):
+                # At least one entry is sent even if it is larger on its own
+                log_slice = log_slice[:k]
+                break
+
+        if prev_idx == -1:
+            prev_term = 0
+        else:
+            if len(log_slice) > 0:
+                prev_term = log_slice[0][0]
+                log_slice = log_slice[1:] if len(log_slice) > 1 else []
+            else:
+                prev_term = 0
+                log_slice = []
+
+        logs = str(log_slice)
+        self.replication_bytes[0] += len(logs)
+
+        codec = self.get_peer_codec(server)
+        if codec and codec[0] != 'none' and len(logs) >= self.config['compress_min_bytes']:
+            dictionary = self.dictionaries.get(codec[1]) if codec[1] != -1 else None
+            payload = compression.encode_payload(codec[0], codec[1] if dictionary else -1, dictionary, logs,
+                                                 self.config['compression_level'])
+            if len(payload) < len(logs):
+                logs = payload
+        self.replication_bytes[1] += len(logs)
+
+        # Include lease duration in the AppendEntries RPC
+        msg = f"APPEND-REQ {self.server_index} {self.current_term} {prev_idx} {prev_term} {logs} {self.commit_index} {self.lease_duration}"
+
+        # The request is sent once, if it fails the next leader tick sends a new one after
+        # the follower's backoff
+        resp = self.send_rpc(msg, server) if self.state == 'LEADER' else None
+        append_rep = re.match('^APPEND-REP ([0-9]+) ([0-9\-]+) ([0-9]+) ([0-9\-]+)$', resp) if resp else None
+
+        if resp and resp.startswith('CODEC-RESET'):
+            # Follower lost the dictionary (e.g. restarted), negotiate again on the next send
+            self.peer_codecs[server] = None
+            self.append_event.set()
+
+        elif append_rep:
+            self.append_backoff_ms[server] = 0
+            self.append_retry_at[server] = 0
+
+            reply_server, curr_term, flag, index = append_rep.groups()
+            self.process_append_reply(int(reply_server), int(curr_term), int(flag) == 1, int(index))
+
+        elif self.state == 'LEADER':
+            self.append_backoff_ms[server] = min(max(2*self.append_backoff_ms[server], self.heartbeat_period_ms),
+                                                 self.election_period_ms)
+            self.append_retry_at[server] = time.time() + self.append_backoff_ms[server]/1000.0
+
+        self.inflight.discard(server)
+
+        if res:
+            res.put('ok')
+
+    def process_append_requests(self, server, term, prev_idx, prev_term, logs, commit_index):
+        print(f"Processing append request from {server} {term}...")
+
+        # Follower/Candidate received vote reply, reset election timeout
+        self.set_election_timeout()
+
+        flag, index = 0, 0
+
+        # If term < self.current_term then the append request came from an old leader
+        # and we should not take action in that case.
+        if term > self.current_term:
+            # Most likely term == self.current_term, if this server participated
+            # in voting rounds. If server was down during voting rounds and previous append requests, then term > self.current_term
+            # and we should update its term
+            self.step_down(term)
+
+        if term == self.current_term:
+            # Request came from current leader
+            self.on_leader_message(server)
+            self.leader_id = server
+            self.state = 'FOLLOWER'
+
+            # Check if the term corresponding to the prev_idx matches with that of the leader
+            self_logs = self.commit_log.read_logs_start_end(
+                prev_idx, prev_idx) if prev_idx != -1 else []
+
+            # Even with retries, this is idempotent
+            # Terms are read back from the log file as strings
+            success = prev_idx == - \
+                1 or (len(self_logs) > 0 and int(self_logs[0][0]) == prev_term)
+
+            if success:
+                # On retry, we will overwrite the same logs
+                last_index, _ = self.commit_log.get_last_index_term()
+                batch_end = prev_idx + len(logs)
+                own_logs = self.commit_log.read_logs_start_end(batch_end, batch_end) \
+                    if len(logs) > 0 and last_index >= batch_end else []
+
+                if len(own_logs) > 0 and own_logs[0][0] == logs[-1][0]:
+                    # The last entry of the batch is already stored with the same term, so all
+                    # entries before it match too. This is a retry or an older batch, storing it
+                    # again would truncate the entries after it.
+                    index = batch_end
+                    self.commit_index = max(self.commit_index, min(commit_index, index))
+                    self.schedule_apply()
+                else:
+                    index = self.store_entries(prev_idx, logs, commit_index)
+
+            flag = 1 if success else 0
+
+        return f"APPEND-REP {self.server_index} {self.current_term} {flag} {index}"
+
+    def process_append_reply(self, server, term, success, index):
+        print(f"Processing append reply from {server} {term}...")
+
+        # It cannot be possible that term < self.current_term because at the time of append request,
+        # all servers will be updated to current term
+
+        if term > self.current_term:
+            # This could be an old leader which become active and sent
+            # append requests but on receiving higher term, it will revert
+            # back to follower state.
+            self.step_down(term)
+
+        if self.state == 'LEADER' and term == self.current_term:
+            if success:
+                # If server log repaired successfully from leader then increment next index
+                self.next_indices[server] = index+1
+                self.match_indices[server] = index
+            else:
+                # If server log could not be repaired successfully, then retry with 1 index less lower than current next index
+                # Process repeats until we find a matching index and term on server
+                self.next_indices[server] = max(0, self.next_indices[server]-1)
+
+            # Send the next batch to a follower that is still behind without waiting for the
+            # next heartbeat period
+            last_index, _ = self.commit_log.get_last_index_term()
+            if self.next_indices[server] <= last_index:
+                self.append_event.set()
+
+    def store_entries(self, prev_idx, leader_logs, commit_index):
+        # Update/Repair server logs from leader logs, replacing non-matching entries and adding non-existent entries
+        # Repair starts from prev_idx+1 where prev_idx is the index till where
+        # both leader and server logs match. Entries keep the term they were created in, so
+        # that the log matching check of later requests compares the same terms.
+        terms = [leader_logs[i][0] for i in range(len(leader_logs))]
+        commands = [f"{leader_logs[i][1]}" for i in range(len(leader_logs))]
+        last_index, _ = self.commit_log.log_replace(
+            terms, commands, prev_idx+1)
+
+        # Only entries the leader has committed are applied, a stored entry that is not
+        # committed yet can still be replaced by a later leader
+        self.commit_index = max(self.commit_index, min(commit_index, last_index))
+        self.schedule_apply()
+
+        return last_index
+
+    def update_state_machine(self, command, index):
+        # Update state machine i.e. in memory hash map in this case
+        set_ht = re.match('^SET ([^\s]+) ([^\s]+) ([0-9]+)( EXPIREAT ([0-9]+))?( SESSION ([^\s]+) ([0-9]+) ([0-9]+))?$', command)
+        del_ht = re.match('^DEL ([^\s]+) ([0-9]+)( SESSION ([^\s]+) ([0-9]+) ([0-9]+))?$', command)
+        compact = re.match('^COMPACT ([0-9]+)$', command)
+
+        session = None
+        if set_ht and set_ht.group(6):
+            session = set_ht.group(7), int(set_ht.group(8)), int(set_ht.group(9))
+        elif del_ht and del_ht.group(3):
+            session = del_ht.group(4), int(del_ht.group(5)), int(del_ht.group(6))
+
+        if session:
+            # Sessions expire by the leader's time logged with the command, so every replica
+            # expires the same sessions at the same entry
+            client_id, seq, now = session
+            self.ht.expire_sessions(now - self.session_ttl_ms)
+
+            last = self.ht.get_session(client_id)
+            if last and last[0] >= seq:
+                # A retry that was logged again before the first one was applied
+                return
+
+        if set_ht:
+            key, value, req_id, _, expire_at = set_ht.groups()[:5]
+            req_id = int(req_id)
+            expire_at = int(expire_at) if expire_at else None
+            self.ht.set(key=key, value=value, req_id=req_id, expire_at=expire_at)
+            self.read_cache.invalidate(key, index)
+
+        elif del_ht:
+            key, req_id = del_ht.groups()[:2]
+            self.ht.delete(key=key, req_id=int(req_id))
+            self.read_cache.invalidate(key, index)
+
+        elif compact:
+            # Segments are deleted in apply_committed once this entry is applied
+            self.compact_index = max(self.compact_index, int(compact.group(1)))
+
+        if session:
+            self.ht.set_session(client_id, seq, 'ok', now)
+
+    def get_log_command(self, msg):
+        # TTLs are turned into an absolute expiry time by the leader before the command is
+        # logged, so that every replica applies the same expiry time. Session commands get
+        # the leader's time appended for the same reason.
+        now = int(time.time()*1000)
+        set_ttl = re.match('^(SET [^\s]+ [^\s]+ [0-9]+) EX ([0-9]+)( SESSION [^\s]+ [0-9]+)?$', msg)
+
+        if set_ttl:
+            command, ttl, session = set_ttl.groups()
+            msg = f"{command} EXPIREAT {now + int(ttl)*1000}{session if session else ''}"
+
+        if re.match('^.* SESSION [^\s]+ [0-9]+$', msg):
+            msg = f"{msg} {now}"
+        return msg
+
+    def replicate(self, msg, session):
+        # Log the command on the leader and wait until it is applied. A command of a client
+        # session that was applied already gets its cached response, a retry of a command
+        # that is still being replicated waits for the entry of the first attempt.
+        with self.session_lock:
+            pending = None
+            if session:
+                client_id, seq = session
+                last = self.ht.get_session(client_id)
+                if last and last[2] < time.time()*1000 - self.session_ttl_ms:
+                    # Expired, it is dropped when the next session command is applied
+                    last = None
+                if last and last[0] > seq:
+                    return 'Error: Stale sequence number'
+                if last and last[0] == seq:
+                    return last[1]
+                pending = self.pending_sessions.get(client_id)
+
+            if pending and pending[0] == seq:
+                _, last_index, term = pending
+            else:
+                with tracing.span('log'):
+                    last_index, term = self.commit_log.log(self.current_term, self.get_log_command(msg))
+                if session:
+                    self.pending_sessions[client_id] = (seq, last_index, term)
+
+        # The time from here until the entry is applied is recorded by apply_committed
+        if tracing.current():
+            self.traced_entries[last_index] = (tracing.current(), time.time())
+        self.append_event.set()
+
+        # Woken up by apply_committed, a leader that stepped down gives up on the entry
+        # and the client retries with the next leader
+        with self.applied:
+            while self.last_applied < last_index and self.state == 'LEADER' and self.current_term == term:
+                self.applied.wait(self.heartbeat_period_ms/1000.0)
+
+        self.traced_entries.pop(last_index, None)
+        if session:
+            with self.session_lock:
+                if self.pending_sessions.get(client_id) == (seq, last_index, term):
+                    self.pending_sessions.pop(client_id)
+
+        if self.last_applied < last_index or self.current_term != term:
+            return 'ko'
+
+        if session:
+            last = self.ht.get_session(client_id)
+            if last and last[0] == seq:
+                return last[1]
+        return 'ok'
+
+    def on_expiry_timeout(self):
+        while True:
+            time.sleep(self.expiry_period_ms/1000.0)
+            self.expiry_tick()
+
+    def expiry_tick(self):
+        # Only the leader decides when a key has expired. Expired keys come from the expiry
+        # heap of the hash table, a DEL entry is logged for each of them and applied once
+        # it is committed, followers apply the same DEL entries from the log.
+        if self.state != 'LEADER':
+            # A key whose DEL did not commit before leadership was lost is still in expiry,
+            # the heap of the next leader is rebuilt from it and expires the key again
+            self.ht.set_expiry_tracking(False)
+            return
+
+        self.ht.set_expiry_tracking(True)
+
+        expired = self.ht.pop_expired(int(time.time()*1000))
+
+        for key, req_id, _ in expired:
+            self.commit_log.log(self.current_term, f"DEL {key} {req_id}")
+
+        if len(expired) > 0:
+            self.append_event.set()
+
+    def read_through(self, node, key, req_id):
+        # Read key from the leader along with the index the leader had applied and cache it.
+        # Returns (value, index), value None if the key does not exist, or None on failure.
+        read_at = time.time()*1000
+        self.read_cache.start_read(key)
+
+        try:
+            resp = self.transport.send_and_recv_no_retry(f"GET-AT {key} {req_id}",
+                                                         self.conns[node][self.leader_id][0],
+                                                         self.conns[node][self.leader_id][1],
+                                                         timeout=self.rpc_period_ms/1000.0)
+            get_rep = re.match('^GET-REP ([0-9\-]+) ([01])( ([^\s]+))?$', resp) if resp else None
+            if get_rep is None:
+                return None
+
+            index, found, _, value = get_rep.groups()
+            value = value if found == '1' else None
+            self.read_cache.put(key, value, int(index), read_at)
+            return value, int(index)
+
+        finally:
+            self.read_cache.end_read(key)
+
+    def get_scan_options(self, options):
+        # Parse the options of a SCAN command into (start, end, prefix, after, limit),
+        # the continuation token is the hex encoded last key of the previous page
+        options = dict(re.findall('(PREFIX|START|END|LIMIT|TOKEN) ([^\s]+)', options))
+        after = bytes.fromhex(options['TOKEN']).decode() if 'TOKEN' in options else None
+        limit = min(max(int(options.get('LIMIT', 100)), 1), self.scan_max_limit)
+        return options.get('START'), options.get('END'), options.get('PREFIX'), after, limit
+
+    def get_scan_reply(self, items, more):
+        # SCAN-REP <token> <key> <value> <key> <value> ..., the token is '-' on the last page.
+        # Keys that do not fit in the page are left for the next page.
+        body = ''
+        for i in range(len(items)):
+            key, value = items[i]
+            pair = f" {key} {value}"
+
+            # Leave room for the token, which is at most the hex encoded key of this pair
+            if i > 0 and len('SCAN-REP ') + 2*len(key.encode()) + len(body.encode()) + len(pair.encode()) > self.scan_page_bytes:
+                items = items[:i]
+                more = True
+                break
+            body += pair
+
+        token = items[-1][0].encode().hex() if more and len(items) > 0 else '-'
+        return 'SCAN-REP ' + token + body
+
+    def parse_scan_reply(self, reply):
+        # Returns (items, more) or None if the partition could not be scanned
+        if reply is None or not reply.startswith('SCAN-REP '):
+            return None
+        parts = reply.split(' ')
+        return [(parts[i], parts[i+1]) for i in range(2, len(parts), 2)], parts[1] != '-'
+
+    def scan_partition(self, msg, res):
+        res.put(self.handle_commands(msg, None))
+
+    def scan_all_partitions(self, req_id, options):
+        # Fan out the scan to every partition and merge the sorted pages. A partition that
+        # has more keys than it returned bounds the merged page by its last key, keys after
+        # it may still be missing from that partition.
+        _, _, _, _, limit = self.get_scan_options(options)
+        results = [Queue() for _ in self.partitions]
+        for i in range(len(self.partitions)):
+            # Each partition's page is a stage of the trace of the SCAN
+            utils.run_thread(fn=tracing.bind(self.scan_partition),
+                             args=(f"SCAN-PART {i} {req_id}{options}", results[i]))
+
+        pages = [self.parse_scan_reply(res.get(block=True)) for res in results]
+        if None in pages:
+            return 'ko'
+
+        more = any([page_more for _, page_more in pages])
+        bound = min([items[-1][0] for items, page_more in pages if page_more], default=None)
+
+        merged = []
+        for key, value in heapq.merge(*[items for items, _ in pages]):
+            if bound is not None and key > bound:
+                break
+            if len(merged) == limit:
+                more = True
+                break
+            merged += [(key, value)]
+
+        return self.get_scan_reply(merged, more)
+
+    def get_watch_options(self, options):
+        # Parse the options of a WATCH command into (prefix, limit, wait_ms, token)
+        options = dict(re.findall('(PREFIX|LIMIT|WAIT|TOKEN) ([^\s]+)', options))
+        limit = min(max(int(options.get('LIMIT', 100)), 1), self.scan_max_limit)
+        wait_ms = min(max(int(options.get('WAIT', 1000)), 0), self.watch_max_wait_ms)
+        return options.get('PREFIX'), limit, wait_ms, options.get('TOKEN')
+
+    def watch(self, start, options):
+        # Changes of the committed entries from index start on. Consumers pull one page at a
+        # time and continue from the index in the reply, so a slow consumer only falls
+        # behind and never makes the leader buffer changes for it.
+        prefix, limit, wait_ms, token = self.get_watch_options(options)
+
+        if token is None and start >= self.commit_log.get_first_index():
+            # Wait for the next entry to be applied unless there are changes already
+            with self.applied:
+                self.applied.wait_for(lambda: self.last_applied >= start or self.state != 'LEADER',
+                                      timeout=wait_ms/1000.0)
+
+            if self.state != 'LEADER':
+                return 'ko'
+
+            output = self.get_watch_reply(start, prefix, limit)
+            if output is not None:
+                return output
+
+        # The entries were compacted away, the consumer reads snapshot pages instead
+        return self.get_watch_snapshot(start if token else None, prefix, limit, token)
+
+    def get_watch_reply(self, start, prefix, limit):
+        # WATCH-REP <next index> <index> SET <key> <value> <index> DEL <key> ... or None if
+        # the entries were compacted away. Entries of other keys and entries that change no
+        # key (NO-OP, COMPACT) are skipped but still move the next index forward.
+        entries = self.commit_log.read_logs_start_end(start, min(self.last_applied, start + self.watch_max_entries - 1))
+        if None in entries:
+            return None
+
+        body = ''
+        count = 0
+        index = start
+        for _, command in entries:
+            set_ht = re.match('^SET ([^\s]+) ([^\s]+) ', command)
+            del_ht = re.match('^DEL ([^\s]+) ', command)
+            change = f" {index} SET {set_ht.group(1)} {set_ht.group(2)}" if set_ht else \
+                     f" {index} DEL {del_ht.group(1)}" if del_ht else None
+            key = set_ht.group(1) if set_ht else del_ht.group(1) if del_ht else None
+
+            if change and (prefix is None or key.startswith(prefix)):
+                if count == limit or len(f"WATCH-REP {index}{body}{change}".encode()) > self.scan_page_bytes:
+                    break
+                body += change
+                count += 1
+            index += 1
+
+        return f"WATCH-REP {index}{body}"
+
+    def get_watch_snapshot(self, start, prefix, limit, token):
+        # WATCH-SNAPSHOT <index> <token> <key> <value> ..., pages of the current keys as in
+        # SCAN, continued with TOKEN until the token is '-' and then followed by the changes
+        # from index on. The first page picks the index, keys that change while the pages
+        # are read show up again in those changes, so applying the pages and then the
+        # changes in order ends up with the same data as the leader.
+        if start is None:
+            start = self.last_applied + 1
+        after = bytes.fromhex(token).decode() if token else None
+
+        items, more = self.ht.scan(prefix=prefix, after=after, limit=limit, now=int(time.time()*1000))
+        return f"WATCH-SNAPSHOT {start}" + self.get_scan_reply(items, more)[len('SCAN-REP'):]
+
+    def handle_commands(self, msg, conn):
+        # EXPIREAT is only added by the leader when it logs a SET with EX (see get_log_command)
+        set_ht = re.match('^SET ([^\s]+) ([^\s]+) ([0-9]+)( (EX) ([0-9]+))?( SESSION ([^\s]+) ([0-9]+))?$', msg)
+        del_ht = re.match('^DEL ([^\s]+) ([0-9]+)( SESSION ([^\s]+) ([0-9]+))?$', msg)
+        get_ht = re.match('^GET ([^\s]+) ([0-9]+)( STALE ([0-9]+))?$', msg)
+        get_at = re.match('^GET-AT ([^\s]+) ([0-9]+)$', msg)
+        scan_req = re.match('^SCAN ([0-9]+)((?: (?:PREFIX|START|END|LIMIT|TOKEN) [^\s]+)*)$', msg)
+        scan_part = re.match('^SCAN-PART ([0-9]+) ([0-9]+)((?: (?:PREFIX|START|END|LIMIT|TOKEN) [^\s]+)*)$', msg)
+        watch_req = re.match('^WATCH ([0-9]+) ([0-9]+)((?: (?:PREFIX|LIMIT|WAIT|TOKEN) [^\s]+)*)$', msg)
+        vote_req = re.match('^VOTE-REQ ([0-9]+) ([0-9\-]+) ([0-9\-]+) ([0-9\-]+)$', msg)
+        heartbeat_req = re.match('^HEARTBEAT ([0-9]+) ([0-9\-]+) ([0-9\-]+) ([0-9\-]+)$', msg)
+        timeout_now = re.match('^TIMEOUT-NOW ([0-9]+) ([0-9\-]+)$', msg)
+        transfer_req = re.match('^TRANSFER ([0-9]+) ([0-9\-]+)$', msg)
+        status_req = re.match('^STATUS ([0-9]+)$', msg)
+        drain_req = re.match('^(DRAIN|RESUME)$', msg)
+        append_req = re.match('^APPEND-REQ ([0-9]+) ([0-9\-]+) ([0-9\-]+) ([0-9\-]+) (\[.*\]|Z[^\s]+) ([0-9\-]+) ([0-9\-]+)$', msg)
+        codec_req = re.match('^CODEC-REQ ([0-9]+) ([a-z,]+) ([0-9\-]+) ([0-9\-]+) ([0-9]+) ([0-9\-]+)$', msg)
+        tracing_req = re.match('^TRACING ([0-9.]+)$', msg)
+        profile_req = re.match('^PROFILE (START|STOP)( ([0-9]+))?$', msg)
+
+        if set_ht or del_ht:
+            output = "ko"
+
+            try:
+                key = set_ht.group(1) if set_ht else del_ht.group(1)
+                session = set_ht.group(8, 9) if set_ht and set_ht.group(7) else \
+                          del_ht.group(4, 5) if del_ht and del_ht.group(3) else None
+                session = (session[0], int(session[1])) if session else None
+
+                # Hash based partitioning
+                node = mmh3.hash(key, signed=False) % len(self.partitions)
+
+                if self.cluster_index == node:
+                    # The key is intended for current cluster
+
+                    while True:
+                        if self.state == 'LEADER' and self.transfer_target != -1:
+                            # Leadership is moving to another node, the client retries there
+                            output = 'ko'
+                            break
+
+                        elif self.state == 'LEADER':
+                            # Replicate if this is leader server
+                            output = self.replicate(msg, session)
+                            break
+                        else:
+                            # If sent to non-leader, then forward to leader
+                            # Do not retry here because it might happen that current server becomes leader after sometime
+                            # Retry at client/upstream service end
+                            if self.leader_id != -1 and self.leader_id != self.server_index:
+                                # If request lands up on the server which was not present in the majority
+                                # when the leader sent and received append queries successfully. The leader_id
+                                # for these servers will still be -1
+                                output = self.transport.send_and_recv_no_retry(msg,
+                                                                             self.conns[node][self.leader_id][0],
+                                                                             self.conns[node][self.leader_id][1],
+                                                                             timeout=self.rpc_period_ms/1000.0)
+                                if output is not None:
+                                    break
+                            else:
+                                output = 'ko'
+                                break
+                else:
+                    # Forward to relevant cluster (1st in partitions config) if key is not intended for this cluster
+                    # Retry here because this is different partition
+                    output = self.transport.send_and_recv(msg,
+                                                         self.conns[node][0][0],
+                                                         self.conns[node][0][1])
+                    if output is None:
+                        output = "ko"
+
+            except Exception as e:
+                traceback.print_exc(limit=1000)
+
+        elif get_ht:
+            output = "ko"
+
+            try:
+                key, req_id, _, max_stale_ms = get_ht.groups()
+                node = mmh3.hash(key, signed=False) % len(self.partitions)
+
+                if self.cluster_index == node:
+                    # The key is intended for current cluster
+
+                    while True:
+                        if self.state == 'LEADER':
+                            output = self.ht.get_value(key=key, now=int(time.time()*1000))
+                            if output:
+                                output = str(output)
+                            else:
+                                output = 'Error: Non existent key'
+                            break
+
+                        elif max_stale_ms is not None and self.leader_id != -1 and self.leader_id != self.server_index:
+                            # The client accepts a value read from the leader up to max_stale_ms ago
+                            cached = self.read_cache.get(key, time.time()*1000 - int(max_stale_ms))
+                            if cached is None:
+                                cached = self.read_through(node, key, req_id)
+
+                            if cached is not None:
+                                output = cached[0] if cached[0] is not None else 'Error: Non existent key'
+                            break
+
+                        else:
+                            # If sent to non-leader, then forward to leader
+                            # Do not retry here because it might happen that current server becomes leader after sometime
+                            # Retry at client/upstream service end
+                            if self.leader_id != -1 and self.leader_id != self.server_index:
+                                output = self.transport.send_and_recv_no_retry(msg,
+                                                                               self.conns[node][self.leader_id][0],
+                                                                               self.conns[node][self.leader_id][1],
+                                                                               timeout=self.rpc_period_ms/1000.0)
+                                if output is not None:
+                                    break
+                            else:
+                                output = 'ko'
+                                break
+
+                else:
+                    # Forward to relevant cluster (1st in partitions config) if key is not intended for this cluster
+                    # Retry here because this is different partition
+                    output = self.transport.send_and_recv(msg,
+                                                          self.conns[node][0][0],
+                                                          self.conns[node][0][1])
+                    if output is None:
+                        output = "ko"
+
+            except Exception as e:
+                traceback.print_exc(limit=1000)
+
+        elif get_at:
+            # GET of a follower that caches the value, see read_through
+            output = "ko"
+
+            try:
+                key, _ = get_at.groups()
+                if self.state == 'LEADER':
+                    # The index is read first, the value includes at least the changes up to it
+                    index = self.last_applied
+                    value = self.ht.get_value(key=key, now=int(time.time()*1000))
+                    output = f"GET-REP {index} 1 {value}" if value is not None else f"GET-REP {index} 0"
+
+            except Exception as e:
+                traceback.print_exc(limit=1000)
+
+        elif scan_req:
+            output = "ko"
+
+            try:
+                req_id, options = scan_req.groups()
+                output = self.scan_all_partitions(req_id, options)
+
+            except Exception as e:
+                traceback.print_exc(limit=1000)
+
+        elif scan_part:
+            output = "ko"
+
+            try:
+                node, req_id, options = scan_part.groups()
+                node = int(node)
+
+                if self.cluster_index == node:
+                    # Same as GET, only the leader serves the scan
+                    if self.state == 'LEADER':
+                        start, end, prefix, after, limit = self.get_scan_options(options)
+                        items, more = self.ht.scan(start=start, end=end, prefix=prefix, after=after,
+                                                   limit=limit, now=int(time.time()*1000))
+                        output = self.get_scan_reply(items, more)
+
+                    elif self.leader_id != -1 and self.leader_id != self.server_index:
+                        output = self.transport.send_and_recv_no_retry(msg,
+                                                                       self.conns[node][self.leader_id][0],
+                                                                       self.conns[node][self.leader_id][1],
+                                                                       timeout=self.rpc_period_ms/1000.0)
+                        if output is None:
+                            output = "ko"
+
+                else:
+                    output = self.transport.send_and_recv(msg,
+                                                          self.conns[node][0][0],
+                                                          self.conns[node][0][1])
+                    if output is None:
+                        output = "ko"
+
+            except Exception as e:
+                traceback.print_exc(limit=1000)
+
+        elif watch_req:
+            output = "ko"
+
+            try:
+                node, start, options = watch_req.groups()
+                node = int(node)
+
+                if self.cluster_index == node:
+                    # Only the leader knows which entries are committed
+                    if self.state == 'LEADER':
+                        output = self.watch(int(start), options)
+
+                    elif self.leader_id != -1 and self.leader_id != self.server_index:
+                        _, _, wait_ms, _ = self.get_watch_options(options)
+                        output = self.transport.send_and_recv_no_retry(msg,
+                                                                       self.conns[node][self.leader_id][0],
+                                                                       self.conns[node][self.leader_id][1],
+                                                                       timeout=(self.rpc_period_ms + wait_ms)/1000.0)
+                        if output is None:
+                            output = "ko"
+
+                else:
+                    output = self.transport.send_and_recv(msg,
+                                                          self.conns[node][0][0],
+                                                          self.conns[node][0][1])
+                    if output is None:
+                        output = "ko"
+
+            except Exception as e:
+                traceback.print_exc(limit=1000)
+
+        elif vote_req:
+            try:
+                server, curr_term, last_term, last_indx = vote_req.groups()
+                server = int(server)
+                curr_term = int(curr_term)
+                last_term = int(last_term)
+                last_indx = int(last_indx)
+
+                output = self.process_vote_request(
+                    server, curr_term, last_term, last_indx)
+
+            except Exception as e:
+                traceback.print_exc(limit=1000)
+
+        elif heartbeat_req:
+            try:
+                server, curr_term, commit_index, _ = heartbeat_req.groups()
+                output = self.process_heartbeat_request(int(server), int(curr_term), int(commit_index))
+
+            except Exception as e:
+                traceback.print_exc(limit=1000)
+
+        elif timeout_now:
+            try:
+                server, curr_term = timeout_now.groups()
+                output = self.process_timeout_now(int(server), int(curr_term))
+
+            except Exception as e:
+                traceback.print_exc(limit=1000)
+
+        elif transfer_req:
+            # Only the leader of the partition can transfer its leadership
+            output = "ko"
+
+            try:
+                node, target = transfer_req.groups()
+                if int(node) == self.cluster_index and self.transfer_leadership(int(target)):
+                    output = "ok"
+
+            except Exception as e:
+                traceback.print_exc(limit=1000)
+
+        elif status_req:
+            output = self.get_status() if int(status_req.group(1)) == self.cluster_index else "ko"
+
+        elif drain_req:
+            output = "ko"
+
+            try:
+                if drain_req.group(1) == 'DRAIN':
+                    output = "ok" if self.drain() else "ko"
+                else:
+                    self.resume()
+                    output = "ok"
+
+            except Exception as e:
+                traceback.print_exc(limit=1000)
+
+        elif codec_req:
+            try:
+                server, codecs, start, end, size, dictionary_id = codec_req.groups()
+                output = self.process_codec_request(int(server), codecs, int(start), int(end), int(size),
+                                                    int(dictionary_id))
+
+            except Exception as e:
+                traceback.print_exc(limit=1000)
+
+        elif append_req:
+            try:
+                server, curr_term, prev_idx, prev_term, logs, commit_index, _ = append_req.groups()
+                server = int(server)
+                curr_term = int(curr_term)
+                prev_idx = int(prev_idx)
+                prev_term = int(prev_term)
+                commit_index = int(commit_index)
+
+                if logs.startswith('Z'):
+                    # Compressed batch, see get_peer_codec
+                    logs = compression.decode_payload(logs, self.dictionaries)
+
+                if logs is None:
+                    output = f"CODEC-RESET {self.server_index}"
+                else:
+                    output = self.process_append_requests(
+                        server, curr_term, prev_idx, prev_term, eval(logs), commit_index)
+
+            except Exception as e:
+                traceback.print_exc(limit=1000)
+
+        elif tracing_req:
+            # Changes the fraction of client commands that are traced on this node
+            self.tracer.sample_rate = float(tracing_req.group(1))
+            output = "ok"
+
+        elif profile_req:
+            output = self.handle_profile(*profile_req.group(1, 3))
+
+        else:
+            print("Hello1 - " + msg + " - Hello2")
+            output = "Error: Invalid command"
+
+        return output
+
+    def handle_profile(self, action, interval_ms):
+        # PROFILE START [interval_ms] starts sampling the stacks of all threads of the
+        # process, PROFILE STOP writes the samples to the profile file
+        if action == 'START':
+            return "ok" if self.profiler.start(int(interval_ms) if interval_ms else self.profile_interval_ms) else "ko"
+
+        samples = self.profiler.stop()
+        if samples is None:
+            return "ko"
+        print(f"Wrote {samples} stack samples to {self.profiler.path}")
+        return "ok"
+
+    def handle_request(self, msg, conn, addr):
+        # A command forwarded as part of a traced command carries the trace, it is removed
+        # before admission control sees the command
+        return self.tracer.handle(msg, lambda msg: self.admit(msg, conn, addr))
+
+    def admit(self, msg, conn, addr):
+        return self.admission.handle(msg, addr, lambda msg: self.handle_commands(msg, conn))
+
+    def process_request(self, conn):
+        addr = conn.getpeername()[0]
+        while True:
+            try:
+                msg = conn.recv(2048)
+                if not msg:
+                    # Client disconnected, clean up the connection
+                    print("Client disconnected")
+                    conn.close()
+                    break
+
+                # Tools that also talk to multiraft.py hosts end their messages with a newline,
+                # it must not end up in the commit log
+                msg = msg.decode().strip()
+                print(f"{msg} received")
+                output = self.handle_request(msg, conn, addr)
+                conn.sendall(output.encode())
+
+            except ConnectionResetError:
+                # Connection was reset by the client
+                print("Connection reset by client")
+                conn.close()
+                break
+
+            except Exception as e:
+                traceback.print_exc(limit=1000)
+                print("Error processing message from client")
+                conn.close()
+                break
+
+            except Exception as e:
+                traceback.print_exc(limit=1000)
+                print("Error processing message from client")
+                conn.close()
+                break
+
+    def listen_to_clients(self):
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind(('0.0.0.0', int(self.port)))
+        server_socket.listen(50)
+
+        print(f"Server listening on {self.ip}:{self.port}")
+
+        while True:
+            try:
+                client_socket, client_address = server_socket.accept()
+                print(f"Connected to new client at address {client_address}")
+                client_thread = Thread(target=self.process_request, args=(client_socket,))
+                client_thread.daemon = True
+                client_thread.start()
+
+            except Exception as e:
+                print(f"Error accepting connection: {e}")
+                continue
+
+
+if __name__ == '__main__':
+    ip_address = str(sys.argv[1])
+    port = int(sys.argv[2])
+    partitions = str(sys.argv[3])
+
+    # Optional --data-dir=<path> keeps the key value data on disk instead of in memory
+    state_machine = None
+    for arg in sys.argv[4:]:
+        if arg.startswith('--data-dir='):
+            state_machine = DiskHashTable(arg[len('--data-dir='):])
+
+    # Timing, compression, read cache, admission control and tracing settings, e.g.
+    # --election-period-ms=500 --compression=zlib --client-rate=100 --trace-sample-rate=0.01
+    # (see timeouts.py, compression.py, read_cache.py, admission.py and tracing.py)
+    config = utils.parse_config_args(sys.argv[4:], dict(DEFAULT_TIMEOUTS, **DEFAULT_COMPRESSION,
+                                                        **DEFAULT_READ_CACHE, **DEFAULT_ADMISSION,
+                                                        **DEFAULT_TRACING))
+    dht = Raft(ip=ip_address, port=port, partitions=partitions, state_machine=state_machine,
+               config=config)
+    utils.run_thread(fn=dht.init, args=())
+    dht.listen_to_clients()
+
+
+
     #source myenv/bin/activate          
\ No newline at end of file
@@ -0,0 +1,88 @@
+from collections import OrderedDict
+from threading import Lock
+
+# Size of the GET cache of a Raft node, can be overridden through the config passed to
+# Raft or on the command line as --read-cache-entries=10000 (see utils.parse_config_args)
+DEFAULT_READ_CACHE = {
+    # Values a follower read from the leader for GETs with a STALE bound, 0 turns the
+    # cache off
+    'read_cache_entries': 10000,
+    # Bytes of cached keys and values
+    'read_cache_bytes': 16*1024*1024,
+}
+
+
+class ReadCache:
+    # LRU cache of the GET results a follower read from the leader. Every entry is tagged
+    # with the index of the last entry the leader had applied when it read the value, and
+    # with the time it was read. An entry is dropped as soon as this node applies a SET or
+    # DEL of its key, and a read that was in flight while its key changed is only cached if
+    # the leader read it after that change.
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+
+        # key -> (value, index, read_at), value is None for a key that does not exist
+        self.entries = OrderedDict()
+        self.bytes = 0
+        # key -> [reads in flight, index of the last change applied while they were]
+        self.reads = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def get_size(self, key, value):
+        return len(key.encode()) + (len(value.encode()) if value is not None else 0)
+
+    def get(self, key, min_read_at):
+        # (value, index) of key if it was read at or after min_read_at, None on a miss
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[2] < min_read_at:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def start_read(self, key):
+        with self.lock:
+            self.reads.setdefault(key, [0, -1])[0] += 1
+
+    def end_read(self, key):
+        with self.lock:
+            self.reads[key][0] -= 1
+            if self.reads[key][0] == 0:
+                self.reads.pop(key)
+
+    def put(self, key, value, index, read_at):
+        # Called between start_read and end_read with the result of the read
+        with self.lock:
+            if self.max_entries <= 0 or index < self.reads.get(key, [0, -1])[1]:
+                return
+
+            if key in self.entries:
+                old_value, old_index, _ = self.entries[key]
+                if old_index > index:
+                    return
+                self.bytes -= self.get_size(key, old_value)
+
+            self.entries[key] = (value, index, read_at)
+            self.entries.move_to_end(key)
+            self.bytes += self.get_size(key, value)
+
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                old_key, (old_value, _, _) = self.entries.popitem(last=False)
+                self.bytes -= self.get_size(old_key, old_value)
+
+    def invalidate(self, key, index):
+        # This node applied a change of key at index
+        with self.lock:
+            if key in self.entries:
+                value, _, _ = self.entries.pop(key)
+                self.bytes -= self.get_size(key, value)
+
+            if key in self.reads:
+                self.reads[key][1] = max(self.reads[key][1], index)
@@ -0,0 +1,243 @@
+from random import Random
+import random
+import os
+import shutil
+import tempfile
+import time
+import traceback
+from queue import Queue, Empty
+from threading import Lock
+from raft import Raft
+import admission
+import tracing
+import utils
+
+
+class SimNetwork:
+    # In-process network connecting Raft nodes, every message is handed directly to
+    # handle_commands of the destination node. Latency, jitter and message loss are
+    # drawn from a seeded random generator so that a given seed always produces the
+    # same sequence of network decisions. Messages and replies are cut off after
+    # max_message_bytes, same as the single recv(2048) of raft.py nodes and clients.
+    def __init__(self, latency_ms=1.0, jitter_ms=0.0, loss=0.0, seed=0, max_message_bytes=2048):
+        self.latency_ms = latency_ms
+        self.max_message_bytes = max_message_bytes
+        self.jitter_ms = jitter_ms
+        self.loss = loss
+        self.rand = Random(seed)
+        self.lock = Lock()
+        self.nodes = {}
+        self.blocked = set()
+        self.down = set()
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+
+    def register(self, addr, node):
+        with self.lock:
+            self.nodes[addr] = node
+
+    def partition(self, group_a, group_b):
+        # Block all traffic between the two groups of addresses in both directions
+        with self.lock:
+            for a in group_a:
+                for b in group_b:
+                    self.blocked.add((a, b))
+                    self.blocked.add((b, a))
+
+    def isolate(self, addr):
+        # Simulates a crashed node, nothing goes in or out of it
+        with self.lock:
+            self.down.add(addr)
+
+    def heal(self, addr=None):
+        with self.lock:
+            if addr is None:
+                self.blocked.clear()
+                self.down.clear()
+            else:
+                self.down.discard(addr)
+                self.blocked = set([(a, b) for a, b in self.blocked if a != addr and b != addr])
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+
+    def is_reachable(self, src, dst):
+        with self.lock:
+            return not self.closed and src not in self.down and dst not in self.down \
+                and (src, dst) not in self.blocked
+
+    def get_delay(self):
+        # One way delay in seconds
+        delay = self.latency_ms
+        if self.jitter_ms > 0:
+            delay += self.rand.uniform(-self.jitter_ms, self.jitter_ms)
+        return max(0.0, delay)/2000.0
+
+    def truncate(self, msg):
+        if msg is None or self.max_message_bytes <= 0:
+            return msg
+        return msg.encode()[:self.max_message_bytes].decode(errors='ignore')
+
+    def deliver(self, src, dst, msg, timeout=-1):
+        with self.lock:
+            self.sent += 1
+            drop = self.loss > 0 and self.rand.random() < self.loss
+            delay = self.get_delay()
+            node = self.nodes.get(dst)
+
+        if drop or node is None or not self.is_reachable(src, dst):
+            with self.lock:
+                self.dropped += 1
+
+            # Sender only finds out after its timeout expires, same as a socket select
+            time.sleep(timeout if timeout > 0 else 1.0)
+            return None
+
+        time.sleep(delay)
+
+        # Run the handler in its own thread, same as a server thread per connection,
+        # so that a stuck handler does not hold the sender beyond its timeout.
+        res = Queue()
+        utils.run_thread(fn=self.handle, args=(node, src, self.truncate(msg), res))
+
+        try:
+            resp = res.get(block=True, timeout=timeout if timeout > 0 else None)
+        except Empty:
+            return None
+
+        # The reply can be lost if the link broke while the request was processed
+        if not self.is_reachable(dst, src):
+            return None
+
+        time.sleep(delay)
+        return self.truncate(resp)
+
+    def handle(self, node, src, msg, res):
+        resp = None
+        try:
+            resp = node.handle_request(msg, None, src[0])
+        except Exception as e:
+            traceback.print_exc(limit=1000)
+        res.put(resp)
+
+
+class SimTransport:
+    # Drop-in replacement for transport.SocketTransport that sends messages over a SimNetwork
+    def __init__(self, network, addr):
+        self.network = network
+        self.addr = addr
+
+    def send_and_recv_no_retry(self, msg, ip, port, timeout=-1):
+        with tracing.span('rpc', to=f"{ip}:{port}"):
+            return self.network.deliver(self.addr, (ip, int(port)), tracing.inject(admission.forward(msg)),
+                                        timeout=timeout)
+
+    def send_and_recv(self, msg, ip, port, res=None, timeout=-1, attempts=3):
+        for attempt in range(attempts):
+            resp = self.send_and_recv_no_retry(msg, ip, port, timeout)
+            if resp or self.network.closed:
+                break
+            time.sleep(0.05*(2**attempt))
+
+        if res is not None:
+            res.put(resp)
+
+        return resp
+
+
+class SimCluster:
+    # Runs all replicas of all partitions as Raft objects inside the current process.
+    # Timeouts are scaled down from the production defaults so that elections
+    # complete in a fraction of a second.
+    def __init__(self, num_partitions=1, replicas=3, network=None, seed=0,
+                 election_period_ms=(300, 600), rpc_period_ms=200, lease_duration=1000,
+                 heartbeat_period_ms=100, base_port=7000, adaptive_timeouts=False, config=None):
+        self.network = network if network else SimNetwork(seed=seed)
+        self.log_dir = tempfile.mkdtemp(prefix='raft-sim-')
+        self.partitions = [[f"127.0.0.1:{base_port + i*replicas + j}" for j in range(replicas)]
+                           for i in range(num_partitions)]
+        self.nodes = []
+        self.clients = 0
+        # Other settings passed on to every node, e.g. {'compression': 'zlib'}
+        node_config = config if config else {}
+
+        # Election timers in raft.py use the global random generator
+        random.seed(seed)
+
+        for cluster in self.partitions:
+            for addr in cluster:
+                ip, port = addr.split(':')
+                port = int(port)
+                config = {'election_period_ms': random.randint(election_period_ms[0], election_period_ms[1]),
+                          'rpc_period_ms': rpc_period_ms, 'lease_duration': lease_duration,
+                          'heartbeat_period_ms': heartbeat_period_ms,
+                          'adaptive_timeouts': 1 if adaptive_timeouts else 0}
+                config.update(node_config)
+                node = Raft(ip=ip, port=port, partitions=str(self.partitions),
+                            transport=SimTransport(self.network, (ip, port)), log_dir=self.log_dir,
+                            config=config)
+                self.network.register((ip, port), node)
+                self.nodes += [node]
+
+    def start(self):
+        for node in self.nodes:
+            utils.run_thread(fn=node.init, args=())
+
+    def stop(self):
+        self.network.close()
+        shutil.rmtree(self.log_dir, ignore_errors=True)
+
+    def addr(self, node):
+        return (node.ip, node.port)
+
+    def partition_nodes(self, partition=0):
+        return [node for node in self.nodes if node.cluster_index == partition]
+
+    def live_nodes(self):
+        # Nodes a client can expect an answer from: not crashed and able to reach a majority
+        # of their partition, counting themselves
+        nodes = []
+        for node in self.nodes:
+            peers = self.partition_nodes(node.cluster_index)
+            reachable = [peer for peer in peers if peer is node or
+                         self.network.is_reachable(self.addr(node), self.addr(peer))]
+            if self.addr(node) not in self.network.down and len(reachable) > len(peers)//2:
+                nodes += [node]
+        return nodes
+
+    def leader(self, partition=0):
+        # Live leader with the highest term, an isolated old leader may still believe it is leader
+        leaders = [node for node in self.partition_nodes(partition)
+                   if node.state == 'LEADER' and self.addr(node) not in self.network.down]
+        if len(leaders) == 0:
+            return None
+        return max(leaders, key=lambda node: node.current_term)
+
+    def wait_for_leader(self, partition=0, timeout=30.0):
+        end = time.time() + timeout
+        while time.time() < end:
+            leader = self.leader(partition)
+            if leader:
+                return leader
+            time.sleep(0.01)
+        return None
+
+    def wait_for_catch_up(self, node, timeout=30.0):
+        # Wait until node has the same last log index as the leader of its partition
+        end = time.time() + timeout
+        while time.time() < end:
+            leader = self.leader(node.cluster_index)
+            if leader:
+                last_index, _ = node.commit_log.get_last_index_term()
+                leader_last_index, _ = leader.commit_log.get_last_index_term()
+                if last_index >= leader_last_index:
+                    return True
+            time.sleep(0.01)
+        return False
+
+    def client(self):
+        # Transport for an external client, every client gets its own address on the network
+        self.clients += 1
+        return SimTransport(self.network, ('client', self.clients))
@@ -0,0 +1,66 @@
+# Timing settings of a Raft node, all in milliseconds. Any of them can be overridden
+# through the config passed to Raft or on the command line as --election-period-ms=500
+# (see utils.parse_config_args).
+DEFAULT_TIMEOUTS = {
+    # Election timeout is picked at random between election_period_ms and twice that
+    'election_period_ms': 5000,
+    # Timeout of a single RPC to another node
+    'rpc_period_ms': 3000,
+    # Leader broadcasts a heartbeat to all followers once its lease is this old
+    'lease_duration': 5000,
+    # Leader sends a heartbeat to a follower that got no other message for this long
+    'heartbeat_period_ms': 1000,
+    # 1 derives the election, RPC and lease timeouts from the measured round trip times
+    # and jitter, within the bounds below
+    'adaptive_timeouts': 0,
+    'min_election_period_ms': 300,
+    'max_election_period_ms': 10000,
+    'min_rpc_period_ms': 20,
+    'max_rpc_period_ms': 3000,
+    # Client sessions without a command for this long are dropped, a retry after that is
+    # applied again. Must be the same on all replicas.
+    'session_ttl_ms': 3600000,
+}
+
+# Starting values of the timeouts with adaptive_timeouts on, used for the ones that are
+# not set explicitly. They only hold until the first round trips are measured.
+ADAPTIVE_TIMEOUTS = {
+    'election_period_ms': 500,
+    'rpc_period_ms': 500,
+    'lease_duration': 400,
+    'heartbeat_period_ms': 100,
+}
+
+
+def clamp(value, low, high):
+    return max(low, min(high, value))
+
+
+class RttEstimator:
+    # Smoothed round trip time and its mean deviation as in TCP (RFC 6298). Also used on
+    # followers for the time between two messages of the leader, where the deviation is
+    # the jitter of the heartbeats.
+    def __init__(self, alpha=0.125, beta=0.25):
+        self.alpha = alpha
+        self.beta = beta
+        self.srtt = None
+        self.rttvar = None
+
+    def add_sample(self, sample_ms):
+        if self.srtt is None:
+            self.srtt = sample_ms
+            self.rttvar = sample_ms/2.0
+        else:
+            self.rttvar = (1-self.beta)*self.rttvar + self.beta*abs(self.srtt - sample_ms)
+            self.srtt = (1-self.alpha)*self.srtt + self.alpha*sample_ms
+
+    def has_samples(self):
+        return self.srtt is not None
+
+    def get_timeout(self):
+        # Time after which a reply or message is very unlikely to still arrive
+        return self.srtt + 4*self.rttvar
+
+    def reset(self):
+        self.srtt = None
+        self.rttvar = None
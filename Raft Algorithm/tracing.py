@@ -0,0 +1,309 @@
+import argparse
+import json
+import os
+import random
+import re
+import socket
+import sys
+import threading
+import time
+from queue import Queue, Full
+from threading import Lock
+import mmh3
+import utils
+
+# Tracing settings of a Raft node, can be overridden through the config passed to Raft or
+# on the command line as --trace-sample-rate=0.01 (see utils.parse_config_args)
+DEFAULT_TRACING = {
+    # Fraction of client commands that are traced, 0 turns tracing off. Can be changed on
+    # a running node with TRACING <rate>.
+    'trace_sample_rate': 0.0,
+    # File the spans are appended to as JSON lines, trace-<ip>-<port>.jsonl next to the
+    # commit log if empty
+    'trace_file': '',
+    # host:port that every span is also sent to as a UDP datagram with the same JSON
+    'trace_endpoint': '',
+    # Time between two stack samples of PROFILE START
+    'profile_interval_ms': 10,
+}
+
+# Commands that start a trace, every other command is only traced when it was forwarded
+# as part of a traced command
+TRACED_COMMANDS = ('SET', 'GET', 'DEL', 'SCAN', 'WATCH')
+
+# Trace of the command the current thread is handling, (tracer, trace_id, span_id) of the
+# innermost span or None
+context = threading.local()
+
+
+def new_id():
+    return f"{random.getrandbits(64):016x}"
+
+
+def current():
+    return getattr(context, 'span', None)
+
+
+def inject(msg):
+    # Prefix a message sent to another node with the current trace, that node continues
+    # the trace with its own spans (see Tracer.handle)
+    traced = current()
+    if traced is None:
+        return msg
+    _, trace_id, span_id = traced
+    return f"TRACE {trace_id} {span_id} {msg}"
+
+
+def bind(fn):
+    # fn runs in the current trace when it is called from another thread
+    traced = current()
+
+    def run(*args):
+        previous = current()
+        context.span = traced
+        try:
+            return fn(*args)
+        finally:
+            context.span = previous
+
+    return run
+
+
+class Span:
+    # Times a stage of the traced command of the current thread, does nothing if the
+    # command is not traced
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.parent = None
+
+    def __enter__(self):
+        self.parent = current()
+        if self.parent:
+            tracer, trace_id, _ = self.parent
+            self.span_id = new_id()
+            self.start = time.time()
+            context.span = (tracer, trace_id, self.span_id)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.parent:
+            context.span = self.parent
+            tracer, trace_id, parent_id = self.parent
+            tracer.record(trace_id, parent_id, self.name, self.start, time.time(),
+                          span_id=self.span_id, **self.attrs)
+        return False
+
+
+def span(name, **attrs):
+    return Span(name, attrs)
+
+
+class SpanExporter:
+    # Appends spans to a file and sends them to an endpoint from a background thread, so
+    # that a slow disk never delays the commands. Spans are dropped while the queue is full.
+    def __init__(self, path, endpoint, max_queue=10000, batch=1000):
+        self.path = path
+        self.endpoint = endpoint
+        self.queue = Queue(maxsize=max_queue)
+        self.batch = batch
+        self.lock = Lock()
+        self.started = False
+        self.dropped = 0
+
+    def export(self, span):
+        with self.lock:
+            if not self.started:
+                self.started = True
+                utils.run_thread(fn=self.run, args=())
+
+        try:
+            self.queue.put_nowait(span)
+        except Full:
+            self.dropped += 1
+
+    def run(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) if self.endpoint else None
+        if sock:
+            ip, port = self.endpoint.split(':')
+            addr = (ip, int(port))
+
+        while True:
+            spans = [self.queue.get(block=True)]
+            while len(spans) < self.batch and not self.queue.empty():
+                spans.append(self.queue.get())
+            lines = [json.dumps(span) for span in spans]
+
+            try:
+                if self.path:
+                    with open(self.path, 'a') as f:
+                        f.write('\n'.join(lines) + '\n')
+                if sock:
+                    for line in lines:
+                        sock.sendto(line.encode(), addr)
+            except Exception as e:
+                print(f"Error exporting spans: {e}")
+
+
+class Tracer:
+    # Samples client commands and records the time of every stage a sampled command goes
+    # through on this node. A command is sampled by the hash of its text, so a node that
+    # it is forwarded to without a trace makes the same decision and does not start a
+    # second trace for it.
+    def __init__(self, config, node, path):
+        self.sample_rate = config['trace_sample_rate']
+        self.node = node
+        self.exporter = SpanExporter(config['trace_file'] if config['trace_file'] else path,
+                                     config['trace_endpoint'])
+
+    def is_sampled(self, msg):
+        if self.sample_rate <= 0 or msg.split(' ', 1)[0] not in TRACED_COMMANDS:
+            return False
+        return mmh3.hash(msg, signed=False) < self.sample_rate*2**32
+
+    def handle(self, msg, handler):
+        # Run handler(msg) with the command's TRACE prefix removed, inside a request span
+        # if the command is traced
+        traced = re.match('^TRACE ([0-9a-f]+) ([0-9a-f]+) (.*)$', msg, re.S)
+        if traced:
+            trace_id, parent_id, msg = traced.groups()
+        elif self.is_sampled(msg):
+            trace_id, parent_id = new_id(), None
+        else:
+            return handler(msg)
+
+        previous = current()
+        span_id = new_id()
+        context.span = (self, trace_id, span_id)
+        start = time.time()
+        output = None
+
+        try:
+            output = handler(msg)
+            return output
+        finally:
+            context.span = previous
+            self.record(trace_id, parent_id, 'request', start, time.time(), span_id=span_id,
+                        command=msg.split(' ', 1)[0], reply=output.split(' ', 1)[0] if output else None)
+
+    def record(self, trace_id, parent_id, name, start, end, span_id=None, **attrs):
+        span = {'trace_id': trace_id, 'span_id': span_id if span_id else new_id(), 'parent_id': parent_id,
+                'name': name, 'node': self.node, 'start_us': int(start*1e6),
+                'duration_us': int((end-start)*1e6)}
+        span.update(attrs)
+        self.exporter.export(span)
+
+
+class SamplingProfiler:
+    # Samples the stacks of all threads of the process every interval_ms between start and
+    # stop, including threads that are blocked, so waits show up as well as CPU time. The
+    # result is written as collapsed stacks, one line per distinct stack with the frames
+    # from the thread's entry point down separated by ; and the number of samples, which
+    # flamegraph.pl and speedscope read.
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.running = False
+        self.thread = None
+        self.counts = {}
+        self.samples = 0
+
+    def start(self, interval_ms):
+        with self.lock:
+            if self.running:
+                return False
+            self.running = True
+            self.counts = {}
+            self.samples = 0
+
+        self.thread = utils.run_thread(fn=self.run, args=(interval_ms,))
+        return True
+
+    def stop(self):
+        # Returns the number of samples written, None if the profiler was not running
+        with self.lock:
+            if not self.running:
+                return None
+            self.running = False
+
+        self.thread.join()
+
+        with open(self.path, 'w') as f:
+            for stack, count in sorted(self.counts.items(), key=lambda item: -item[1]):
+                f.write(f"{stack} {count}\n")
+        return self.samples
+
+    def run(self, interval_ms):
+        me = threading.get_ident()
+        next_sample = time.time()
+
+        while self.running:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                stack = ';'.join(reversed(stack))
+                self.counts[stack] = self.counts.get(stack, 0) + 1
+
+            self.samples += 1
+            next_sample += interval_ms/1000.0
+            time.sleep(max(0, next_sample - time.time()))
+
+
+def load_traces(paths):
+    # trace_id -> spans of the trace from all the span files
+    traces = {}
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    span = json.loads(line)
+                    traces.setdefault(span['trace_id'], []).append(span)
+    return traces
+
+
+def print_trace(spans):
+    # Spans indented under their parent, ordered by start time, with the offset from the
+    # start of the trace
+    start = min([span['start_us'] for span in spans])
+    ids = set([span['span_id'] for span in spans])
+    children = {}
+    for span in sorted(spans, key=lambda span: span['start_us']):
+        parent = span['parent_id'] if span['parent_id'] in ids else None
+        children.setdefault(parent, []).append(span)
+
+    def print_children(parent, depth):
+        for span in children.get(parent, []):
+            attrs = ' '.join([f"{k}={v}" for k, v in span.items()
+                              if k not in ('trace_id', 'span_id', 'parent_id', 'name', 'node',
+                                           'start_us', 'duration_us')])
+            print(f"  {'  '*depth}{span['name']:<12} {span['node']:<21} "
+                  f"+{(span['start_us']-start)/1000.0:8.3f}ms {span['duration_us']/1000.0:8.3f}ms {attrs}")
+            print_children(span['span_id'], depth+1)
+
+    print_children(None, 0)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Print the slowest traces of the span files of the nodes')
+    parser.add_argument('files', nargs='+', help='trace-<ip>-<port>.jsonl files')
+    parser.add_argument('--top', type=int, default=10, help='number of traces to print')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    traces = load_traces(args.files)
+
+    def get_duration(spans):
+        return max([span['start_us'] + span['duration_us'] for span in spans]) - \
+               min([span['start_us'] for span in spans])
+
+    slowest = sorted(traces.items(), key=lambda item: -get_duration(item[1]))[:args.top]
+    for trace_id, spans in slowest:
+        print(f"{trace_id} {get_duration(spans)/1000.0:.3f}ms")
+        print_trace(spans)
@@ -0,0 +1,180 @@
+import socket
+import time
+import admission
+import tracing
+from queue import Queue, Empty
+from threading import Lock
+import utils
+
+
+class SocketTransport:
+    # Default transport used by Raft nodes, every RPC opens a new TCP connection
+    # to the destination node (see utils.send_and_recv_no_retry). A message sent while
+    # handling a traced command carries the trace (see tracing.inject), a client command
+    # passed on to another node carries its client (see admission.forward).
+    def send_and_recv_no_retry(self, msg, ip, port, timeout=-1):
+        with tracing.span('rpc', to=f"{ip}:{port}"):
+            return utils.send_and_recv_no_retry(tracing.inject(admission.forward(msg)), ip, port,
+                                                timeout=timeout)
+
+    def send_and_recv(self, msg, ip, port, res=None, timeout=-1, attempts=3):
+        with tracing.span('rpc', to=f"{ip}:{port}"):
+            return utils.send_and_recv(tracing.inject(admission.forward(msg)), ip, port, res=res,
+                                       timeout=timeout, attempts=attempts)
+
+
+class Connection:
+    # Persistent connection carrying newline terminated messages, used between
+    # Multi-Raft hosts where one connection is reused for many requests
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b''
+
+    def send(self, msg):
+        self.sock.sendall((msg + '\n').encode())
+
+    def recv(self, timeout=-1):
+        self.sock.settimeout(timeout if timeout > 0 else None)
+
+        while b'\n' not in self.buffer:
+            data = self.sock.recv(65536)
+            if not data:
+                return None
+            self.buffer += data
+
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return line.decode()
+
+    def close(self):
+        try:
+            self.sock.close()
+        except Exception as e:
+            pass
+
+
+class ConnectionPool:
+    def __init__(self, max_idle=8):
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = Lock()
+
+    def get(self, ip, port, timeout=-1):
+        with self.lock:
+            conns = self.idle.get((ip, port), [])
+            if len(conns) > 0:
+                return conns.pop()
+
+        sock = socket.create_connection((ip, port), timeout=timeout if timeout > 0 else None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return Connection(sock)
+
+    def put(self, ip, port, conn):
+        with self.lock:
+            conns = self.idle.setdefault((ip, port), [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def request(self, msg, ip, port, timeout=-1):
+        try:
+            conn = self.get(ip, port, timeout)
+        except Exception as e:
+            return None
+
+        try:
+            conn.send(msg)
+            resp = conn.recv(timeout)
+        except Exception as e:
+            # A reply that arrives after the timeout would be read by the next request
+            conn.close()
+            return None
+
+        if resp is None:
+            conn.close()
+        else:
+            self.put(ip, port, conn)
+        return resp
+
+
+class HostTransport:
+    # Transport shared by all Raft groups of a Multi-Raft host. Messages are tagged with
+    # the group they belong to and sent over pooled connections. Raft peer RPCs that are
+    # waiting for the same destination host while a batch to it is in flight are merged
+    # into a single BATCH message, so the heartbeats of all groups led by this host reach
+    # each other host in one round trip.
+    BATCHED_COMMANDS = ('VOTE-REQ', 'APPEND-REQ', 'HEARTBEAT')
+
+    def __init__(self, pool=None):
+        self.pool = pool if pool else ConnectionPool()
+        self.lock = Lock()
+        self.pending = {}
+        self.flushing = set()
+
+    def for_group(self, group):
+        return GroupTransport(self, group)
+
+    def request(self, msg, ip, port, timeout=-1):
+        command = msg.split(' ', 3)[2] if msg.startswith('GROUP ') else msg.split(' ', 1)[0]
+        if command not in self.BATCHED_COMMANDS:
+            return self.pool.request(msg, ip, port, timeout)
+
+        res = Queue()
+        with self.lock:
+            self.pending.setdefault((ip, port), []).append((msg, timeout, res))
+            start_flush = (ip, port) not in self.flushing
+            if start_flush:
+                self.flushing.add((ip, port))
+
+        if start_flush:
+            utils.run_thread(fn=self.flush, args=(ip, port))
+
+        try:
+            return res.get(block=True, timeout=timeout if timeout > 0 else None)
+        except Empty:
+            return None
+
+    def flush(self, ip, port):
+        # Keep sending whatever accumulated for this host while the previous batch was in flight
+        while True:
+            with self.lock:
+                batch = self.pending.pop((ip, port), [])
+                if len(batch) == 0:
+                    self.flushing.discard((ip, port))
+                    return
+
+            timeouts = [timeout for _, timeout, _ in batch]
+            timeout = -1 if min(timeouts) <= 0 else max(timeouts)
+
+            if len(batch) == 1:
+                resps = [self.pool.request(batch[0][0], ip, port, timeout)]
+            else:
+                resp = self.pool.request('BATCH\t' + '\t'.join([msg for msg, _, _ in batch]), ip, port, timeout)
+                resps = resp.split('\t')[1:] if resp else []
+
+            for i, (_, _, res) in enumerate(batch):
+                res.put(resps[i] if i < len(resps) and resps[i] else None)
+
+
+class GroupTransport:
+    def __init__(self, host_transport, group):
+        self.host_transport = host_transport
+        self.group = group
+
+    def send_and_recv_no_retry(self, msg, ip, port, timeout=-1):
+        with tracing.span('rpc', to=f"{ip}:{port}"):
+            return self.host_transport.request(f"GROUP {self.group} {tracing.inject(admission.forward(msg))}",
+                                               ip, int(port), timeout)
+
+    def send_and_recv(self, msg, ip, port, res=None, timeout=-1, attempts=3):
+        # Same as utils.send_and_recv, gives up with None after attempts tries
+        for attempt in range(attempts):
+            resp = self.send_and_recv_no_retry(msg, ip, port, timeout)
+            if resp:
+                break
+            time.sleep(0.05*(2**attempt))
+
+        if res is not None:
+            res.put(resp)
+
+        return resp
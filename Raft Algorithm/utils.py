@@ -1,71 +1,109 @@
-from queue import Queue
-import select
-import socket
-from threading import Thread
-import time
-import traceback
-
-
-def run_thread(fn, args):
-    my_thread = Thread(target=fn, args=args)
-    my_thread.daemon = True
-    my_thread.start()
-    return my_thread
-
-
-def wait_for_server_startup(ip, port):
-    while True:
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sock.connect((str(ip), int(port)))
-            return sock
-
-        except Exception as e:
-            traceback.print_exc(limit=1000)
-
-
-def send_and_recv_no_retry(msg, ip, port, timeout=-1):
-    # Could not connect possible reasons:
-    # 1. Server is not ready
-    # 2. Server is busy and not responding
-    # 3. Server crashed and not responding
-
-    conn = wait_for_server_startup(ip, port)
-    resp = None
-
-    try:
-        conn.sendall(msg.encode())
-
-        if timeout > 0:
-            ready = select.select([conn], [], [], timeout)
-            if ready[0]:
-                resp = conn.recv(2048).decode()
-        else:
-            resp = conn.recv(2048).decode()
-
-    except Exception as e:
-        traceback.print_exc(limit=1000)
-        # The server crashed but it is still not marked in current node
-
-    conn.close()
-    return resp
-
-
-def send_and_recv(msg, ip, port, res=None, timeout=-1):
-    resp = None
-    # Could not connect possible reasons:
-    # 1. Server is not ready
-    # 2. Server is busy and not responding
-    # 3. Server crashed and not responding
-
-    while True:
-        resp = send_and_recv_no_retry(msg, ip, port, timeout)
-
-        if resp:
-            break
-
-    if res is not None:
-        res.put(resp)
-
-    return resp
\ No newline at end of file
+from queue import Queue
+import select
+import socket
+from threading import Thread
+import time
+import traceback
+
+
+def run_thread(fn, args):
+    my_thread = Thread(target=fn, args=args)
+    my_thread.daemon = True
+    my_thread.start()
+    return my_thread
+
+
+def wait_for_server_startup(ip, port, timeout=-1, attempts=3):
+    # Connect to the node, None if it did not accept the connection within attempts tries,
+    # e.g. because it is down
+    for attempt in range(attempts):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.settimeout(timeout if timeout > 0 else None)
+            sock.connect((str(ip), int(port)))
+            sock.settimeout(None)
+            return sock
+
+        except Exception as e:
+            sock.close()
+            time.sleep(0.01*(2**attempt))
+
+    return None
+
+
+def send_and_recv_no_retry(msg, ip, port, timeout=-1):
+    # Could not connect possible reasons:
+    # 1. Server is not ready
+    # 2. Server is busy and not responding
+    # 3. Server crashed and not responding
+
+    conn = wait_for_server_startup(ip, port, timeout)
+    resp = None
+    if conn is None:
+        return None
+
+    try:
+        conn.sendall(msg.encode())
+
+        if timeout > 0:
+            ready = select.select([conn], [], [], timeout)
+            if ready[0]:
+                resp = conn.recv(2048).decode()
+        else:
+            resp = conn.recv(2048).decode()
+
+    except Exception as e:
+        traceback.print_exc(limit=1000)
+        # The server crashed but it is still not marked in current node
+
+    conn.close()
+    return resp
+
+
+def send_and_recv(msg, ip, port, res=None, timeout=-1, attempts=3):
+    resp = None
+    # Could not connect possible reasons:
+    # 1. Server is not ready
+    # 2. Server is busy and not responding
+    # 3. Server crashed and not responding
+    # Gives up with None after attempts tries, the caller answers ko and the client retries
+
+    for attempt in range(attempts):
+        resp = send_and_recv_no_retry(msg, ip, port, timeout)
+
+        if resp:
+            break
+        time.sleep(0.05*(2**attempt))
+
+    if res is not None:
+        res.put(resp)
+
+    return resp
+
+
+def parse_config_args(argv, defaults):
+    # Collect --name=value arguments whose name is a key of defaults, e.g. --rpc-period-ms=200,
+    # values are converted to the type of the default
+    config = {}
+    for arg in argv:
+        if arg.startswith('--') and '=' in arg:
+            name, value = arg[2:].split('=', 1)
+            name = name.replace('-', '_')
+            if name in defaults:
+                config[name] = type(defaults[name])(value)
+    return config
+
+
+def request(addr, msg, timeout):
+    # The trailing newline frames the message for multiraft.py hosts, raft.py nodes
+    # ignore it
+    ip, port = addr.split(':')
+    try:
+        conn = socket.create_connection((ip, int(port)), timeout=timeout)
+        conn.sendall((msg + '\n').encode())
+        resp = conn.recv(2048).decode().strip()
+        conn.close()
+        return resp
+    except Exception as e:
+        return None
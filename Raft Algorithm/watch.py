@@ -0,0 +1,120 @@
+import argparse
+import json
+import os
+import sys
+import time
+from threading import Lock
+import utils
+
+
+class CursorFile:
+    # Next log index to read of every partition, saved after every page so that a
+    # restarted consumer continues where it stopped
+    def __init__(self, path, start):
+        self.path = path
+        self.lock = Lock()
+        self.cursors = {}
+        self.start = start
+
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.cursors = dict([(int(i), index) for i, index in json.load(f).items()])
+
+    def get(self, i):
+        with self.lock:
+            return self.cursors.get(i, self.start)
+
+    def set(self, i, index):
+        with self.lock:
+            self.cursors[i] = index
+            if self.path:
+                with open(self.path + '.tmp', 'w') as f:
+                    json.dump(self.cursors, f)
+                os.replace(self.path + '.tmp', self.path)
+
+
+def parse_pairs(parts):
+    return [(parts[k], parts[k+1]) for k in range(0, len(parts)-1, 2)]
+
+
+def parse_changes(parts):
+    # <index> SET <key> <value> or <index> DEL <key>
+    changes = []
+    k = 0
+    while k < len(parts):
+        if parts[k+1] == 'SET':
+            changes += [(int(parts[k]), 'SET', parts[k+2], parts[k+3])]
+            k += 4
+        else:
+            changes += [(int(parts[k]), 'DEL', parts[k+2], None)]
+            k += 3
+    return changes
+
+
+def follow(i, cluster, cursors, args, lock):
+    # Print the changes of partition i, any replica forwards WATCH to the leader
+    options = ''
+    if args.prefix:
+        options += f" PREFIX {args.prefix}"
+    options += f" LIMIT {args.limit} WAIT {args.wait_ms}"
+
+    replica = 0
+    # Index and continuation token of the snapshot being read
+    snapshot = None
+    while True:
+        index, token = snapshot if snapshot else (cursors.get(i), None)
+        msg = f"WATCH {i} {index}{options}" + (f" TOKEN {token}" if token else '')
+        resp = utils.request(cluster[replica], msg, args.timeout + args.wait_ms/1000.0)
+
+        if resp is None or not resp.startswith('WATCH-'):
+            # Try the next replica, e.g. while a new leader is elected
+            replica = (replica + 1) % len(cluster)
+            time.sleep(args.retry_interval)
+            continue
+
+        parts = resp.split(' ')
+        if parts[0] == 'WATCH-SNAPSHOT':
+            # The cursor is older than the compacted log, load the keys and then continue
+            # with the changes from the index of the snapshot
+            with lock:
+                for key, value in parse_pairs(parts[3:]):
+                    print(f"{i} SNAPSHOT {key} {value}")
+                sys.stdout.flush()
+
+            if parts[2] != '-':
+                snapshot = (int(parts[1]), parts[2])
+            else:
+                snapshot = None
+                cursors.set(i, int(parts[1]))
+            continue
+
+        with lock:
+            for change_index, command, key, value in parse_changes(parts[2:]):
+                print(f"{i} {change_index} {command} {key}" + (f" {value}" if value is not None else ''))
+            sys.stdout.flush()
+        cursors.set(i, int(parts[1]))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Stream the committed changes of every partition')
+    parser.add_argument('partitions', help="partitions config, same format as raft.py and multiraft.py")
+    parser.add_argument('--prefix', default=None, help='only changes of keys starting with prefix')
+    parser.add_argument('--start', type=int, default=0, help='log index to start from without a cursor file')
+    parser.add_argument('--cursor-file', default=None, help='file that keeps the position in every partition')
+    parser.add_argument('--limit', type=int, default=100, help='changes per page')
+    parser.add_argument('--wait-ms', type=int, default=1000, help='time a node holds a request without changes')
+    parser.add_argument('--timeout', type=float, default=2.0)
+    parser.add_argument('--retry-interval', type=float, default=0.5)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    partitions = eval(args.partitions)
+    cursors = CursorFile(args.cursor_file, args.start)
+    lock = Lock()
+
+    threads = [utils.run_thread(fn=follow, args=(i, partitions[i], cursors, args, lock))
+               for i in range(len(partitions))]
+    for thread in threads:
+        thread.join()